@@ -11,6 +11,11 @@ import chess
 import gettext
 import locale as loc
 import readline
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from chessclub.protocol.compression import COMPRESSED, available, negotiate, unpack
 
 if 'libedit' in readline.__doc__:
     readline.parse_and_bind("bind ^I rl_complete")
@@ -19,6 +24,27 @@ else:
 
 SERVER = "127.0.0.1"
 PORT = 5555
+RECONNECT_TRIES = 5
+RECONNECT_DELAY = 0.5
+KEEPALIVE_IDLE = 60
+# Requests refused by the server's rate limiter are retried after backoff.
+LIMIT_RETRIES = 4
+LIMIT_BACKOFF = 0.1
+# Seconds between refreshes of player names shown in the game window.
+TABLE_INFO_INTERVAL = 1.0
+# Seconds to wait for the lobby listener before seeking without it.
+LISTEN_TIMEOUT = 5.0
+ADMIN_ENV = "CHESSCLUB_ADMIN_TOKEN"
+# Review keeps a position every REVIEW_CHECKPOINT plies; PageUp/PageDown move by REVIEW_JUMP.
+REVIEW_CHECKPOINT = 16
+REVIEW_JUMP = 10
+# Banner text of drawn game by reason the server gives.
+DRAW_TEXT = {
+    "stalemate": "Пат. Ничья",
+    "insufficient_material": "Ничья: недостаточно материала",
+    "fivefold_repetition": "Ничья: пятикратное повторение",
+    "seventyfive_moves": "Ничья: правило 75 ходов",
+}
 
 locales_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "locales")
 LOCALES = {
@@ -37,45 +63,308 @@ def _(text, locale):
     return LOCALES[locale].gettext(text)
 
 
+class TextCache:
+    """Bounded cache of rendered text and overlay surfaces."""
+
+    def __init__(self, maxsize=64):
+        """Init class."""
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.names = None
+
+    def get(self, key, make):
+        """Return cached surface or create it with make()."""
+        item = self.items.get(key)
+        if item is None:
+            item = self.items[key] = make()
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+        else:
+            self.items.move_to_end(key)
+        return item
+
+    def text(self, font, text, color, locale=None, **fmt):
+        """Render text, translating it first when locale is given."""
+        key = (text, font, color, locale, tuple(sorted(fmt.items())))
+
+        def make():
+            s = _(text, locale) if locale else str(text)
+            return font.render(s.format(**fmt) if fmt else s, True, color)
+
+        return self.get(key, make)
+
+    def overlay(self, size, color):
+        """Filled translucent surface of given size."""
+
+        def make():
+            s = pygame.Surface(size, pygame.SRCALPHA)
+            s.fill(color)
+            return s
+
+        return self.get(("overlay", size, color), make)
+
+    def set_names(self, names):
+        """Drop cache when player names on labels change."""
+        if names != self.names:
+            self.clear()
+            self.names = names
+
+    def clear(self):
+        """Invalidate all cached surfaces."""
+        self.items.clear()
+
+
+TEXT_CACHE = TextCache()
+
+
+class TableIdCache:
+    """Sorted table ids for completion, refreshed incrementally after ttl."""
+
+    def __init__(self, ttl=2.0):
+        """Init class."""
+        self.ttl = ttl
+        self.version = None
+        self.ids = []
+        self.fetched = 0
+
+    def refresh(self, sock):
+        """Fetch lobby changes since known version."""
+        resp = send_recv(sock, {"action": "lobby_ids", "since": self.version})
+        self.fetched = time.monotonic()
+        if resp["status"] != "ok":
+            # Rate limited: complete from known ids until the next refresh.
+            return
+        data = resp["data"]
+        if "ids" in data:
+            self.ids = sorted(str(tid) for tid in data["ids"])
+        else:
+            for tid, added in data["changes"]:
+                tid = str(tid)
+                i = bisect_left(self.ids, tid)
+                present = i < len(self.ids) and self.ids[i] == tid
+                if added and not present:
+                    insort(self.ids, tid)
+                elif not added and present:
+                    del self.ids[i]
+        self.version = data["version"]
+
+    def complete(self, sock, prefix):
+        """Ids starting with prefix."""
+        if time.monotonic() - self.fetched > self.ttl:
+            self.refresh(sock)
+        lo = bisect_left(self.ids, prefix)
+        hi = bisect_left(self.ids, prefix + "\U0010ffff", lo)
+        return self.ids[lo:hi]
+
+
+def connect(address):
+    """TCP connection without Nagle delay on small move frames, with keepalive."""
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+    return sock
+
+
+class Connection:
+    """Socket to server that resumes the session after a drop."""
+
+    def __init__(self, address, sock=None):
+        """Init class."""
+        self.address = address
+        self.sock = sock or connect(address)
+        self.token = None
+        self.on_resume = None
+        self.codec = None
+        self.rtt = None
+
+    def sendall(self, data):
+        """Send bytes."""
+        self.sock.sendall(data)
+
+    def recv(self, size):
+        """Receive bytes."""
+        return self.sock.recv(size)
+
+    def getpeername(self):
+        """Server address."""
+        return self.sock.getpeername()
+
+    def close(self):
+        """Close socket."""
+        self.sock.close()
+
+    def negotiate(self):
+        """Ask server to compress large frames; old servers just refuse."""
+        self.codec = None
+        resp = send_recv(self, {"action": "compress", "codecs": available()})
+        if resp["status"] == "ok" and resp["data"]["codec"]:
+            self.codec = negotiate([resp["data"]["codec"]])
+        return self.codec
+
+    def reconnect(self, tries=RECONNECT_TRIES, delay=RECONNECT_DELAY, ply=0):
+        """Open new socket and resume session in one round trip."""
+        self.sock.close()
+        for attempt in range(tries):
+            try:
+                self.sock = connect(self.address)
+                resp = send_recv(self.sock, {"action": "resume", "token": self.token, "ply": ply})
+                break
+            except OSError:
+                if attempt == tries - 1:
+                    raise
+                time.sleep(delay * 2 ** attempt)
+        if resp["status"] != "ok":
+            self.token = None
+            raise ConnectionError(resp["msg"])
+        self.negotiate()
+        if self.on_resume is not None:
+            self.on_resume(resp["data"])
+        return resp["data"]
+
+
 def send_recv(sock, data):
-    """Sends pickle payload to receive response from server."""
+    """Sends pickle payload to receive response from server.
+
+    A request refused by the rate limiter is sent again after a growing
+    pause; if it is still refused, the refusal is returned like any other
+    error.
+    """
     payload = pickle.dumps(data)
-    sock.sendall(len(payload).to_bytes(4, "big") + payload)
+    frame = len(payload).to_bytes(4, "big") + payload
+    for attempt in range(LIMIT_RETRIES + 1):
+        started = time.monotonic()
+        try:
+            sock.sendall(frame)
+            resp = recv_frame(sock)
+        except OSError:
+            if not isinstance(sock, Connection) or sock.token is None:
+                raise
+            sock.reconnect()
+            started = time.monotonic()
+            sock.sendall(frame)
+            resp = recv_frame(sock)
+        if not resp.get("limited") or attempt == LIMIT_RETRIES:
+            break
+        time.sleep(LIMIT_BACKOFF * 2 ** attempt)
+    if isinstance(sock, Connection):
+        # Reported to the server with the next move for lag statistics.
+        sock.rtt = time.monotonic() - started
+    return resp
+
+
+def send_stream(sock, data):
+    """Send request and yield data of response frames while server marks more."""
+    resp = send_recv(sock, data)
+    while True:
+        if resp["status"] != "ok":
+            raise RuntimeError(resp["msg"])
+        if not resp.get("more"):
+            return
+        yield resp["data"]
+        resp = recv_frame(sock)
+
+
+def recv_frame(sock):
+    """Receive one length-prefixed pickle frame."""
     resp_len_bytes = sock.recv(4)
     if not resp_len_bytes:
         raise ConnectionError("Server disconnected")
-    resp_len = int.from_bytes(resp_len_bytes, "big")
+    header = int.from_bytes(resp_len_bytes, "big")
+    resp_len = header & ~COMPRESSED
     resp_data = b""
     while len(resp_data) < resp_len:
         chunk = sock.recv(resp_len - len(resp_data))
         if not chunk:
             raise ConnectionError("Server disconnected")
         resp_data += chunk
-    return pickle.loads(resp_data)
+    # Only a Connection negotiates compression, so only it gets such frames.
+    return pickle.loads(unpack(header, resp_data, sock.codec if header & COMPRESSED else None))
 
 
 def get_table_info(sock, table_id):
-    """Get table list and print info."""
-    resp = send_recv(sock, {"action": "list_tables"})
-    for t in resp["data"]:
-        if t["id"] == table_id:
-            return t
+    """Lobby entry of table, None if there is no such table or server refused."""
+    resp = send_recv(sock, {"action": "table_info", "table_id": table_id})
+    return resp["data"] if resp["status"] == "ok" else None
+
+
+def find_move(moves, from_sq, to_sq):
+    """Return first move between two squares or None."""
+    for mv in moves:
+        if mv.from_square == from_sq and mv.to_square == to_sq:
+            return mv
     return None
 
 
+def premove_board(board, color, premoves):
+    """Board after queued premoves, with color to move."""
+    b = board.copy(stack=False)
+    for mv in premoves:
+        b.turn, b.ep_square = color, None
+        if b.color_at(mv.from_square) != color:
+            break
+        b.push(mv)
+    b.turn, b.ep_square = color, None
+    return b
+
+
+class Replay:
+    """Moves of finished game with positions cached every `every` plies.
+
+    Stepping one ply pushes or pops a single move; any other jump copies
+    the nearest checkpoint at or before the target and pushes at most
+    every - 1 moves from there.
+    """
+
+    def __init__(self, moves, start=chess.STARTING_FEN, every=REVIEW_CHECKPOINT):
+        """Init class."""
+        self.moves = moves
+        self.every = every
+        board = chess.Board(start)
+        self.checkpoints = [board.copy(stack=False)]
+        for ply, mv in enumerate(moves, 1):
+            board.push(mv)
+            if ply % every == 0:
+                self.checkpoints.append(board.copy(stack=False))
+        self.ply = 0
+        self.board = self.checkpoints[0].copy(stack=False)
+
+    def __len__(self):
+        """Number of plies."""
+        return len(self.moves)
+
+    def seek(self, ply):
+        """Board after ply moves, clamped to the game."""
+        ply = max(0, min(ply, len(self.moves)))
+        if ply == self.ply + 1:
+            self.board.push(self.moves[self.ply])
+        elif ply == self.ply - 1 and self.board.move_stack:
+            self.board.pop()
+        elif ply != self.ply:
+            base = ply // self.every
+            self.board = self.checkpoints[base].copy(stack=False)
+            for mv in self.moves[base * self.every:ply]:
+                self.board.push(mv)
+        self.ply = ply
+        return self.board
+
+
 def play_game_pygame(
-    table_id, sock, my_color=None, flip_board=False, quit_callback=None, username=None, locale="ru_RU.UTF-8"
+    table_id, sock, my_color=None, flip_board=False, quit_callback=None, username=None, locale="ru_RU.UTF-8",
+    review=None, review_info=None,
 ):
     """Make fonts and images."""
     BASE_DIR = os.path.dirname(os.path.dirname(__file__))
     FIGDIR = os.path.join(BASE_DIR, "figures")
     SQ, FPS = 96, 60
     COL_L, COL_D = (240, 217, 181), (181, 136, 99)
-    CLR_LAST, CLR_MOVE, CLR_CAP, CLR_CHK = (
+    CLR_LAST, CLR_MOVE, CLR_CAP, CLR_CHK, CLR_PRE = (
         (0, 120, 215, 120),
         (255, 255, 0, 120),
         (255, 0, 0, 120),
         (200, 0, 0, 150),
+        (0, 160, 80, 120),
     )
     MASK_MATE, MASK_PATT = (200, 0, 0, 130), (128, 128, 128, 130)
     ANIM_FRAMES = 12
@@ -86,7 +375,7 @@ def play_game_pygame(
     pygame.font.init()
 
     screen = pygame.display.set_mode((SQ * 8, TOP_MARGIN + SQ * 8 + BOTTOM_MARGIN))
-    pygame.display.set_caption(f"Table {table_id}")
+    pygame.display.set_caption(f"Game {table_id}" if review is not None else f"Table {table_id}")
     clock = pygame.time.Clock()
     font = pygame.font.SysFont(None, 48)
     label_font = pygame.font.SysFont(None, 40)
@@ -115,7 +404,9 @@ def play_game_pygame(
         s.fill(color)
         return s
 
-    S_LAST, S_MOVE, S_CAP, S_CHK = map(surf, (CLR_LAST, CLR_MOVE, CLR_CAP, CLR_CHK))
+    S_LAST, S_MOVE, S_CAP, S_CHK, S_PRE = map(
+        surf, (CLR_LAST, CLR_MOVE, CLR_CAP, CLR_CHK, CLR_PRE)
+    )
 
     def sq_center(sq):
         """Measure square center."""
@@ -194,8 +485,90 @@ def play_game_pygame(
 
     def send_move(move):
         """Send move of chess piece."""
-        uci = move.uci()
-        send_recv(sock, {"action": "move", "table_id": table_id, "uci": uci})
+        req = {"action": "move", "table_id": table_id, "uci": move.uci()}
+        if isinstance(sock, Connection) and sock.rtt is not None:
+            req["rtt"] = sock.rtt
+        return send_recv(sock, req)
+
+    def corner(sq):
+        """Top left corner of square."""
+        c = sq_center(sq)
+        return c[0] - SQ // 2, c[1] - SQ // 2
+
+    def animate_move(move, castling, start=None):
+        """Animate move that is already pushed to board."""
+        p = board.piece_at(move.to_square)
+        anims.append(
+            Anim(
+                p.piece_type,
+                p.color,
+                start or corner(move.from_square),
+                corner(move.to_square),
+                move.to_square,
+            )
+        )
+        if castling:
+            rf, rt = (7, 5) if chess.square_file(move.to_square) == 6 else (0, 3)
+            rank = chess.square_rank(move.to_square)
+            rf, rt = chess.square(rf, rank), chess.square(rt, rank)
+            anims.append(Anim(chess.ROOK, p.color, corner(rf), corner(rt), rt))
+
+    def commit_move(move, start=None, animate=True):
+        """Push own move at once and send it without waiting for the reply.
+
+        The animation runs while the move travels; settle_move() applies
+        the reply once it arrives.
+        """
+        nonlocal last, sent
+        castling = board.is_castling(move)
+        prev = last
+        board.push(move)
+        last = move
+        if animate:
+            animate_move(move, castling, start)
+        sent = (prev, mover.submit(send_move, move))
+
+    def settle_move():
+        """Apply reply to sent move, rolling the board back if server rejected it."""
+        nonlocal last, last_poll, game_over, outcome, sent
+        prev, reply = sent
+        sent = None
+        resp = reply.result()
+        if resp.get("status") != "ok":
+            board.pop()
+            last = prev
+            anims.clear()
+            premoves.clear()
+            last_poll = 0
+            return
+        # The server decides when the game is over and says so in the reply.
+        if resp.get("data"):
+            outcome, game_over = resp["data"], True
+
+    def play_premove():
+        """Submit first queued premove if it is legal now."""
+        if not premoves or board.turn != my_side or game_over:
+            return
+        mv = premoves.pop(0)
+        if mv in board.legal_moves:
+            commit_move(mv)
+        else:
+            premoves.clear()
+
+    def targets(b, sq, moves):
+        """Split destinations of piece into quiet moves and captures."""
+        quiet, caps = set(), set()
+        for mv in moves:
+            if mv.from_square == sq:
+                if b.piece_at(mv.to_square) or (
+                    b.piece_at(sq).piece_type == chess.PAWN
+                    and b.ep_square is not None
+                    and mv.to_square == b.ep_square
+                ):
+                    caps.add(mv.to_square)
+                else:
+                    quiet.add(mv.to_square)
+        return quiet, caps
 
     def draw_labels(table_info):
         """Draw names of players."""
@@ -207,73 +580,106 @@ def play_game_pygame(
             white = "White"
             black = "Black"
             active_players = set()
+        TEXT_CACHE.set_names((white, black, frozenset(active_players)))
 
+        wait_white, wait_black = "Ожидание белых", "Ожидание чёрных"
         if not white or white not in active_players:
-            white_label = _("Ожидание белых", locale)
+            white_label, white_loc = wait_white, locale
         else:
-            white_label = white
+            white_label, white_loc = white, None
 
         if not black or black not in active_players:
-            black_label = _("Ожидание чёрных", locale)
+            black_label, black_loc = wait_black, locale
         else:
-            black_label = black
+            black_label, black_loc = black, None
 
         if my_color == "white":
-            my_name = username if username else white_label
-            opp_name = black_label if black_label != my_name else _("Ожидание чёрных", locale)
+            my_name, my_loc = (username, None) if username else (white_label, white_loc)
+            opp_name, opp_loc = (
+                (black_label, black_loc) if black_label != my_name else (wait_black, locale)
+            )
         elif my_color == "black":
-            my_name = username if username else black_label
-            opp_name = white_label if white_label != my_name else _("Ожидание белых", locale)
+            my_name, my_loc = (username, None) if username else (black_label, black_loc)
+            opp_name, opp_loc = (
+                (white_label, white_loc) if white_label != my_name else (wait_white, locale)
+            )
         else:
-            my_name = white_label
-            opp_name = black_label
+            my_name, my_loc = white_label, white_loc
+            opp_name, opp_loc = black_label, black_loc
 
-        if flip_board:
-            bottom_label = my_name
-            top_label = opp_name
+        if flip_board or my_color != "black":
+            bottom = (my_name, my_loc)
+            top = (opp_name, opp_loc)
         else:
-            bottom_label = my_name if my_color != "black" else opp_name
-            top_label = opp_name if my_color != "black" else my_name
+            bottom = (opp_name, opp_loc)
+            top = (my_name, my_loc)
 
-        if top_label:
-            top_text = label_font.render(str(top_label), True, (0, 0, 0))
+        if top[0]:
+            top_text = TEXT_CACHE.text(label_font, top[0], (0, 0, 0), top[1])
             top_rect = top_text.get_rect(center=(SQ * 4, TOP_MARGIN // 2))
             screen.blit(top_text, top_rect)
-        if bottom_label:
-            bottom_text = label_font.render(str(bottom_label), True, (0, 0, 0))
+        if bottom[0]:
+            bottom_text = TEXT_CACHE.text(label_font, bottom[0], (0, 0, 0), bottom[1])
             bottom_rect = bottom_text.get_rect(
                 center=(SQ * 4, TOP_MARGIN + SQ * 8 + BOTTOM_MARGIN // 2)
             )
             screen.blit(bottom_text, bottom_rect)
 
-    resp = send_recv(sock, {"action": "get_board", "table_id": table_id})
-    if resp["status"] != "ok":
-        print(_("Ошибка: нет такой партии!", locale))
-        pygame.quit()
-        return
-
-    board = chess.Board(resp["data"])
-    drag_sq = drag_pos = None
+    def review_to(ply):
+        """Show position after ply of reviewed game, animating single steps."""
+        nonlocal board, last, game_over, outcome
+        prev = review.ply
+        castling = ply == prev + 1 and prev < len(review) and board.is_castling(review.moves[prev])
+        board = review.seek(ply)
+        if review.ply == prev + 1:
+            animate_move(review.moves[prev], castling)
+        elif review.ply == prev - 1:
+            mv = review.moves[review.ply]
+            p = board.piece_at(mv.from_square)
+            anims.append(Anim(p.piece_type, p.color, corner(mv.to_square), corner(mv.from_square), mv.from_square))
+        else:
+            anims.clear()
+        last = review.moves[review.ply - 1] if review.ply else None
+        outcome = review_info.get("outcome") if review.ply == len(review) else None
+        game_over = outcome is not None
+
+    outcome = None
+    if review is not None:
+        board = review.seek(0)
+    else:
+        resp = send_recv(sock, {"action": "get_board", "table_id": table_id})
+        if resp["status"] != "ok":
+            print(_("Ошибка: нет такой партии!", locale))
+            pygame.quit()
+            return
+        board = chess.Board(resp["data"])
+        outcome = send_recv(sock, {"action": "game_status", "table_id": table_id}).get("data")
+    drag_sq = drag_pos = drag_piece = None
     legal_sqs, capture_sqs = set(), set()
     last = None
     anims = []
     pending = None
     promo = None
+    premoves = []
     game_over = False
+    # Own move waiting for the server; the socket is not used for polls meanwhile.
+    sent = None
+    mover = ThreadPoolExecutor(1)
 
     my_is_white = my_color == "white"
     my_is_black = my_color == "black"
     my_is_player = my_is_white or my_is_black
+    my_side = chess.WHITE if my_is_white else chess.BLACK
 
     POLL_INTERVAL = 0.3
     last_poll = 0
-    pending_fen = None
+    table_info = review_info if review is not None else get_table_info(sock, table_id)
+    info_fetched = time.time()
 
     has_left_table = False
     left_table_time = None
 
-    if board.is_checkmate() or board.is_stalemate():
-        game_over = True
+    game_over = outcome is not None
 
     running = True
     while running:
@@ -281,11 +687,30 @@ def play_game_pygame(
         now = time.time()
 
         for e in pygame.event.get():
+            if review is not None:
+                if e.type == pygame.QUIT or (e.type == pygame.KEYDOWN and e.key == pygame.K_ESCAPE):
+                    running = False
+                    break
+                if e.type == pygame.KEYDOWN:
+                    target = {
+                        pygame.K_RIGHT: review.ply + 1,
+                        pygame.K_LEFT: review.ply - 1,
+                        pygame.K_PAGEDOWN: review.ply + REVIEW_JUMP,
+                        pygame.K_PAGEUP: review.ply - REVIEW_JUMP,
+                        pygame.K_HOME: 0,
+                        pygame.K_END: len(review),
+                    }.get(e.key)
+                    if target is not None:
+                        review_to(target)
+                continue
+
             if e.type == pygame.QUIT or (
                 e.type == pygame.KEYDOWN and e.key == pygame.K_ESCAPE
             ):
                 has_left_table = True
                 left_table_time = time.time()
+                if sent is not None:
+                    settle_move()
                 if quit_callback:
                     quit_callback()
                 break
@@ -306,98 +731,61 @@ def play_game_pygame(
                         push_move = chess.Move(
                             pending.from_square, pending.to_square, promotion=ptype
                         )
-                        board.push(push_move)
-                        last = push_move
                         promo = None
-                        send_move(push_move)
                         pending = None
-                        if board.is_checkmate() or board.is_stalemate():
-                            game_over = True
+                        commit_move(push_move, animate=False)
                 continue
-            if anims:
+            if not my_is_player:
                 continue
-            if my_is_player and (
-                (board.turn and my_is_white) or (not board.turn and my_is_black)
-            ):
-                if e.type == pygame.MOUSEBUTTONDOWN and e.button == 1:
-                    sq = mouse_sq(*e.pos)
-                    if (
-                        sq is not None
-                        and board.piece_at(sq)
-                        and board.piece_at(sq).color == board.turn
-                    ):
-                        drag_sq, drag_pos = sq, e.pos
-                        legal_sqs, capture_sqs = set(), set()
-                        for mv in board.legal_moves:
-                            if mv.from_square == sq:
-                                if board.piece_at(mv.to_square):
-                                    capture_sqs.add(mv.to_square)
-                                elif (
-                                    board.piece_at(sq).piece_type == chess.PAWN
-                                    and board.ep_square is not None
-                                    and mv.to_square == board.ep_square
-                                ):
-                                    capture_sqs.add(mv.to_square)
-                                else:
-                                    legal_sqs.add(mv.to_square)
-
-                elif e.type == pygame.MOUSEMOTION and (drag_sq is not None):
-                    drag_pos = e.pos
-                elif e.type == pygame.MOUSEBUTTONUP and e.button == 1 and (drag_sq is not None):
-                    dst = mouse_sq(*e.pos)
-                    mv = None
-                    for m in board.legal_moves:
-                        if m.from_square == drag_sq and m.to_square == dst:
-                            mv = m
-                            break
-                    start = (drag_pos[0] - SQ // 2, drag_pos[1] - SQ // 2)
-                    tgt = (
-                        (sq_center(dst)[0] - SQ // 2, sq_center(dst)[1] - SQ // 2)
-                        if mv
-                        else (
-                            sq_center(drag_sq)[0] - SQ // 2,
-                            sq_center(drag_sq)[1] - SQ // 2,
-                        )
-                    )
-                    anims.append(
-                        Anim(
-                            board.piece_at(drag_sq).piece_type,
-                            board.turn,
-                            start,
-                            tgt,
-                            drag_sq,
-                        )
+            my_turn = board.turn == my_side
+            if e.type == pygame.MOUSEBUTTONDOWN and e.button == 3:
+                premoves.clear()
+            elif e.type == pygame.MOUSEBUTTONDOWN and e.button == 1:
+                sq = mouse_sq(*e.pos)
+                src = board if my_turn else premove_board(board, my_side, premoves)
+                piece = src.piece_at(sq) if sq is not None else None
+                if piece and piece.color == my_side:
+                    drag_sq, drag_pos, drag_piece = sq, e.pos, piece
+                    legal_sqs, capture_sqs = targets(
+                        src, sq, src.legal_moves if my_turn else src.pseudo_legal_moves
                     )
-                    if mv and board.is_castling(mv):
-                        rf, rt = (
-                            (7, 5) if chess.square_file(mv.to_square) == 6 else (0, 3)
-                        )
-                        rf, rt = chess.square(
-                            rf, chess.square_rank(mv.to_square)
-                        ), chess.square(rt, chess.square_rank(mv.to_square))
-                        rs, rtg = sq_center(rf), sq_center(rt)
-                        rook = board.piece_at(rf)
+
+            elif e.type == pygame.MOUSEMOTION and (drag_sq is not None):
+                drag_pos = e.pos
+            elif e.type == pygame.MOUSEBUTTONUP and e.button == 1 and (drag_sq is not None):
+                dst = mouse_sq(*e.pos)
+                start = (drag_pos[0] - SQ // 2, drag_pos[1] - SQ // 2)
+                if not my_turn:
+                    pb = premove_board(board, my_side, premoves)
+                    mv = find_move(pb.pseudo_legal_moves, drag_sq, dst)
+                    if mv:
+                        premoves.append(mv)
+                else:
+                    mv = find_move(board.legal_moves, drag_sq, dst)
+                    if mv and not mv.promotion:
+                        commit_move(mv, start)
+                    else:
                         anims.append(
                             Anim(
-                                rook.piece_type,
-                                rook.color,
-                                (rs[0] - SQ // 2, rs[1] - SQ // 2),
-                                (rtg[0] - SQ // 2, rtg[1] - SQ // 2),
-                                rf,
+                                drag_piece.piece_type,
+                                drag_piece.color,
+                                start,
+                                corner(dst if mv else drag_sq),
+                                drag_sq,
                             )
                         )
-                    pending = mv
-                    drag_sq = drag_pos = None
-                    legal_sqs.clear()
-                    capture_sqs.clear()
+                        pending = mv
+                drag_sq = drag_pos = drag_piece = None
+                legal_sqs.clear()
+                capture_sqs.clear()
 
         if has_left_table:
             screen.fill((0, 0, 0))
-            text = font_big.render(_("Вы покинули стол", locale), True, (255, 255, 255))
+            text = TEXT_CACHE.text(font_big, "Вы покинули стол", (255, 255, 255), locale)
             rect = text.get_rect(center=(SQ * 4, TOP_MARGIN + SQ * 4))
             screen.blit(text, rect)
-            msg = font_small.render(
-                _("Для продолжения вернитесь в терминал", locale), True, (200, 200, 200)
+            msg = TEXT_CACHE.text(
+                font_small, "Для продолжения вернитесь в терминал", (200, 200, 200), locale
             )
             rect2 = msg.get_rect(center=(SQ * 4, TOP_MARGIN + SQ * 4 + 70))
             screen.blit(msg, rect2)
@@ -406,53 +794,37 @@ def play_game_pygame(
                 running = False
             continue
 
+        if sent is not None and sent[1].done():
+            settle_move()
         if anims:
             if all(a.tick() for a in anims):
                 anims.clear()
                 if pending:
-                    if board.piece_at(
-                        pending.from_square
-                    ).piece_type == chess.PAWN and chess.square_rank(
-                        pending.to_square
-                    ) in (
-                        0,
-                        7,
-                    ):
-                        promo = PromoMenu(board.turn, pending.to_square)
-                    else:
-                        board.push(pending)
-                        last = pending
-                        send_move(pending)
-                        pending = None
-                        if board.is_checkmate() or board.is_stalemate():
-                            game_over = True
-                if pending_fen:
-                    board.set_fen(pending_fen)
-                    pending_fen = None
-                    if board.is_checkmate() or board.is_stalemate():
-                        game_over = True
-        elif promo and pending:
+                    promo = PromoMenu(board.turn, pending.to_square)
+        if (promo and pending) or review is not None or sent is not None:
             pass
-        else:
-            if time.time() - last_poll > POLL_INTERVAL:
-                resp = send_recv(sock, {"action": "get_board", "table_id": table_id})
-                if resp.get("status") != "ok" or resp.get("data") is None:
-                    screen.fill((0, 0, 0))
-                    text = font_big.render("Партия завершена", True, (255, 255, 255))
-                    rect = text.get_rect(center=(SQ * 4, TOP_MARGIN + SQ * 4))
-                    screen.blit(text, rect)
-                    msg = font_small.render(
-                        _("Стол был автоматически удален.", locale), True, (200, 200, 200)
-                    )
-                    rect2 = msg.get_rect(center=(SQ * 4, TOP_MARGIN + SQ * 4 + 70))
-                    screen.blit(msg, rect2)
-                    pygame.display.flip()
-                    pygame.time.wait(2000)
-                    running = False
-                    break
+        elif time.time() - last_poll > POLL_INTERVAL:
+            resp = send_recv(sock, {"action": "get_board", "table_id": table_id})
+            if resp.get("limited"):
+                # Keep the board and ask again next poll.
+                pass
+            elif resp.get("status") != "ok" or resp.get("data") is None:
+                screen.fill((0, 0, 0))
+                text = font_big.render("Партия завершена", True, (255, 255, 255))
+                rect = text.get_rect(center=(SQ * 4, TOP_MARGIN + SQ * 4))
+                screen.blit(text, rect)
+                msg = font_small.render(
+                    _("Стол был автоматически удален.", locale), True, (200, 200, 200)
+                )
+                rect2 = msg.get_rect(center=(SQ * 4, TOP_MARGIN + SQ * 4 + 70))
+                screen.blit(msg, rect2)
+                pygame.display.flip()
+                pygame.time.wait(2000)
+                running = False
+                break
+            else:
                 new_fen = resp["data"]
                 if new_fen != board.fen():
-                    new_board = chess.Board(new_fen)
                     move = None
                     for mv in board.legal_moves:
                         test_board = board.copy()
@@ -461,45 +833,23 @@ def play_game_pygame(
                             move = mv
                             break
                     if move:
-                        s, t = sq_center(move.from_square), sq_center(move.to_square)
-                        anims.append(
-                            Anim(
-                                board.piece_at(move.from_square).piece_type,
-                                board.turn,
-                                (s[0] - SQ // 2, s[1] - SQ // 2),
-                                (t[0] - SQ // 2, t[1] - SQ // 2),
-                                move.from_square,
-                            )
-                        )
-                        if board.is_castling(move):
-                            rf, rt = (
-                                (7, 5)
-                                if chess.square_file(move.to_square) == 6
-                                else (0, 3)
-                            )
-                            rf, rt = chess.square(
-                                rf, chess.square_rank(move.to_square)
-                            ), chess.square(rt, chess.square_rank(move.to_square))
-                            rs, rtg = sq_center(rf), sq_center(rt)
-                            rook = board.piece_at(rf)
-                            anims.append(
-                                Anim(
-                                    rook.piece_type,
-                                    rook.color,
-                                    (rs[0] - SQ // 2, rs[1] - SQ // 2),
-                                    (rtg[0] - SQ // 2, rtg[1] - SQ // 2),
-                                    rf,
-                                )
-                            )
-                        pending = None
-                        pending_fen = new_fen
+                        castling = board.is_castling(move)
+                        board.push(move)
+                        animate_move(move, castling)
                         last = move
                     else:
                         board.set_fen(new_fen)
-                        pending_fen = None
-                        if board.is_checkmate() or board.is_stalemate():
-                            game_over = True
-                last_poll = time.time()
+                        last = None
+                    status = send_recv(sock, {"action": "game_status", "table_id": table_id})
+                    if status["status"] == "ok":
+                        outcome = status["data"]
+                        game_over = outcome is not None
+                    play_premove()
+            if now - info_fetched > TABLE_INFO_INTERVAL:
+                # Names change rarely; the whole lobby is never fetched here.
+                table_info = get_table_info(sock, table_id) or table_info
+                info_fetched = now
+            last_poll = time.time()
 
         screen.fill((255, 255, 255))
         for r in range(8):
@@ -524,6 +874,11 @@ def play_game_pygame(
                 f, r = chess.square_file(s), chess.square_rank(s)
                 draw_r = r if flip_board else 7 - r
                 screen.blit(S_CAP, (f * SQ, draw_r * SQ + TOP_MARGIN))
+            for mv in premoves:
+                for s in (mv.from_square, mv.to_square):
+                    f, r = chess.square_file(s), chess.square_rank(s)
+                    draw_r = r if flip_board else 7 - r
+                    screen.blit(S_PRE, (f * SQ, draw_r * SQ + TOP_MARGIN))
             if board.is_check():
                 k = board.king(board.turn)
                 f, r = chess.square_file(k), chess.square_rank(k)
@@ -561,7 +916,7 @@ def play_game_pygame(
         for a in anims:
             screen.blit(SPR[(a.col, a.ptype)], a.pos)
         if (drag_sq is not None) and drag_pos:
-            p = board.piece_at(drag_sq)
+            p = drag_piece
             screen.blit(
                 SPR[(p.color, p.piece_type)],
                 (drag_pos[0] - SQ // 2, drag_pos[1] - SQ // 2),
@@ -569,28 +924,32 @@ def play_game_pygame(
         if promo:
             promo.draw()
         if game_over:
-            mask = pygame.Surface((SQ * 8, SQ * 8), pygame.SRCALPHA)
-            mask.fill(MASK_MATE if board.is_checkmate() else MASK_PATT)
+            decisive = outcome["result"] in ("1-0", "0-1")
+            mask = TEXT_CACHE.overlay((SQ * 8, SQ * 8), MASK_MATE if decisive else MASK_PATT)
             screen.blit(mask, (0, TOP_MARGIN))
-            if board.is_checkmate():
-                winner = _("Чёрные", locale) if board.turn else _("Белые", locale)
-                txt = _("Мат. {winner} победили", locale).format(winner=winner)
+            if decisive:
+                winner = _("Белые", locale) if outcome["result"] == "1-0" else _("Чёрные", locale)
+                img = TEXT_CACHE.text(
+                    font,
+                    "Мат. {winner} победили" if outcome["reason"] == "checkmate" else "{winner} победили",
+                    (255, 255, 255),
+                    locale,
+                    winner=winner,
+                )
             else:
-                txt = _("Пат. Ничья", locale)
-            img = font.render(txt, True, (255, 255, 255))
+                img = TEXT_CACHE.text(font, DRAW_TEXT.get(outcome["reason"], "Ничья"), (255, 255, 255), locale)
             rect = img.get_rect(center=(SQ * 4, TOP_MARGIN + SQ * 4))
             screen.blit(img, rect)
-        table_info = get_table_info(sock, table_id)
         draw_labels(table_info)
         pygame.display.flip()
 
     if has_left_table:
         screen.fill((0, 0, 0))
-        text = font_big.render(_("Вы покинули стол", locale), True, (255, 255, 255))
+        text = TEXT_CACHE.text(font_big, "Вы покинули стол", (255, 255, 255), locale)
         rect = text.get_rect(center=(SQ * 4, TOP_MARGIN + SQ * 4))
         screen.blit(text, rect)
-        msg = font_small.render(
-            _("Для продолжения вернитесь в терминал", locale), True, (200, 200, 200)
+        msg = TEXT_CACHE.text(
+            font_small, "Для продолжения вернитесь в терминал", (200, 200, 200), locale
         )
         rect2 = msg.get_rect(center=(SQ * 4, TOP_MARGIN + SQ * 4 + 70))
         screen.blit(msg, rect2)
@@ -598,6 +957,7 @@ def play_game_pygame(
         if left_table_time and time.time() - left_table_time > 1:
             running = False
 
+    mover.shutdown()
     pygame.display.quit()
     pygame.quit()
     return
@@ -615,12 +975,16 @@ class ChessCmd(cmd.Cmd):
         if sock:
             self.sock = sock
         else:
-            self.sock = socket.create_connection((SERVER, PORT))
+            self.sock = Connection((SERVER, PORT))
         self.username = username
         resp = send_recv(self.sock, {"action": "register", "name": self.username})
         if resp["status"] != "ok":
             print(_("Ошибка регистрации: {msg}", self.locale).format(msg=resp["msg"]))
             sys.exit(1)
+        if isinstance(self.sock, Connection):
+            self.sock.token = resp["data"]["token"]
+            self.sock.on_resume = self.on_resume
+            self.sock.negotiate()
         self.current_table = None
         self.current_color = None
         self.playing = False
@@ -629,30 +993,48 @@ class ChessCmd(cmd.Cmd):
         self.polling_thread = None
         self.polling_stop = threading.Event()
         self.game_start_request = threading.Event()
+        self.opponent_joined = threading.Event()
+        self.listening = threading.Event()
+        self.listener_sock = None
+        self.table_ids = TableIdCache()
+        self.last_game = None
+
+    def on_resume(self, data):
+        """Restore seat after reconnect."""
+        self.current_table, self.current_color = data["table_id"], data["color"]
+        if self.current_table is None:
+            print(_("Соединение восстановлено.", self.locale))
+            return
+        print(
+            _("Соединение восстановлено: стол {table}, вы играете {color}, ходов: {ply}.", self.locale).format(
+                table=self.current_table, color=self.current_color, ply=data["ply"]
+            )
+        )
+        if not self.playing:
+            self.start_table_watcher()
 
     def wait_for_opponent_and_start(self):
         """Wait for second player."""
         print(_("Ожидание второго игрока...", self.locale))
-        while True:
-            resp = send_recv(self.sock, {"action": "list_tables"})
-            for t in resp["data"]:
-                if t["id"] == self.current_table and t["white"] and t["black"]:
-                    print("Партия стартует!")
-                    flip = self.current_color == "black"
-                    play_game_pygame(
-                        self.current_table,
-                        self.sock,
-                        my_color=self.current_color,
-                        flip_board=flip,
-                        quit_callback=self.on_leave,
-                        username=self.username,
-                        locale=self.locale
-                    )
-                    self.playing = False
-                    self.current_table = None
-                    self.current_color = None
-                    return
-            time.sleep(1)
+        if not (self.polling_thread and self.polling_thread.is_alive()):
+            self.start_table_watcher()
+        self.opponent_joined.wait()
+        if self.current_table is None:
+            return
+        print("Партия стартует!")
+        flip = self.current_color == "black"
+        play_game_pygame(
+            self.current_table,
+            self.sock,
+            my_color=self.current_color,
+            flip_board=flip,
+            quit_callback=self.on_leave,
+            username=self.username,
+            locale=self.locale
+        )
+        self.playing = False
+        self.current_table = None
+        self.current_color = None
 
     def do_switchlocale(self, arg):
         """Change locale ru or en."""
@@ -660,19 +1042,25 @@ class ChessCmd(cmd.Cmd):
             self.locale = "en_US.UTF-8"
         else:
             self.locale = "ru_RU.UTF-8"
+        TEXT_CACHE.clear()
 
     def do_createtable(self, arg):
         """Создать новый стол для игры.
-        Использование: createtable [as white|black]
+        Использование: createtable [as white|black] [bot]
         Если цвет не указан, выбирается случайным образом.
+        С bot вторым игроком за стол садится движок.
         Можно создать только один стол одновременно (до leave).
         """
         if self.current_table is not None:
             print(_("Сначала покиньте текущий стол (leave), чтобы создать новый.", self.locale))
             return
         args = shlex.split(arg)
+        req = {"action": "createtable"}
+        if args and args[-1].lower() == "bot":
+            req["bot"] = True
+            args = args[:-1]
         if not args:
-            resp = send_recv(self.sock, {"action": "createtable"})
+            resp = send_recv(self.sock, req)
             print(resp["msg"])
             if resp["status"] == "ok":
                 self.current_table = resp["data"]["table_id"]
@@ -682,7 +1070,8 @@ class ChessCmd(cmd.Cmd):
                 self.start_table_watcher()
         elif len(args) == 2 and args[0].lower() == "as" and args[1] in ("white", "black"):
             color = args[1]
-            resp = send_recv(self.sock, {"action": "createtable", "color": color})
+            req["color"] = color
+            resp = send_recv(self.sock, req)
             print(resp["msg"])
             if resp["status"] == "ok":
                 self.current_table = resp["data"]["table_id"]
@@ -691,7 +1080,7 @@ class ChessCmd(cmd.Cmd):
                 print(_("Ждём соперника... Когда он появится, вы получите уведомление.", self.locale))
                 self.start_table_watcher()
         else:
-            print(_("Используйте: createtable или createtable as white|black", self.locale))
+            print(_("Используйте: createtable [as white|black] [bot]", self.locale))
 
     def complete_createtable(self, text, line, begidx, endidx):
         """Complete createtable command."""
@@ -700,6 +1089,8 @@ class ChessCmd(cmd.Cmd):
             return ["as"] if "as".startswith(text) else []
         if len(parts) == 2:
             return [c for c in ["white", "black"] if c.startswith(text)]
+        if len(parts) == 3:
+            return ["bot"] if "bot".startswith(text) else []
         return []
 
     def do_list(self, arg):
@@ -707,6 +1098,9 @@ class ChessCmd(cmd.Cmd):
         Использование: list
         """
         resp = send_recv(self.sock, {"action": "list_tables"})
+        if resp["status"] != "ok":
+            print(resp["msg"])
+            return
         for t in resp["data"]:
             print(
                 f"Table {t['id']} | White: {t['white']} | Black: {t['black']} | InGame: {t['in_game']}"
@@ -758,10 +1152,49 @@ class ChessCmd(cmd.Cmd):
                 print(_("Ждём соперника... Когда он появится, вы получите уведомление.", self.locale))
                 self.start_table_watcher()
 
+    def do_seek(self, arg):
+        """Найти соперника близкого рейтинга и сесть с ним за новый стол.
+        Использование: seek [контроль]
+        Контроль времени в виде минуты+добавление, по умолчанию 5+0.
+        """
+        if self.current_table is not None:
+            print(
+                _("Сначала покиньте текущий стол (leave), чтобы присоединиться к другому.", self.locale)
+            )
+            return
+        args = shlex.split(arg)
+        req = {"action": "seek"}
+        if args:
+            req["time_control"] = args[0]
+        # The pairing may come later as a lobby event, so listen first.
+        self.start_table_watcher()
+        self.listening.wait(LISTEN_TIMEOUT)
+        print(_("Ищем соперника...", self.locale))
+        resp = send_recv(self.sock, req)
+        print(resp["msg"])
+        if resp["status"] != "ok":
+            self.stop_table_watcher()
+        elif resp["data"]:
+            self.on_match(resp["data"])
+
+    def on_match(self, data):
+        """Take seat found by matchmaking and watch its table."""
+        self.current_table = data["table_id"]
+        self.current_color = data["color"]
+        print(
+            _("Соперник {opponent} ({rating}), стол {table}, вы играете {color}.", self.locale).format(
+                opponent=data["opponent"],
+                rating=data["opponent_rating"],
+                table=self.current_table,
+                color=self.current_color,
+            )
+        )
+        self.start_table_watcher()
+
     def on_leave(self):
         """Quit table."""
         if self.current_table is not None:
-            send_recv(
+            resp = send_recv(
                 self.sock,
                 {
                     "action": "leave",
@@ -770,50 +1203,94 @@ class ChessCmd(cmd.Cmd):
                     "user": self.username,
                 },
             )
+            if resp.get("data") and resp["data"].get("game_id") is not None:
+                self.last_game = resp["data"]["game_id"]
             self.current_table = None
             self.current_color = None
             self.playing = False
-            if hasattr(self, "polling_stop"):
-                self.polling_stop.set()
+            self.stop_table_watcher()
             print(_("Вы покинули стол.", self.locale))
 
     def start_table_watcher(self):
         """Start watching game of somebody."""
         import threading
 
-        if (
-            hasattr(self, "polling_thread")
-            and self.polling_thread
-            and self.polling_thread.is_alive()
-        ):
-            self.polling_stop.set()
-            self.polling_thread.join()
+        self.stop_table_watcher()
         self.polling_stop = threading.Event()
         self.game_start_request.clear()
+        self.opponent_joined.clear()
+        self.listening.clear()
         self.polling_thread = threading.Thread(target=self.table_watcher, daemon=True)
         self.polling_thread.start()
 
+    def stop_table_watcher(self):
+        """Stop lobby events listener."""
+        self.polling_stop.set()
+        if self.listener_sock is not None:
+            try:
+                self.listener_sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.listener_sock.close()
+            self.listener_sock = None
+        self.opponent_joined.set()
+
     def table_watcher(self):
-        """Get recponses for game of somebody."""
-        import time
-
-        notified = False
-        while (
-            not self.polling_stop.is_set()
-            and self.current_table
-            and self.current_color
-            and not notified
-        ):
-            resp = send_recv(self.sock, {"action": "list_tables"})
-            for t in resp["data"]:
-                if t["id"] == self.current_table and t["white"] and t["black"]:
-                    other = t["white"] if self.current_color == "black" else t["black"]
-                    if other and other != self.username:
-                        print(_("Игрок {name} готов с вами сыграть! Введите команду play для старта партии.", self.locale).format(name=other))
-                        print(self.prompt, end="", flush=True)
-                        notified = True
-                        return
-            time.sleep(1)
+        """Get lobby events for current table pushed by server."""
+        tid = self.current_table
+        sock = None
+        try:
+            sock = connect(self.sock.getpeername()[:2])
+            self.listener_sock = sock
+            resp = send_recv(
+                sock, {"action": "subscribe", "user": self.username, "table_id": tid}
+            )
+            self.listening.set()
+            t = resp["data"]
+            if t and t["white"] and t["black"]:
+                other = t["white"] if self.current_color == "black" else t["black"]
+                self.on_lobby_event({"event": "joined", "table_id": tid, "user": other})
+            while not self.polling_stop.is_set():
+                self.on_lobby_event(recv_frame(sock))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if sock is not None:
+                sock.close()
+
+    def on_lobby_event(self, ev):
+        """Report lobby event about current table or matchmaking."""
+        if ev["event"] == "matched" and self.current_table is None:
+            self.on_match(ev)
+        elif ev["event"] == "unmatched":
+            print(_("Соперник не найден.", self.locale))
+            self.stop_table_watcher()
+        elif ev["table_id"] != self.current_table or ev["user"] == self.username:
+            return
+        elif ev["event"] == "joined":
+            print(_("Игрок {name} готов с вами сыграть! Введите команду play для старта партии.", self.locale).format(name=ev["user"]))
+            self.opponent_joined.set()
+        elif ev["event"] == "ready":
+            print(_("Игрок {name} ждёт вас за доской.", self.locale).format(name=ev["user"]))
+        elif ev["event"] == "left":
+            print(_("Игрок {name} покинул стол.", self.locale).format(name=ev["user"]))
+            self.opponent_joined.clear()
+        elif ev["event"] == "result":
+            print(
+                _("Партия за столом {table} окончена: {result}. Номер в архиве: {game}.", self.locale).format(
+                    table=ev["table_id"], result=ev["result"], game=ev["game_id"]
+                )
+            )
+            self.last_game = ev["game_id"]
+        elif ev["event"] == "deleted":
+            print(_("Стол {table} удалён.", self.locale).format(table=ev["table_id"]))
+            self.current_table = None
+            self.current_color = None
+            self.opponent_joined.set()
+        else:
+            return
+        if not self.playing:
+            print(self.prompt, end="", flush=True)
 
     def do_play(self, arg):
         """Начать игру, если оба игрока присоединились к столу и готовы.
@@ -823,34 +1300,274 @@ class ChessCmd(cmd.Cmd):
         if self.current_table is None or self.current_color is None:
             print(_("Нет активного стола. Сначала создайте или присоединитесь.", self.locale))
             return
-        resp = send_recv(self.sock, {"action": "list_tables"})
-        for t in resp["data"]:
-            if t["id"] == self.current_table and t["white"] and t["black"]:
-                send_recv(
-                    self.sock,
-                    {
-                        "action": "ready_play",
-                        "table_id": self.current_table,
-                        "user": self.username,
-                    },
-                )
-                flip = self.current_color == "black"
-                self.playing = True
-                play_game_pygame(
-                    self.current_table,
-                    self.sock,
-                    my_color=self.current_color,
-                    flip_board=flip,
-                    quit_callback=self.on_leave,
-                    username=self.username,
-                    locale=self.locale
-                )
-                self.playing = False
-                self.current_table = None
-                self.current_color = None
-                return
+        t = get_table_info(self.sock, self.current_table)
+        if t is not None and t["white"] and t["black"]:
+            send_recv(
+                self.sock,
+                {
+                    "action": "ready_play",
+                    "table_id": self.current_table,
+                    "user": self.username,
+                },
+            )
+            flip = self.current_color == "black"
+            self.playing = True
+            play_game_pygame(
+                self.current_table,
+                self.sock,
+                my_color=self.current_color,
+                flip_board=flip,
+                quit_callback=self.on_leave,
+                username=self.username,
+                locale=self.locale
+            )
+            self.playing = False
+            self.current_table = None
+            self.current_color = None
+            return
         print(_("Соперник еще не подключился! Ждите оповещения.", self.locale))
 
+    def do_analyze(self, arg):
+        """Оценить позицию на столе движком сервера.
+        Использование: analyze [id] [секунды]
+        Без id анализируется текущий стол.
+        """
+        args = shlex.split(arg)
+        try:
+            tid = int(args[0]) if args else self.current_table
+            movetime = float(args[1]) if len(args) > 1 else None
+        except ValueError:
+            print(_("Некорректный номер стола", self.locale))
+            return
+        if tid is None:
+            print(_("Укажите номер стола", self.locale))
+            return
+        resp = send_recv(self.sock, {"action": "analyze", "table_id": tid, "movetime": movetime})
+        if resp["status"] != "ok":
+            print(resp["msg"])
+            return
+        res = resp["data"]
+        print(
+            _("Лучший ход: {move}, оценка: {score:+.2f}, глубина: {depth}, узлов: {nodes}", self.locale).format(
+                move=res["move"], score=res["score"] / 100, depth=res["depth"], nodes=res["nodes"]
+            )
+        )
+
+    def do_book(self, arg):
+        """Показать ходы дебютной книги для позиции на столе.
+        Использование: book [id]
+        Без id используется текущий стол.
+        """
+        args = shlex.split(arg)
+        try:
+            tid = int(args[0]) if args else self.current_table
+        except ValueError:
+            print(_("Некорректный номер стола", self.locale))
+            return
+        if tid is None:
+            print(_("Укажите номер стола", self.locale))
+            return
+        resp = send_recv(self.sock, {"action": "book_moves", "table_id": tid})
+        if resp["status"] != "ok":
+            print(resp["msg"])
+        elif not resp["data"]:
+            print(_("Позиции нет в дебютной книге.", self.locale))
+        for entry in resp["data"] or []:
+            print(f"{entry['move']}: {entry['weight']}")
+
+    def do_explore(self, arg):
+        """Статистика архивных партий из позиции на столе.
+        Использование: explore [id]
+        Без id используется текущий стол.
+        """
+        args = shlex.split(arg)
+        try:
+            tid = int(args[0]) if args else self.current_table
+        except ValueError:
+            print(_("Некорректный номер стола", self.locale))
+            return
+        if tid is None:
+            print(_("Укажите номер стола", self.locale))
+            return
+        resp = send_recv(self.sock, {"action": "position_stats", "table_id": tid})
+        if resp["status"] != "ok":
+            print(resp["msg"])
+            return
+        stats = resp["data"]
+        if not stats["games"]:
+            print(_("Позиция не встречалась в архиве.", self.locale))
+            return
+        score = 100 * (stats["white"] + stats["draws"] / 2) / stats["games"]
+        print(
+            _("Партий: {games}, белые набрали {score:.1f}%", self.locale).format(
+                games=stats["games"], score=score
+            )
+        )
+        for m in stats["moves"]:
+            print(f"{m['move']}: {m['games']} (+{m['white']} ={m['draws']} -{m['black']})")
+
+    def do_tournament(self, arg):
+        """Запустить турнир ботов на сервере.
+        Использование: tournament <игроков> [rr|swiss] [туров] [random|engine]
+        Партии играются на сервере и попадают в архив.
+        Нужен токен администратора в переменной CHESSCLUB_ADMIN_TOKEN.
+        """
+        args = shlex.split(arg)
+        try:
+            players = int(args[0])
+            rounds = int(args[2]) if len(args) > 2 else None
+        except (IndexError, ValueError):
+            print(_("Используйте: tournament <игроков> [rr|swiss] [туров] [random|engine]", self.locale))
+            return
+        system = "swiss" if len(args) > 1 and args[1] == "swiss" else "round-robin"
+        kind = args[3] if len(args) > 3 else "random"
+        resp = send_recv(
+            self.sock,
+            {
+                "action": "tournament", "players": players, "system": system, "rounds": rounds, "kind": kind,
+                "admin_token": os.environ.get(ADMIN_ENV),
+            },
+        )
+        print(resp["msg"])
+
+    def do_standings(self, arg):
+        """Показать таблицу турнира.
+        Использование: standings <id>
+        """
+        args = shlex.split(arg)
+        try:
+            tid = int(args[0])
+        except (IndexError, ValueError):
+            print(_("Используйте: standings <id>", self.locale))
+            return
+        resp = send_recv(self.sock, {"action": "standings", "tournament_id": tid})
+        if resp["status"] != "ok":
+            print(resp["msg"])
+            return
+        data = resp["data"]
+        state = _("завершён", self.locale) if data["finished"] else _("идёт", self.locale)
+        print(
+            _("Турнир {id} ({state}): {games} партий, {rate:.1f} партий/с", self.locale).format(
+                id=data["id"], state=state, games=data["games"], rate=data["games_per_sec"]
+            )
+        )
+        for place, row in enumerate(data["standings"], 1):
+            print(f"{place:3d}. {row['name']:16s} {row['points']:5.1f}  {row['buchholz']:6.1f}  {row['games']}")
+
+    def do_export(self, arg):
+        """Выгрузить завершённые партии из архива сервера в PGN-файл.
+        Использование: export <файл> [player=<имя>] [since=ГГГГ-ММ-ДД] [until=ГГГГ-ММ-ДД]
+        Партии передаются частями и сразу пишутся в файл.
+        """
+        args = shlex.split(arg)
+        if not args:
+            print(_("Используйте: export <файл> [player=<имя>] [since=ГГГГ-ММ-ДД] [until=ГГГГ-ММ-ДД]", self.locale))
+            return
+        req = {"action": "export_games"}
+        try:
+            for opt in args[1:]:
+                key, _sep, value = opt.partition("=")
+                if key == "player":
+                    req["player"] = value
+                elif key in ("since", "until"):
+                    req[key] = time.mktime(time.strptime(value, "%Y-%m-%d"))
+                else:
+                    raise ValueError(opt)
+        except ValueError:
+            print(_("Некорректный параметр выгрузки", self.locale))
+            return
+        size = 0
+        try:
+            with open(args[0], "w", encoding="utf-8") as f:
+                for chunk in send_stream(self.sock, req):
+                    f.write(chunk)
+                    size += len(chunk)
+        except RuntimeError as e:
+            print(e)
+            return
+        except OSError as e:
+            print(_("Не удалось записать файл: {err}", self.locale).format(err=e))
+            return
+        print(_("Записано {size} символов PGN в {path}", self.locale).format(size=size, path=args[0]))
+
+    def do_lagstats(self, arg):
+        """Показать задержки по ходам стола или гистограммы всего сервера.
+        Использование: lagstats [id]
+        Для каждого хода: время на обдумывание, время обработки сервером и время приёма-передачи клиента, мс.
+        Нужен токен администратора в переменной CHESSCLUB_ADMIN_TOKEN.
+        """
+        args = shlex.split(arg)
+        req = {"action": "lagstats", "admin_token": os.environ.get(ADMIN_ENV)}
+        if args:
+            try:
+                req["table_id"] = int(args[0])
+            except ValueError:
+                print(_("Некорректный номер стола", self.locale))
+                return
+        resp = send_recv(self.sock, req)
+        if resp["status"] != "ok":
+            print(resp["msg"])
+            return
+
+        def ms(value):
+            # NaN marks a timing the server could not know.
+            return "-" if value != value else f"{value:.1f}"
+
+        data = resp["data"]
+        if args:
+            print(_("Стол {id}: {white} - {black}", self.locale).format(
+                id=data["table_id"], white=data["white"], black=data["black"]
+            ))
+            print(_("  ход   обдумывание     сервер    клиент", self.locale))
+            for ply, think, server, rtt in data["rows"]:
+                print(f"{ply:5d} {ms(think):>13s} {ms(server):>10s} {ms(rtt):>9s}")
+            return
+        for kind in ("think", "server", "rtt"):
+            h = data[kind]
+            print(_("{kind}: {count} ходов, среднее {mean:.1f} мс, p50 <= {p50} мс, p99 <= {p99} мс", self.locale).format(
+                kind=kind, count=h["count"], mean=h["mean_ms"], p50=h["p50_ms"], p99=h["p99_ms"]
+            ))
+            peak = max(h["counts"]) or 1
+            for bound, n in zip([*h["bounds_ms"], None], h["counts"]):
+                label = f"<= {bound}" if bound is not None else f"> {h['bounds_ms'][-1]}"
+                print(f"  {label:>9s} {n:8d} {'#' * round(40 * n / peak)}".rstrip())
+
+    def do_review(self, arg):
+        """Просмотреть завершённую партию из архива сервера.
+        Использование: review [номер партии]
+        Без номера открывается последняя сыгранная партия. Стрелки влево/вправо — ход назад/вперёд,
+        PageUp/PageDown — на 10 ходов, Home/End — начало/конец партии, Esc — выход.
+        """
+        args = shlex.split(arg)
+        try:
+            gid = int(args[0]) if args else self.last_game
+        except ValueError:
+            print(_("Некорректный номер партии", self.locale))
+            return
+        if gid is None:
+            print(_("Укажите номер партии", self.locale))
+            return
+        resp = send_recv(self.sock, {"action": "game", "game_id": gid})
+        if resp["status"] != "ok":
+            print(resp["msg"])
+            return
+        g = resp["data"]
+        replay = Replay([chess.Move.from_uci(uci) for uci in g["moves"]], g["start"])
+        print(
+            _("Партия {id}: {white} - {black}, {result}, ходов: {plies}", self.locale).format(
+                id=gid, white=g["white"], black=g["black"], result=g["result"], plies=len(replay)
+            )
+        )
+        play_game_pygame(
+            gid, self.sock, username=None, locale=self.locale, review=replay,
+            review_info={
+                "white": g["white"],
+                "black": g["black"],
+                "active_players": [g["white"], g["black"]],
+                "outcome": {"result": g["result"], "reason": None} if g["result"] != "*" else None,
+            },
+        )
+
     def do_leave(self, arg):
         """Покинуть текущий стол (выйти из партии/лобби).
         Использование: leave
@@ -871,9 +1588,11 @@ class ChessCmd(cmd.Cmd):
         except ValueError:
             print(_("Некорректный номер стола", self.locale))
             return
-        resp = send_recv(self.sock, {"action": "list_tables"})
-        table_exists = any(t["id"] == table_id for t in resp["data"])
-        if not table_exists:
+        resp = send_recv(self.sock, {"action": "table_info", "table_id": table_id})
+        if resp.get("limited"):
+            print(resp["msg"])
+            return
+        if resp["status"] != "ok":
             print(_("Нет такого стола", self.locale))
             return
         play_game_pygame(
@@ -891,9 +1610,7 @@ class ChessCmd(cmd.Cmd):
 
     def complete_join(self, text, line, begidx, endidx):
         """Complete join command."""
-        resp = send_recv(self.sock, {"action": "list_tables"})
-        ids = [str(t["id"]) for t in resp["data"]]
-        return [i for i in ids if i.startswith(text)]
+        return self.table_ids.complete(self.sock, text)
 
     def complete_create(self, text, line, begidx, endidx):
         """Complete create command."""
@@ -901,9 +1618,7 @@ class ChessCmd(cmd.Cmd):
 
     def complete_view(self, text, line, begidx, endidx):
         """Complete view command."""
-        resp = send_recv(self.sock, {"action": "list_tables"})
-        ids = [str(t["id"]) for t in resp["data"]]
-        return [i for i in ids if i.startswith(text)]
+        return self.table_ids.complete(self.sock, text)
 
 
 def run():
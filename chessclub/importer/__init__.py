@@ -0,0 +1,3 @@
+"""Initialization file."""
+
+from .__main__ import *
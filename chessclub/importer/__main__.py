@@ -0,0 +1,174 @@
+"""Bulk import of PGN files into the game archive."""
+
+import argparse
+import io
+import os
+import sys
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import chess
+import chess.pgn
+
+from chessclub.server.archive import GameArchive, encode_move
+from chessclub.server.stats import OpeningIndex
+
+CHUNK_GAMES = 500
+
+
+class GameRecord(chess.pgn.BaseVisitor):
+    """PGN visitor that keeps only what the archive stores."""
+
+    def begin_game(self):
+        """Start new game."""
+        self.headers = {}
+        self.codes = array("H")
+        self.error = None
+
+    def visit_header(self, tagname, tagvalue):
+        """Remember header."""
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        """Skip side lines."""
+        return chess.pgn.SKIP
+
+    def visit_move(self, board, move):
+        """Record main line move."""
+        self.codes.append(encode_move(move))
+
+    def handle_error(self, error):
+        """Mark game as broken instead of raising."""
+        self.error = error
+
+    def result(self):
+        """Return visitor itself."""
+        return self
+
+
+def pgn_date(value):
+    """Timestamp of PGN date or 0 when unknown."""
+    try:
+        return time.mktime(time.strptime(value.replace("??", "01"), "%Y.%m.%d"))
+    except (ValueError, OverflowError, AttributeError):
+        return 0.0
+
+
+def split_games(lines, chunk_games=CHUNK_GAMES):
+    """Group PGN lines into text chunks of whole games."""
+    chunk, games, in_moves = [], 0, False
+    for line in lines:
+        if line.startswith("["):
+            if in_moves:
+                games += 1
+                in_moves = False
+                if games >= chunk_games:
+                    yield "".join(chunk)
+                    chunk, games = [], 0
+        elif line.strip():
+            in_moves = True
+        chunk.append(line)
+    if chunk:
+        yield "".join(chunk)
+
+
+def parse_chunk(text):
+    """Parse chunk of PGN in worker, return (games, rejected)."""
+    handle, games, rejected = io.StringIO(text), [], 0
+    while True:
+        try:
+            rec = chess.pgn.read_game(handle, Visitor=GameRecord)
+        except (ValueError, KeyError):
+            rejected += 1
+            continue
+        if rec is None:
+            return games, rejected
+        h = rec.headers
+        fen = h.get("FEN", chess.STARTING_FEN)
+        if rec.error is not None or not rec.codes:
+            rejected += 1
+            continue
+        games.append(
+            (h.get("White"), h.get("Black"), h.get("Result", "*"), rec.codes, fen, pgn_date(h.get("Date")))
+        )
+
+
+def import_pgn(path, archive, workers=None, chunk_games=CHUNK_GAMES, progress=None):
+    """Import PGN file into archive, return (games, rejected, seconds).
+
+    At most two chunks per worker are in flight, so memory does not grow
+    with file size; results are written in file order.
+    """
+    started = time.monotonic()
+    imported = rejected = 0
+    workers = workers or os.cpu_count() or 1
+    with open(path, encoding="utf-8", errors="replace") as f, ProcessPoolExecutor(workers) as executor:
+        limit = 2 * workers
+        running = deque()
+
+        def write(fut):
+            nonlocal imported, rejected
+            games, bad = fut.result()
+            if games:
+                archive.extend(games)
+            imported += len(games)
+            rejected += bad
+            if progress is not None:
+                progress(imported, rejected, time.monotonic() - started)
+
+        for text in split_games(f, chunk_games):
+            running.append(executor.submit(parse_chunk, text))
+            if len(running) >= limit:
+                write(running.popleft())
+        while running:
+            write(running.popleft())
+    return imported, rejected, time.monotonic() - started
+
+
+def show_progress(imported, rejected, elapsed):
+    """Print import progress on one line."""
+    rate = imported / elapsed if elapsed else 0
+    print(
+        f"\r{imported} games, {rejected} rejected, {rate:.0f} games/sec",
+        end="", file=sys.stderr, flush=True,
+    )
+
+
+def parse_args(argv=None):
+    """Parse importer command line."""
+    parser = argparse.ArgumentParser(prog="chimport", description="Import PGN into Chess Club archive")
+    parser.add_argument("pgn", help="PGN file")
+    parser.add_argument("--archive", required=True, help="archive directory of chserver")
+    parser.add_argument("--workers", type=int, default=None, help="parser processes (default: CPU count)")
+    parser.add_argument("--chunk", type=int, default=CHUNK_GAMES, help="games per parser task")
+    parser.add_argument("--stats", default=None, help="rebuild opening statistics index after import")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Import PGN file."""
+    args = parse_args(argv)
+    # Existing games stay on disk; new ones are written without being kept.
+    archive = GameArchive(args.archive, append_only=True)
+    imported, rejected, elapsed = import_pgn(
+        args.pgn, archive, args.workers, args.chunk, show_progress
+    )
+    print(file=sys.stderr)
+    rate = imported / elapsed if elapsed else 0
+    print(f"Imported {imported} games ({rejected} rejected) in {elapsed:.1f}s, {rate:.0f} games/sec")
+    if args.stats:
+        index = OpeningIndex(args.stats)
+        index.rebuild(GameArchive(args.archive), args.workers)
+        print(f"Statistics index: {len(index)} records")
+        index.close()
+
+
+def run():
+    """Run application."""
+    main()
+
+
+if __name__ == "__main__":
+    run()
@@ -1,245 +1,1295 @@
 """Server for chess."""
 
+import argparse
 import asyncio
+import heapq
+import hmac
+import os
 import pickle
+import random
+import secrets
+import time
+from array import array
+from collections import deque
 import chess
+import chess.polyglot
+
+from chessclub.protocol.compression import COMPRESSED, THRESHOLD, negotiate, pack, unpack
+
+from .archive import GameArchive, decode_move, encode_move
+from .book import OpeningBook
+from .cache import PositionCache
+from .cluster import Cluster, UnixBus, serve_hub
+from .engine import EnginePool
+from .handoff import listen, send_state, take_over
+from .matchmaking import DEFAULT_RATING, DEFAULT_TIME_CONTROL, Matchmaker, elo
+from .net import BACKLOG, LOOPS, listen_socket, loop_factory, run_on, tune_socket
+from .profiling import PROFILE_ENV, Profiler
+from .ratelimit import RateLimiter
+from .stats import OpeningIndex
+from .telemetry import LagLog, Telemetry
+from .tournament import KINDS, MAX_PLAYERS, MAX_ROUNDS, Tournament
 
 HOST = "0.0.0.0"
 PORT = 5555
+LOBBY_LOG_SIZE = 1024
+BOT_NAME = "Engine"
+BOT_MOVETIME = 0.5
+EXPORT_CHUNK = 64 * 1024
+SEEK_TIMEOUT = 60.0
+SESSION_GRACE = 30.0
+ADMIN_ENV = "CHESSCLUB_ADMIN_TOKEN"
+SWEEP_INTERVAL = 1.0
+SCORES = {"1-0": 1.0, "1/2-1/2": 0.5, "0-1": 0.0}
+# Draws the server declares without a claim: fivefold repetition and the
+# 75-move rule; threefold repetition and 50 moves would need a claim.
+REPETITIONS = 5
+SEVENTY_FIVE_MOVES = 150
+# Position of every table before its first move; must never be pushed to.
+START_BOARD = chess.Board()
+# Action name -> coroutine method of ChessServer, filled by @action.
+HANDLERS = {}
+
+
+def action(name):
+    """Register ChessServer method as handler of client action."""
+
+    def register(method):
+        HANDLERS[name] = method
+        return method
+
+    return register
 
 
 class Player:
-    """Class with player name."""
+    """Class with player name, rating and session."""
 
-    def __init__(self, name):
+    __slots__ = ("name", "rating", "token", "conn", "expiry")
+
+    def __init__(self, name, rating=DEFAULT_RATING, token=None, conn=None):
         """Init class."""
         self.name = name
+        self.rating = rating
+        self.token = token
+        self.conn = conn
+        self.expiry = None
 
 
 class Table:
-    """Class with chess table info."""
+    """Class with chess table info.
+
+    Tables without moves read START_BOARD; after the first move the table
+    owns a board without move stack and keeps history as 16-bit codes.
+    Instead of the stack, repetitions are counted by Zobrist hash of the
+    positions since the last capture or pawn move.
+    """
 
-    def __init__(self, tid, white=None, black=None):
+    __slots__ = (
+        "id", "white", "black", "bot", "spectators", "active_players", "players", "moves", "_board",
+        "time_control", "lag", "seen", "result", "bots_only",
+    )
+
+    def __init__(self, tid, white=None, black=None, bot=None, time_control=None, bots_only=False):
         """Init class."""
         self.id = tid
         self.white = white
         self.black = black
-        self.board = chess.Board()
+        self.bot = bot
+        self.bots_only = bots_only
+        self.time_control = time_control
         self.spectators = []
         self.active_players = set()
+        self.players = (white, black)
+        self.moves = array("H")
+        self._board = None
+        self.lag = None
+        self.seen = None
+        self.result = None
+
+    @property
+    def position(self):
+        """Current position for reading only."""
+        return START_BOARD if self._board is None else self._board
+
+    @property
+    def board(self):
+        """Own board of table, created on first access."""
+        if self._board is None:
+            self._board = chess.Board()
+        return self._board
+
+    def push(self, mv):
+        """Make move remembering who played it for the archive."""
+        self.players = (self.white or self.players[0], self.black or self.players[1])
+        board = self.board
+        if self.seen is None:
+            self.seen = {chess.polyglot.zobrist_hash(board): 1}
+        if board.is_zeroing(mv):
+            # Positions before a capture or pawn move cannot occur again.
+            self.seen.clear()
+        board.push(mv)
+        board.clear_stack()
+        self.moves.append(encode_move(mv))
+        key = chess.polyglot.zobrist_hash(board)
+        self.seen[key] = self.seen.get(key, 0) + 1
+
+    def repetitions(self):
+        """How many times the current position has occurred."""
+        if self.seen is None:
+            return 1
+        return self.seen.get(chess.polyglot.zobrist_hash(self.position), 0)
+
+    def history(self):
+        """Moves made at table."""
+        return [decode_move(code) for code in self.moves]
+
+
+class Connection:
+    """Per-connection state handlers share."""
+
+    __slots__ = (
+        "writer", "user", "listener", "watching", "buckets", "codec", "received", "upstreams", "seek",
+    )
+
+    def __init__(self, writer, buckets=None):
+        """Init class."""
+        self.writer = writer
+        self.user = None
+        self.listener = None
+        self.watching = None
+        self.buckets = buckets
+        self.codec = None
+        self.received = None
+        self.upstreams = None
+        self.seek = None
+
+
+def frame_bytes(obj, codec=None, threshold=THRESHOLD):
+    """Length-prefixed pickle frame as bytes."""
+    return pack(pickle.dumps(obj), codec, threshold)
+
+
+def write_frame(writer, obj, codec=None, threshold=THRESHOLD):
+    """Write length-prefixed pickle frame, compressed if codec is given."""
+    writer.write(frame_bytes(obj, codec, threshold))
+
+
+# "limited" tells clients to retry later instead of treating the request as failed.
+LIMITED_FRAME = frame_bytes(
+    {"status": "err", "msg": "SERVER:: Too many requests, slow down", "data": None, "limited": True}
+)
 
 
 class ChessServer:
     """Class for handling interaction between players and table management."""
 
-    def __init__(self):
+    def __init__(
+        self, engine=None, cache=None, book=None, archive=None, stats=None, grace=SESSION_GRACE,
+        limiter=None, compress_threshold=THRESHOLD,
+    ):
         """Init class."""
+        self.grace = grace
+        self.sessions = {}
+        self.conns = set()
+        self._engine = engine
+        self.cache = cache or PositionCache()
+        self.book = book
+        self.archive = archive if archive is not None else GameArchive()
+        self.stats = stats
+        self.stats_merge = None
+        self.tasks = set()
         self.users = {}
         self.tables = {}
         self.table_id_seq = 1
         self.lock = asyncio.Lock()
+        self.subscribers = {}
+        self.lobby_version = 0
+        self.lobby_log = deque(maxlen=LOBBY_LOG_SIZE)
+        self.matchmaker = Matchmaker()
+        self.seek_deadlines = []
+        self.sweeper = None
+        self.handing_over = False
+        self.tournaments = {}
+        self.profiler = None
+        self.admin_token = None
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.compress_threshold = compress_threshold
+        self.telemetry = Telemetry()
+        self.cluster = None
+
+    def lobby_changed(self, tid, added, local=True):
+        """Record table creation or removal in versioned lobby log."""
+        self.lobby_version += 1
+        self.lobby_log.append((self.lobby_version, tid, added))
+        if local and self.cluster is not None:
+            self.cluster.table_changed(tid)
+
+    def admin(self, cmd, resp):
+        """Check admin token of request, answer error if it is missing or wrong."""
+        token = cmd.get("admin_token")
+        if self.admin_token and isinstance(token, str) and hmac.compare_digest(token, self.admin_token):
+            return True
+        resp["status"] = "err"
+        resp["msg"] = "SERVER:: Admin only"
+        return False
+
+    def table_info(self, t):
+        """Lobby entry of table."""
+        return {
+            "id": t.id,
+            "white": t.white,
+            "black": t.black,
+            "in_game": t.white is not None and t.black is not None,
+            "active_players": list(t.active_players),
+        }
+
+    def archive_table(self, t):
+        """Store game of table that is being removed, return its archive id."""
+        if t.result is not None:
+            return t.result["game_id"]
+        if t.moves:
+            # Every decided game is archived by finish(); this one was abandoned.
+            return self.record_game(*t.players, "*", t.moves, lag=t.lag)
+        return None
+
+    def record_game(self, white, black, result, moves, start=chess.STARTING_FEN, lag=None):
+        """Put finished game to archive and statistics index."""
+        gid = self.archive.add(white, black, result, moves, start, time.time())
+        if lag is not None and len(lag):
+            self.archive.add_lag(gid, lag.rows())
+        if self.stats is not None and self.stats.add_game(*self.archive.raw(gid)):
+            self.flush_stats()
+        return gid
+
+    def flush_stats(self):
+        """Start merging statistics kept in memory into index file unless a merge runs."""
+        if self.stats_merge is None or self.stats_merge.done():
+            self.stats_merge = self.spawn(self.merge_stats())
+
+    async def merge_stats(self):
+        """Merge statistics kept in memory into index file in a worker thread."""
+        counts = self.stats.detach()
+        if counts is not None:
+            self.stats.install(await asyncio.to_thread(self.stats.merge, counts))
+
+    async def save_stats(self):
+        """Wait for running merge, then merge the rest of statistics."""
+        if self.stats_merge is not None:
+            await self.stats_merge
+        await self.merge_stats()
+
+    def decide(self, t):
+        """Result and reason if the last move at table ended the game, else None."""
+        board = t.position
+        status = self.cache.status(board)
+        if status == "checkmate":
+            return ("0-1" if board.turn == chess.WHITE else "1-0"), status
+        if status is not None:
+            return "1/2-1/2", status
+        if board.halfmove_clock >= SEVENTY_FIVE_MOVES:
+            return "1/2-1/2", "seventyfive_moves"
+        if t.repetitions() >= REPETITIONS:
+            return "1/2-1/2", "fivefold_repetition"
+        return None
+
+    def finish(self, t):
+        """Freeze table whose game just ended, archive it and push the result."""
+        decided = self.decide(t)
+        if decided is None:
+            return None
+        result, reason = decided
+        self.rate_game(t, result)
+        gid = self.record_game(*t.players, result, t.moves, lag=t.lag)
+        t.result = {"result": result, "reason": reason, "game_id": gid}
+        self.notify(t, "result", None, **t.result)
+        return t.result
+
+    @property
+    def engine(self):
+        """Engine worker pool, started on first use."""
+        if self._engine is None:
+            self._engine = EnginePool()
+        return self._engine
+
+    def spawn(self, coro):
+        """Run background task keeping reference to it, None during handoff."""
+        if self.handing_over:
+            coro.close()
+            return None
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def new_table_id(self):
+        """Smallest free table id."""
+        tid = 1
+        while tid in self.tables or (self.cluster is not None and not self.cluster.free(tid)):
+            tid += 1
+        return tid
+
+    def drop_session(self, player):
+        """Detach player from its connection and start grace period."""
+        player.conn = None
+        if player.expiry is not None:
+            player.expiry.cancel()
+        player.expiry = self.spawn(self.expire_session(player))
+
+    async def expire_session(self, player):
+        """Forget player who did not resume within grace period."""
+        await asyncio.sleep(self.grace)
+        async with self.lock:
+            player.expiry = None
+            if player.conn is None and self.users.get(player.name) is player:
+                del self.users[player.name]
+                self.sessions.pop(player.token, None)
+                if self.cluster is not None and player.name in self.cluster.local:
+                    self.cluster.user_changed(player.name, gone=True)
+
+    def resync(self, name, ply=0):
+        """Seat of player and moves made at its table since ply."""
+        for t in self.tables.values():
+            if name in (t.white, t.black):
+                return {
+                    "user": name,
+                    "table_id": t.id,
+                    "color": "white" if t.white == name else "black",
+                    "white": t.white,
+                    "black": t.black,
+                    "fen": t.position.fen(),
+                    "ply": len(t.moves),
+                    "moves": [decode_move(code).uci() for code in t.moves[ply:]],
+                }
+        return {"user": name, "table_id": None, "color": None}
+
+    def table_state(self, t):
+        """Table as plain data for another server process."""
+        return (
+            t.id, t.white, t.black, t.bot, t.time_control, t.players, t.moves.tobytes(),
+            t.lag.rows() if t.lag is not None else None, t.result,
+        )
+
+    def restore_table(self, state):
+        """Recreate table from table_state and return it."""
+        tid, white, black, bot, time_control, players, moves, *rest = state
+        t = Table(tid, white, black, bot, time_control)
+        codes = array("H")
+        codes.frombytes(moves)
+        for code in codes:
+            t.push(decode_move(code))
+        t.players = players
+        if rest and rest[0] is not None:
+            t.lag = LagLog.from_rows(rest[0])
+        if len(rest) > 1:
+            t.result = rest[1]
+        self.tables[tid] = t
+        if bot:
+            t.active_players.add(BOT_NAME)
+            self.spawn(self.bot_move(tid))
+        return t
+
+    def snapshot(self):
+        """Tables and sessions as plain data for the next server process."""
+        return {
+            "tables": [self.table_state(t) for t in self.tables.values()],
+            "users": [(p.name, p.rating, p.token) for p in self.users.values()],
+            "lobby_version": self.lobby_version,
+        }
+
+    def restore(self, state):
+        """Load snapshot; its players have the grace period to resume."""
+        for table in state["tables"]:
+            self.restore_table(table)
+        for name, rating, token in state["users"]:
+            player = self.users[name] = Player(name, rating, token)
+            self.sessions[token] = name
+            self.drop_session(player)
+        self.lobby_version = state["lobby_version"]
+
+    async def stop_tasks(self):
+        """Cancel background tasks and wait for them; a running index merge may finish."""
+        current = asyncio.current_task()
+        tasks = [t for t in self.tasks if t is not current and t is not self.stats_merge]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.sweeper = None
+
+    def restart_tasks(self):
+        """Start background work again after a handoff that did not happen."""
+        for tid, t in self.tables.items():
+            if t.bot:
+                self.spawn(self.bot_move(tid))
+        for player in self.users.values():
+            if player.conn is None:
+                self.drop_session(player)
+        if self.matchmaker.seeks:
+            self.sweeper = self.spawn(self.matchmaking())
+        if self.cluster is not None:
+            self.cluster.listener = self.spawn(self.cluster.listen())
+
+    async def hand_over(self, ctl, srv, stopped):
+        """Give listening socket and state to the process that connects to ctl.
+
+        Bot moves, tournaments and session expiries are stopped first and
+        no new ones start, since they would change tables, archive and
+        index behind the snapshot; tournaments close their tables under
+        the lock, so they are awaited before taking it. The lock is then
+        held from snapshot until clients are disconnected, so no request
+        changes state the new process does not know about; clients then
+        resume their sessions on the new process. From then on the old
+        process leaves the archive and index files to the new one.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            conn, _addr = await loop.sock_accept(ctl)
+            with conn:
+                self.handing_over = True
+                await self.stop_tasks()
+                async with self.lock:
+                    if self.stats is not None:
+                        await self.save_stats()
+                    try:
+                        done = await send_state(
+                            conn, [s.fileno() for s in srv.sockets], self.snapshot()
+                        )
+                    except OSError:
+                        done = False
+                    if not done:
+                        self.handing_over = False
+                        self.restart_tasks()
+                        continue
+                    self.archive.read_only = True
+                    if self.stats is not None:
+                        self.stats.read_only = True
+                    srv.close()
+                    for writer in list(self.conns):
+                        writer.close()
+            ctl.close()
+            stopped.set()
+            return
+
+    def open_table(self, white, black, **kwargs):
+        """Create table with both seats taken, return its id."""
+        tid = self.new_table_id()
+        self.tables[tid] = Table(tid, white, black, **kwargs)
+        self.lobby_changed(tid, True)
+        return tid
+
+    def close_table(self, tid):
+        """Remove table from lobby."""
+        del self.tables[tid]
+        self.lobby_changed(tid, False)
+
+    def push(self, name, event):
+        """Send event to lobby listener of user if there is one."""
+        writer = self.subscribers.get(name)
+        if writer is not None:
+            write_frame(writer, event)
+
+    def start_match(self, a, b, requester=None):
+        """Seat two matched seeks at a new table.
+
+        Both players get a "matched" event except the requester, whose
+        seek request is still waiting for its reply; the pairing of the
+        requester is returned.
+        """
+        if random.random() < 0.5:
+            a, b = b, a
+        tid = self.open_table(a.name, b.name, time_control=a.time_control)
+        pairing = None
+        for s, color, opponent in ((a, "white", b), (b, "black", a)):
+            data = {
+                "table_id": tid,
+                "color": color,
+                "opponent": opponent.name,
+                "opponent_rating": round(opponent.rating),
+                "time_control": s.time_control,
+            }
+            if s.name == requester:
+                pairing = data
+            else:
+                self.push(s.name, {"event": "matched", "user": opponent.name, **data})
+        return pairing
+
+    def expire_seeks(self, now):
+        """Drop seeks past their deadline and tell their players."""
+        deadlines = self.seek_deadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, _, s = heapq.heappop(deadlines)
+            if self.matchmaker.cancel(s.name, s) is not None:
+                self.push(s.name, {"event": "unmatched", "table_id": None, "user": None})
+
+    async def matchmaking(self):
+        """Pair waiting seeks as their rating windows widen, drop expired ones."""
+        while self.matchmaker.seeks:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            async with self.lock:
+                for a, b in self.matchmaker.sweep():
+                    self.start_match(a, b)
+                self.expire_seeks(time.monotonic())
+        self.seek_deadlines.clear()
+        self.sweeper = None
+
+    def rate_game(self, t, result):
+        """Update Elo of both players still online after rated game."""
+        white, black = (self.users.get(name) for name in t.players)
+        if t.bot or result not in SCORES or white is None or black is None:
+            return
+        score = SCORES[result]
+        white.rating, black.rating = (
+            elo(white.rating, black.rating, score),
+            elo(black.rating, white.rating, 1 - score),
+        )
+        if self.cluster is not None:
+            for player in (white, black):
+                self.cluster.rated(player.name, player.rating)
+
+    async def bot_move(self, tid):
+        """Let engine answer on bot table if it is its turn."""
+        async with self.lock:
+            t = self.tables.get(tid)
+            if (
+                t is None
+                or t.bot is None
+                or t.result is not None
+                or t.position.turn != (t.bot == "white")
+            ):
+                return
+            if self.book is not None:
+                mv = self.book.choose(t.position)
+                if mv is not None:
+                    t.push(mv)
+                    self.telemetry.moved(t, time.monotonic())
+                    self.finish(t)
+                    return
+            fen = t.position.fen()
+            key = self.cache.key(t.position, "eval")
+        result = await self.evaluate(tid, fen, key, movetime=BOT_MOVETIME)
+        async with self.lock:
+            t = self.tables.get(tid)
+            if t is not None and t.result is None and result["move"] and t.position.fen() == fen:
+                t.push(chess.Move.from_uci(result["move"]))
+                self.telemetry.moved(t, time.monotonic())
+                self.finish(t)
+
+    async def evaluate(self, tid, fen, key, movetime=None, nodes=None):
+        """Engine analysis shared between tables through position cache."""
+        movetime, nodes = self.engine.budget(movetime, nodes)
+        cached = self.cache.lookup(key)
+        if cached is not None and cached["budget"] >= (movetime, nodes):
+            return cached
+        result = await self.engine.submit(tid, fen, movetime, nodes)
+        if result["move"]:
+            self.cache.store(key, dict(result, budget=(movetime, nodes)))
+        return result
+
+    def notify(self, t, event, actor, **data):
+        """Push lobby event to players and watchers of table except actor."""
+        if self.cluster is not None and t.id in self.tables:
+            self.cluster.table_changed(t.id)
+        for name in {t.white, t.black, *t.spectators}:
+            if name and name != actor and name in self.subscribers:
+                write_frame(
+                    self.subscribers[name],
+                    {"event": event, "table_id": t.id, "user": actor, **data},
+                )
 
     async def handle(self, reader, writer):
         """Handle requests from clients."""
-        user = None
+        limiter = self.limiter
+        conn = Connection(writer, limiter.buckets() if limiter is not None else None)
+        self.conns.add(writer)
         try:
             while True:
-                data_len_bytes = await reader.readexactly(4)
-                data_len = int.from_bytes(data_len_bytes, "big")
-                data = await reader.readexactly(data_len)
-                cmd = pickle.loads(data)
-                resp = {"status": "ok", "msg": None, "data": None}
-
-                if cmd["action"] == "register":
-                    name = cmd["name"]
-                    async with self.lock:
-                        if name in self.users:
-                            resp["status"] = "err"
-                            resp["msg"] = "SERVER:: Name taken"
-                        else:
-                            self.users[name] = Player(name)
-                            resp["msg"] = f"SERVER:: Welcome, {name}"
-                            user = name
-
-                elif cmd["action"] == "ready_play":
-                    tid = cmd["table_id"]
-                    user = cmd["user"]
-                    async with self.lock:
-                        if tid not in self.tables:
-                            resp["status"] = "err"
-                            resp["msg"] = "SERVER:: No such table"
-                        else:
-                            t = self.tables[tid]
-                            t.active_players.add(user)
-                            resp["msg"] = f"SERVER:: {user} is ready"
-
-                elif cmd["action"] == "createtable":
-                    color = cmd.get("color", None)
-                    async with self.lock:
-                        existing_ids = set(self.tables.keys())
-                        tid = 1
-                        while tid in existing_ids:
-                            tid += 1
-                        table = Table(tid)
-                        import random
-
-                        if color is None:
-                            color = random.choice(["white", "black"])
-                        if color == "white":
-                            table.white = user
-                        elif color == "black":
-                            table.black = user
-                        self.tables[tid] = table
-                        resp["data"] = {"table_id": tid, "color": color}
-                        resp["msg"] = (
-                            f"SERVER:: Table {tid} created, you play as {color}, waiting for second player"
+                header = int.from_bytes(await reader.readexactly(4), "big")
+                data = await reader.readexactly(header & ~COMPRESSED)
+                conn.received = time.monotonic()
+                cmd = pickle.loads(unpack(header, data, conn.codec))
+                handler = HANDLERS.get(cmd["action"])
+                if limiter is not None and not limiter.allow(
+                    conn.buckets, cmd["action"] if handler is not None else "unknown"
+                ):
+                    writer.write(LIMITED_FRAME)
+                    await writer.drain()
+                    await asyncio.sleep(0)
+                    continue
+                node = self.cluster.route(conn, cmd) if self.cluster is not None else None
+                if node is not None:
+                    # The owner answers through the connection's upstream.
+                    if not await self.cluster.forward(conn, node, cmd):
+                        write_frame(
+                            writer, {"status": "err", "msg": "SERVER:: Table node unavailable", "data": None}
                         )
-
-                elif cmd["action"] == "list_tables":
-                    async with self.lock:
-                        tables = [
-                            {
-                                "id": t.id,
-                                "white": t.white,
-                                "black": t.black,
-                                "in_game": (
-                                    t.white is not None and t.black is not None
-                                ),
-                                "active_players": (
-                                    list(t.active_players)
-                                    if hasattr(t, "active_players")
-                                    else []
-                                ),
-                            }
-                            for t in self.tables.values()
-                        ]
-                        resp["data"] = tables
-
-                elif cmd["action"] == "join":
-                    tid = cmd.get("table_id", None)
-                    async with self.lock:
-                        if tid is None:
-                            found = False
-                            for t in self.tables.values():
-                                if not (t.white and t.black):
-                                    found = True
-                                    if not t.white:
-                                        t.white = user
-                                        color = "white"
-                                    else:
-                                        t.black = user
-                                        color = "black"
-                                    resp["data"] = {"table_id": t.id, "color": color}
-                                    resp["msg"] = (
-                                        f"SERVER:: Fastjoined to table {t.id} as {color}"
-                                    )
-                                    break
-                            if not found:
-                                resp["status"] = "err"
-                                resp["msg"] = "SERVER:: No available tables. Create one!"
-                        else:
-                            if tid not in self.tables:
-                                resp["status"] = "err"
-                                resp["msg"] = "SERVER:: No such table"
-                            else:
-                                t = self.tables[tid]
-                                color = None
-                                if not t.white:
-                                    t.white = user
-                                    color = "white"
-                                elif not t.black:
-                                    t.black = user
-                                    color = "black"
-                                else:
-                                    resp["status"] = "err"
-                                    resp["msg"] = "SERVER:: Both seats are taken"
-                                    color = None
-                                if color:
-                                    resp["msg"] = f"SERVER:: You joined table {tid} as {color}"
-                                    resp["data"] = {"color": color}
-
-                elif cmd["action"] == "move":
-                    tid, uci = cmd["table_id"], cmd["uci"]
-                    async with self.lock:
-                        if tid not in self.tables:
-                            resp["status"] = "err"
-                            resp["msg"] = "SERVER:: No such table"
-                        else:
-                            t = self.tables[tid]
-                            mv = chess.Move.from_uci(uci)
-                            if mv in t.board.legal_moves:
-                                t.board.push(mv)
-                                resp["msg"] = "SERVER:: Move accepted"
-                            else:
-                                resp["status"] = "err"
-                                resp["msg"] = "SERVER:: Illegal move"
-
-                elif cmd["action"] == "get_board":
-                    tid = cmd["table_id"]
-                    async with self.lock:
-                        if tid not in self.tables:
-                            resp["status"] = "err"
-                            resp["msg"] = "SERVER:: No such table"
-                        else:
-                            t = self.tables[tid]
-                            resp["data"] = t.board.fen()
-
-                elif cmd["action"] == "view":
-                    tid = cmd["table_id"]
-                    async with self.lock:
-                        if tid not in self.tables:
-                            resp["status"] = "err"
-                            resp["msg"] = "SERVER:: No such table"
-                        else:
-                            t = self.tables[tid]
-                            resp["data"] = t.board.fen()
-                elif cmd["action"] == "leave":
-                    tid, color, user = cmd["table_id"], cmd["color"], cmd["user"]
-                    async with self.lock:
-                        if tid in self.tables:
-                            t = self.tables[tid]
-                            if color == "white" and t.white == user:
-                                t.white = None
-                            elif color == "black" and t.black == user:
-                                t.black = None
-                            if t.white is None and t.black is None:
-                                del self.tables[tid]
-                            resp["msg"] = f"{user} left table {tid} ({color})"
-                        else:
-                            resp["status"] = "err"
-                            resp["msg"] = "SERVER:: No such table"
-
-                out_data = pickle.dumps(resp)
-                writer.write(len(out_data).to_bytes(4, "big"))
-                writer.write(out_data)
+                        await writer.drain()
+                    await asyncio.sleep(0)
+                    continue
+                resp = {"status": "ok", "msg": None, "data": None}
+                profiler = self.profiler
+                if handler is None:
+                    resp["status"] = "err"
+                    resp["msg"] = "SERVER:: Unknown action"
+                elif profiler is None:
+                    await handler(self, conn, cmd, resp)
+                else:
+                    started = time.perf_counter()
+                    await handler(self, conn, cmd, resp)
+                    profiler.record(cmd["action"], time.perf_counter() - started)
+                write_frame(writer, resp, conn.codec, self.compress_threshold)
                 await writer.drain()
+                # Requests already buffered would run without yielding; go to
+                # the back of the ready queue so connections take turns.
+                await asyncio.sleep(0)
         except (asyncio.IncompleteReadError, ConnectionResetError):
             pass
         finally:
-            if user is not None:
+            self.conns.discard(writer)
+            if conn.upstreams:
+                for up in conn.upstreams.values():
+                    up.close()
+            if conn.user is not None:
+                async with self.lock:
+                    if conn.seek is not None:
+                        self.matchmaker.cancel(conn.user, conn.seek)
+                    player = self.users.get(conn.user)
+                    if player is not None and player.conn is writer:
+                        self.drop_session(player)
+            if conn.listener is not None:
                 async with self.lock:
-                    if user in self.users:
-                        del self.users[user]
+                    if self.subscribers.get(conn.listener) is writer:
+                        del self.subscribers[conn.listener]
+                    if conn.watching in self.tables:
+                        spectators = self.tables[conn.watching].spectators
+                        if conn.listener in spectators:
+                            spectators.remove(conn.listener)
             writer.close()
             await writer.wait_closed()
 
+    @action("register")
+    async def register(self, conn, cmd, resp):
+        """Create player with session token."""
+        name = cmd["name"]
+        async with self.lock:
+            if name in self.users or (self.cluster is not None and self.cluster.taken(name)):
+                resp["status"] = "err"
+                resp["msg"] = "SERVER:: Name taken"
+            else:
+                token = secrets.token_urlsafe(16)
+                self.users[name] = Player(name, token=token, conn=conn.writer)
+                self.sessions[token] = name
+                resp["msg"] = f"SERVER:: Welcome, {name}"
+                resp["data"] = {"token": token, "grace": self.grace}
+                conn.user = name
+                if self.cluster is not None:
+                    self.cluster.user_changed(name)
+
+    @action("attach")
+    async def attach(self, conn, cmd, resp):
+        """Serve player of another cluster node over this connection."""
+        if self.cluster is None or cmd.get("secret") != self.cluster.secret:
+            resp["status"] = "err"
+            resp["msg"] = "SERVER:: Not a cluster node"
+            return
+        async with self.lock:
+            conn.user = name = cmd["user"]
+            if name is not None and name not in self.users:
+                self.users[name] = Player(name, cmd.get("rating") or DEFAULT_RATING, conn=conn.writer)
+
+    @action("resume")
+    async def resume(self, conn, cmd, resp):
+        """Rebind session to new connection and resync seat."""
+        async with self.lock:
+            player = self.users.get(self.sessions.get(cmd.get("token")))
+            if player is None:
+                resp["status"] = "err"
+                resp["msg"] = "SERVER:: Session expired"
+            else:
+                if player.expiry is not None:
+                    # A later drop starts its own grace period.
+                    player.expiry.cancel()
+                    player.expiry = None
+                player.conn = conn.writer
+                conn.user = player.name
+                resp["data"] = self.resync(conn.user, cmd.get("ply") or 0)
+                resp["msg"] = f"SERVER:: Welcome back, {conn.user}"
+
+    @action("subscribe")
+    async def subscribe(self, conn, cmd, resp):
+        """Make connection receive lobby events of table."""
+        tid = cmd.get("table_id", None)
+        async with self.lock:
+            conn.listener = listener = cmd["user"]
+            self.subscribers[listener] = conn.writer
+            if tid in self.tables:
+                t = self.tables[tid]
+                if listener not in (t.white, t.black, *t.spectators):
+                    t.spectators.append(listener)
+                    conn.watching = tid
+                resp["data"] = {
+                    "id": t.id,
+                    "white": t.white,
+                    "black": t.black,
+                    "active_players": list(t.active_players),
+                }
+            resp["msg"] = f"SERVER:: {listener} subscribed"
+
+    @action("ready_play")
+    async def ready_play(self, conn, cmd, resp):
+        """Mark player ready at table."""
+        tid = cmd["table_id"]
+        conn.user = user = cmd["user"]
+        async with self.lock:
+            if tid not in self.tables:
+                resp["status"] = "err"
+                resp["msg"] = "SERVER:: No such table"
+            else:
+                t = self.tables[tid]
+                t.active_players.add(user)
+                self.notify(t, "ready", user)
+                resp["msg"] = f"SERVER:: {user} is ready"
+
+    @action("createtable")
+    async def createtable(self, conn, cmd, resp):
+        """Create table, optionally against engine."""
+        color = cmd.get("color", None)
+        async with self.lock:
+            tid = self.new_table_id()
+            table = Table(tid)
+
+            if color is None:
+                color = random.choice(["white", "black"])
+            if color == "white":
+                table.white = conn.user
+            elif color == "black":
+                table.black = conn.user
+            if cmd.get("bot", False):
+                table.bot = "black" if color == "white" else "white"
+                setattr(table, table.bot, BOT_NAME)
+                table.active_players.add(BOT_NAME)
+                self.spawn(self.bot_move(tid))
+            self.tables[tid] = table
+            self.lobby_changed(tid, True)
+            resp["data"] = {"table_id": tid, "color": color}
+            resp["msg"] = (
+                f"SERVER:: Table {tid} created, you play as {color}, waiting for second player"
+            )
+
+    @action("list_tables")
+    async def list_tables(self, conn, cmd, resp):
+        """Describe all tables."""
+        async with self.lock:
+            if self.cluster is not None:
+                resp["data"] = self.cluster.listing()
+            else:
+                resp["data"] = [self.table_info(t) for t in self.tables.values()]
+
+    @action("table_info")
+    async def get_table_info(self, conn, cmd, resp):
+        """Lobby entry of one table."""
+        async with self.lock:
+            t = self.tables.get(cmd.get("table_id"))
+            if t is None:
+                resp["status"] = "err"
+                resp["msg"] = "SERVER:: No such table"
+            else:
+                resp["data"] = self.table_info(t)
+
+    @action("lobby_ids")
+    async def lobby_ids(self, conn, cmd, resp):
+        """Table ids, or changes since lobby version the client has."""
+        since = cmd.get("since", None)
+        async with self.lock:
+            log = self.lobby_log
+            if since is not None and since <= self.lobby_version and (
+                since == self.lobby_version or (log and log[0][0] <= since + 1)
+            ):
+                resp["data"] = {
+                    "version": self.lobby_version,
+                    "changes": [(tid, added) for v, tid, added in log if v > since],
+                }
+            else:
+                resp["data"] = {
+                    "version": self.lobby_version,
+                    "ids": self.cluster.ids() if self.cluster is not None else list(self.tables),
+                }
+
+    @action("join")
+    async def join(self, conn, cmd, resp):
+        """Take free seat at given table or at any table."""
+        tid = cmd.get("table_id", None)
+        user = conn.user
+        async with self.lock:
+            if tid is None:
+                found = False
+                for t in self.tables.values():
+                    if not (t.white and t.black):
+                        found = True
+                        if not t.white:
+                            t.white = user
+                            color = "white"
+                        else:
+                            t.black = user
+                            color = "black"
+                        resp["data"] = {"table_id": t.id, "color": color}
+                        resp["msg"] = (
+                            f"SERVER:: Fastjoined to table {t.id} as {color}"
+                        )
+                        self.notify(t, "joined", user)
+                        break
+                if not found:
+                    resp["status"] = "err"
+                    resp["msg"] = "SERVER:: No available tables. Create one!"
+            else:
+                if tid not in self.tables:
+                    resp["status"] = "err"
+                    resp["msg"] = "SERVER:: No such table"
+                else:
+                    t = self.tables[tid]
+                    color = None
+                    if not t.white:
+                        t.white = user
+                        color = "white"
+                    elif not t.black:
+                        t.black = user
+                        color = "black"
+                    else:
+                        resp["status"] = "err"
+                        resp["msg"] = "SERVER:: Both seats are taken"
+                        color = None
+                    if color:
+                        resp["msg"] = f"SERVER:: You joined table {tid} as {color}"
+                        resp["data"] = {"table_id": tid, "color": color}
+                        self.notify(t, "joined", user)
+
+    @action("seek")
+    async def seek(self, conn, cmd, resp):
+        """Pair with waiting player or join matchmaking queue.
+
+        A queued player gets the pairing later as "matched" lobby event,
+        or "unmatched" when nobody is found before the timeout.
+        """
+        tc = cmd.get("time_control") or DEFAULT_TIME_CONTROL
+        user = conn.user
+        async with self.lock:
+            player = self.users.get(user)
+            if player is None:
+                resp["status"] = "err"
+                resp["msg"] = "SERVER:: Register first"
+                return
+            timeout = cmd.get("timeout")
+            if not isinstance(timeout, (int, float)) or not 0 < timeout < SEEK_TIMEOUT:
+                timeout = SEEK_TIMEOUT
+            deadline = time.monotonic() + timeout
+            s, opponent = self.matchmaker.seek(user, player.rating, tc, deadline)
+            if opponent is not None:
+                resp["data"] = self.start_match(s, opponent, requester=user)
+                resp["msg"] = (
+                    f"SERVER:: Matched with {resp['data']['opponent']} "
+                    f"at table {resp['data']['table_id']}, you play as {resp['data']['color']}"
+                )
+                return
+            conn.seek = s
+            heapq.heappush(self.seek_deadlines, (deadline, id(s), s))
+            if self.sweeper is None:
+                self.sweeper = self.spawn(self.matchmaking())
+            resp["msg"] = f"SERVER:: Seeking opponent, {tc}"
+
+    @action("move")
+    async def move(self, conn, cmd, resp):
+        """Make move at table."""
+        tid, uci = cmd["table_id"], cmd["uci"]
+        async with self.lock:
+            if tid not in self.tables:
+                resp["status"] = "err"
+                resp["msg"] = "SERVER:: No such table"
+            else:
+                t = self.tables[tid]
+                try:
+                    mv = chess.Move.from_uci(uci)
+                except ValueError:
+                    mv = None
+                if t.result is not None:
+                    resp["status"] = "err"
+                    resp["msg"] = "SERVER:: Game is over"
+                    resp["data"] = t.result
+                elif t.bots_only:
+                    resp["status"] = "err"
+                    resp["msg"] = "SERVER:: Bots play at this table"
+                elif mv is not None and mv in t.position.legal_moves:
+                    t.push(mv)
+                    self.telemetry.record(t, len(t.moves), conn.received, time.monotonic(), cmd.get("rtt"))
+                    resp["msg"] = "SERVER:: Move accepted"
+                    resp["data"] = self.finish(t)
+                    if t.bot and t.result is None:
+                        self.spawn(self.bot_move(tid))
+                else:
+                    resp["status"] = "err"
+                    resp["msg"] = "SERVER:: Illegal move"
+
+    @action("analyze")
+    async def analyze(self, conn, cmd, resp):
+        """Engine evaluation of table position."""
+        tid = cmd["table_id"]
+        async with self.lock:
+            t = self.tables.get(tid)
+            if t is not None:
+                fen, key = t.position.fen(), self.cache.key(t.position, "eval")
+        if t is None:
+            resp["status"] = "err"
+            resp["msg"] = "SERVER:: No such table"
+        else:
+            resp["data"] = await self.evaluate(
+                tid, fen, key, cmd.get("movetime"), cmd.get("nodes")
+            )
+
+    @action("legal_moves")
+    async def legal_moves(self, conn, cmd, resp):
+        """Legal moves at table."""
+        async with self.lock:
+            t = self.tables.get(cmd["table_id"])
+            if t is None:
+                resp["status"] = "err"
+                resp["msg"] = "SERVER:: No such table"
+            else:
+                resp["data"] = list(self.cache.legal_moves(t.position))
+
+    @action("game_status")
+    async def game_status(self, conn, cmd, resp):
+        """Result, reason and archive id of finished game at table, None while it runs."""
+        async with self.lock:
+            t = self.tables.get(cmd["table_id"])
+            if t is None:
+                resp["status"] = "err"
+                resp["msg"] = "SERVER:: No such table"
+            else:
+                resp["data"] = t.result
+
+    @action("book_moves")
+    async def book_moves(self, conn, cmd, resp):
+        """Opening book moves at table."""
+        tid = cmd["table_id"]
+        async with self.lock:
+            if tid not in self.tables:
+                resp["status"] = "err"
+                resp["msg"] = "SERVER:: No such table"
+            elif self.book is None:
+                resp["data"] = []
+            else:
+                resp["data"] = self.book.moves(self.tables[tid].position)
+
+    @action("position_stats")
+    async def position_stats(self, conn, cmd, resp):
+        """Archive statistics of table position."""
+        tid = cmd["table_id"]
+        async with self.lock:
+            if tid not in self.tables:
+                resp["status"] = "err"
+                resp["msg"] = "SERVER:: No such table"
+            elif self.stats is None:
+                resp["status"] = "err"
+                resp["msg"] = "SERVER:: Statistics are disabled"
+            else:
+                resp["data"] = self.stats.lookup(self.tables[tid].position)
+
+    @action("tournament")
+    async def tournament(self, conn, cmd, resp):
+        """Start bot tournament."""
+        if not self.admin(cmd, resp):
+            return
+        players, rounds = cmd.get("players", 8), cmd.get("rounds")
+        if isinstance(players, int) and 2 <= players <= MAX_PLAYERS:
+            players = [f"{BOT_NAME}{i}" for i in range(1, players + 1)]
+        if (
+            not isinstance(players, list)
+            or not all(isinstance(p, str) for p in players)
+            or not 2 <= len(set(players)) == len(players) <= MAX_PLAYERS
+            or not (rounds is None or isinstance(rounds, int) and 1 <= rounds <= MAX_ROUNDS)
+            or cmd.get("system", "round-robin") not in ("round-robin", "swiss")
+            or cmd.get("kind", "random") not in KINDS
+        ):
+            resp["status"] = "err"
+            resp["msg"] = "SERVER:: Bad tournament settings"
+            return
+        # Games queue in the engine pool next to bot moves instead of a pool per tournament.
+        tour = Tournament(
+            self, players, cmd.get("system", "round-robin"), rounds,
+            cmd.get("kind", "random"), self.engine.workers, cmd.get("seed"), self.engine,
+        )
+        self.tournaments[tour.id] = tour
+        self.spawn(tour.run())
+        resp["data"] = {"tournament_id": tour.id}
+        resp["msg"] = f"SERVER:: Tournament {tour.id} started, {len(players)} players"
+
+    @action("standings")
+    async def standings(self, conn, cmd, resp):
+        """Tournament progress and standings."""
+        tour = self.tournaments.get(cmd.get("tournament_id"))
+        if tour is None:
+            resp["status"] = "err"
+            resp["msg"] = "SERVER:: No such tournament"
+        else:
+            resp["data"] = tour.status()
+
+    @action("cache_stats")
+    async def cache_stats(self, conn, cmd, resp):
+        """Position cache counters."""
+        resp["data"] = self.cache.stats()
+
+    @action("profile")
+    async def profile(self, conn, cmd, resp):
+        """Switch profiler on or off and report what it collected."""
+        if not self.admin(cmd, resp):
+            return
+        if cmd.get("enable") and self.profiler is None:
+            self.profiler = Profiler()
+        if self.profiler is None:
+            resp["status"] = "err"
+            resp["msg"] = "SERVER:: Profiler is off"
+            return
+        resp["data"] = self.profiler.report(cmd.get("stacks", True))
+        if cmd.get("reset"):
+            self.profiler.reset()
+        if cmd.get("enable") is False:
+            self.profiler.stop()
+            self.profiler = None
+
+    @action("compress")
+    async def compress(self, conn, cmd, resp):
+        """Agree on codec for large frames; reply says None if there is none."""
+        conn.codec = negotiate(cmd.get("codecs")) if self.compress_threshold is not None else None
+        resp["data"] = {
+            "codec": conn.codec.name if conn.codec is not None else None,
+            "threshold": self.compress_threshold,
+        }
+
+    @action("lagstats")
+    async def lagstats(self, conn, cmd, resp):
+        """Per-ply timings of table, or server-wide histograms without table id."""
+        if not self.admin(cmd, resp):
+            return
+        tid = cmd.get("table_id")
+        if tid is None:
+            resp["data"] = self.telemetry.report()
+            return
+        async with self.lock:
+            t = self.tables.get(tid)
+            if t is None:
+                resp["status"] = "err"
+                resp["msg"] = "SERVER:: No such table"
+            else:
+                resp["data"] = {
+                    "table_id": tid,
+                    "white": t.players[0],
+                    "black": t.players[1],
+                    "rows": t.lag.rows() if t.lag is not None else [],
+                }
+
+    @action("rate_limits")
+    async def rate_limits(self, conn, cmd, resp):
+        """Rate limiter counters."""
+        if self.limiter is None:
+            resp["status"] = "err"
+            resp["msg"] = "SERVER:: Rate limits are off"
+        else:
+            resp["data"] = self.limiter.stats()
+
+    @action("get_board")
+    @action("view")
+    async def get_board(self, conn, cmd, resp):
+        """FEN of table position."""
+        async with self.lock:
+            t = self.tables.get(cmd["table_id"])
+            if t is None:
+                resp["status"] = "err"
+                resp["msg"] = "SERVER:: No such table"
+            else:
+                resp["data"] = t.position.fen()
+
+    @action("leave")
+    async def leave(self, conn, cmd, resp):
+        """Free seat; table is archived and removed when nobody is left."""
+        tid, color, user = cmd["table_id"], cmd["color"], cmd["user"]
+        async with self.lock:
+            if tid in self.tables:
+                t = self.tables[tid]
+                freed = color in ("white", "black") and getattr(t, color) == user
+                if freed:
+                    setattr(t, color, None)
+                self.notify(t, "left", user)
+                if freed and t.bot:
+                    # The engine does not play on alone.
+                    setattr(t, t.bot, None)
+                    t.active_players.discard(BOT_NAME)
+                if t.white is None and t.black is None:
+                    self.notify(t, "deleted", user)
+                    resp["data"] = {"game_id": self.archive_table(t)}
+                    self.close_table(tid)
+                resp["msg"] = f"{user} left table {tid} ({color})"
+            else:
+                resp["status"] = "err"
+                resp["msg"] = "SERVER:: No such table"
+
+    @action("game")
+    async def game(self, conn, cmd, resp):
+        """Moves of archived game for review."""
+        gid = cmd.get("game_id")
+        if not isinstance(gid, int) or not 0 <= gid < len(self.archive):
+            resp["status"] = "err"
+            resp["msg"] = "SERVER:: No such game"
+            return
+        g = self.archive.game(gid)
+        resp["data"] = dict(g, moves=[mv.uci() for mv in g["moves"]], lag=None)
+
+    @action("export_games")
+    async def export_games(self, conn, cmd, resp):
+        """Stream PGN of archived games in several frames."""
+        games = self.archive.export(
+            cmd.get("player"), cmd.get("since"), cmd.get("until"),
+            cmd.get("chunk_size", EXPORT_CHUNK), cmd.get("emt", False),
+        )
+        for chunk in games:
+            write_frame(
+                conn.writer, {"status": "ok", "msg": None, "data": chunk, "more": True},
+                conn.codec, self.compress_threshold,
+            )
+            await conn.writer.drain()
+        resp["more"] = False
+
+
+def parse_args(argv=None):
+    """Parse server command line."""
+    parser = argparse.ArgumentParser(prog="chserver", description="Chess Club server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument(
+        "--engine-workers", type=int, default=None, help="engine processes (default: CPU count)"
+    )
+    parser.add_argument("--uci", default=None, help="path to UCI engine instead of built-in search")
+    parser.add_argument(
+        "--cache-mb", type=int, default=64, help="memory cap of shared position cache"
+    )
+    parser.add_argument("--book", default=None, help="Polyglot opening book (.bin)")
+    parser.add_argument(
+        "--archive", default=None, help="directory of finished games archive (default: memory)"
+    )
+    parser.add_argument("--stats", default=None, help="opening statistics index file")
+    parser.add_argument(
+        "--handoff", default=None, help="unix socket where the next server process takes over"
+    )
+    parser.add_argument(
+        "--takeover", default=None, help="take listening socket and state from --handoff of old server"
+    )
+    parser.add_argument(
+        "--grace", type=float, default=SESSION_GRACE, help="seconds to keep session of dropped client"
+    )
+    parser.add_argument(
+        "--rebuild-stats", action="store_true", help="recount statistics from archive on start"
+    )
+    parser.add_argument(
+        "--loop", choices=LOOPS, default="asyncio", help="event loop (uvloop falls back if missing)"
+    )
+    parser.add_argument(
+        "--no-rate-limit", action="store_true", help="serve requests without per-connection limits"
+    )
+    parser.add_argument(
+        "--compress-threshold", type=int, default=THRESHOLD, help="compress frames from this size on"
+    )
+    parser.add_argument("--no-compress", action="store_true", help="never compress frames")
+    parser.add_argument("--backlog", type=int, default=BACKLOG, help="listen queue length")
+    parser.add_argument("--rcvbuf", type=int, default=None, help="socket receive buffer bytes")
+    parser.add_argument("--sndbuf", type=int, default=None, help="socket send buffer bytes")
+    parser.add_argument("--bus", default=None, help="unix socket of cluster bus; joins the cluster")
+    parser.add_argument("--serve-bus", action="store_true", help="also run the bus hub at --bus")
+    parser.add_argument(
+        "--gateway", action="store_true", help="own no tables, route table requests to other nodes"
+    )
+    parser.add_argument(
+        "--advertise", default=None, help="HOST:PORT other nodes reach this one at (default: --host:--port)"
+    )
+    parser.add_argument(
+        "--admin-token", default=os.environ.get(ADMIN_ENV), help=f"token of admin actions (default: ${ADMIN_ENV})"
+    )
+    return parser.parse_args(argv)
+
+
+def advertised(args):
+    """Address other cluster nodes connect to."""
+    if args.advertise:
+        host, _, port = args.advertise.rpartition(":")
+        return host, int(port)
+    return ("127.0.0.1" if args.host == HOST else args.host), args.port
+
 
-async def main():
+async def main(argv=None, args=None):
     """Run async server."""
-    server = ChessServer()
+    if args is None:
+        args = parse_args(argv)
+    sockets = state = None
+    if args.takeover:
+        # Before opening archive and index: the old process flushes them first.
+        sockets, state = take_over(args.takeover)
+    server = ChessServer(
+        EnginePool(args.engine_workers, args.uci),
+        PositionCache(args.cache_mb * 1024 * 1024),
+        OpeningBook(args.book) if args.book else None,
+        GameArchive(args.archive),
+        OpeningIndex(args.stats) if args.stats else None,
+        args.grace,
+    )
+    server.admin_token = args.admin_token
+    if args.no_rate_limit:
+        server.limiter = None
+    server.compress_threshold = None if args.no_compress else args.compress_threshold
+    if args.rebuild_stats and server.stats is not None:
+        server.stats.rebuild(server.archive, args.engine_workers)
 
     async def handle_conn(reader, writer):
+        tune_socket(writer.get_extra_info("socket"), args.rcvbuf, args.sndbuf)
         await server.handle(reader, writer)
 
-    srv = await asyncio.start_server(handle_conn, HOST, PORT)
-    print(f"SERVER:: Async server listening on {HOST}:{PORT}")
-    async with srv:
-        await srv.serve_forever()
+    if state is not None:
+        server.restore(state)
+        sock = sockets[0]
+        print(f"SERVER:: Took over {sock.getsockname()}, {len(server.tables)} tables")
+    else:
+        sock = listen_socket(args.host, args.port, args.backlog, args.rcvbuf, args.sndbuf)
+        print(f"SERVER:: Async server listening on {args.host}:{args.port} ({args.loop} loop)")
+    srv = await asyncio.start_server(handle_conn, sock=sock, backlog=args.backlog)
+    profile = os.environ.get(PROFILE_ENV)
+    if profile:
+        server.profiler = Profiler()
+    stopped = asyncio.Event()
+    if args.handoff:
+        server.spawn(server.hand_over(listen(args.handoff), srv, stopped))
+    hub = await serve_hub(args.bus) if args.bus and args.serve_bus else None
+    if args.bus:
+        server.cluster = Cluster(server, UnixBus(args.bus), advertised(args), owns=not args.gateway)
+        await server.cluster.start()
+        print(f"SERVER:: Node {server.cluster.id} joined cluster at {args.bus}")
+    try:
+        async with srv:
+            serving = asyncio.create_task(srv.serve_forever())
+            await stopped.wait()
+            serving.cancel()
+    finally:
+        if server.cluster is not None:
+            await server.cluster.leave()
+        if hub is not None:
+            hub.close()
+        if server.profiler is not None:
+            server.profiler.stop()
+            if profile and profile != "1":
+                server.profiler.dump(profile)
+        server.engine.close()
+        if server.stats is not None:
+            await server.save_stats()
+            server.stats.close()
 
 
 def run():
     """Run application."""
-    asyncio.run(main())
+    args = parse_args()
+    run_on(loop_factory(args.loop), main(args=args))
 
 
 if __name__ == "__main__":
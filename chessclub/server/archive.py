@@ -0,0 +1,282 @@
+"""Archive of finished games in compact columns."""
+
+import math
+import os
+import struct
+import time
+from array import array
+
+import chess
+import chess.pgn
+
+RESULTS = ["*", "1-0", "0-1", "1/2-1/2"]
+RESULT_CODES = {r: i for i, r in enumerate(RESULTS)}
+
+COLUMNS = {
+    "offset": "Q",
+    "plies": "H",
+    "white": "I",
+    "black": "I",
+    "result": "B",
+    "start": "I",
+    "date": "d",
+    "moves": "H",
+}
+# Sparse per-ply timings of games played on the server: (game id, rows)
+# header, then rows of (ply, think ms, server ms, rtt ms).
+LAG_HEAD = struct.Struct("<IH")
+LAG_ROW = struct.Struct("<Hfff")
+
+
+def encode_move(mv):
+    """Pack move to 16 bits: from, to and promotion piece."""
+    return mv.from_square | mv.to_square << 6 | (mv.promotion or 0) << 12
+
+
+def decode_move(code):
+    """Unpack move from 16 bits."""
+    return chess.Move(code & 63, code >> 6 & 63, code >> 12 or None)
+
+
+class GameArchive:
+    """Append-only columnar store of finished games.
+
+    Every column is an array; with path set each column is also
+    appended to its own file in that directory and loaded back on start.
+    An append-only archive (for bulk writers such as the importer) reads
+    only the lengths of the column files and the name dictionaries, and
+    writes new games to disk without keeping them; it cannot be read.
+    A read-only archive keeps games added later in memory only, for a
+    server whose files were handed over to another process.
+    """
+
+    def __init__(self, path=None, append_only=False):
+        """Init class."""
+        if append_only and path is None:
+            raise ValueError("append-only archive needs a directory")
+        self.path = path
+        self.append_only = append_only
+        self.read_only = False
+        self.cols = {name: array(code) for name, code in COLUMNS.items()}
+        # Games and moves that are on disk but not in self.cols.
+        self.stored_games = self.stored_moves = 0
+        self.names, self.name_ids = [], {}
+        self.fens, self.fen_ids = [], {}
+        self.lags = {}
+        self.intern_fen(chess.STARTING_FEN, save=False)
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self.load()
+
+    def __len__(self):
+        """Number of archived games."""
+        return self.stored_games + len(self.cols["plies"])
+
+    def file(self, name):
+        """Path of column or dictionary file."""
+        return os.path.join(self.path, name)
+
+    def load_dictionaries(self):
+        """Read player names and start positions written by previous runs."""
+        for fname, intern in (("players.txt", self.intern_name), ("fens.txt", self.intern_fen)):
+            if os.path.exists(self.file(fname)):
+                with open(self.file(fname), encoding="utf-8") as f:
+                    for line in f:
+                        intern(line.rstrip("\n"), save=False)
+
+    def truncate(self, games, moves):
+        """Cut column files to games and moves, dropping a batch torn by a crash."""
+        for name, code in COLUMNS.items():
+            fname = self.file(f"{name}.bin")
+            size = (moves if name == "moves" else games) * array(code).itemsize
+            if os.path.exists(fname) and os.path.getsize(fname) > size:
+                os.truncate(fname, size)
+
+    def open_append(self):
+        """Find complete games in column files without reading the columns."""
+        self.load_dictionaries()
+        counts = {}
+        for name, code in COLUMNS.items():
+            fname = self.file(f"{name}.bin")
+            counts[name] = os.path.getsize(fname) // array(code).itemsize if os.path.exists(fname) else 0
+
+        def end(gid):
+            # Offset and plies of one game, read in place.
+            row = {}
+            for name in ("offset", "plies"):
+                arr = array(COLUMNS[name])
+                with open(self.file(f"{name}.bin"), "rb") as f:
+                    f.seek(gid * arr.itemsize)
+                    arr.frombytes(f.read(arr.itemsize))
+                row[name] = arr[0]
+            return row["offset"] + row["plies"]
+
+        n = min(counts[c] for c in COLUMNS if c != "moves")
+        while n and counts["moves"] < end(n - 1):
+            n -= 1
+        self.stored_games, self.stored_moves = n, end(n - 1) if n else 0
+        self.truncate(self.stored_games, self.stored_moves)
+
+    def load(self):
+        """Read columns written by previous runs."""
+        if self.append_only:
+            self.open_append()
+            return
+        for name, arr in self.cols.items():
+            fname = self.file(f"{name}.bin")
+            if os.path.exists(fname):
+                with open(fname, "rb") as f:
+                    arr.frombytes(f.read())
+        self.load_dictionaries()
+        # Drop the tail of a batch that was cut short by a crash.
+        n = min(len(self.cols[c]) for c in COLUMNS if c != "moves")
+        while n and len(self.cols["moves"]) < self.cols["offset"][n - 1] + self.cols["plies"][n - 1]:
+            n -= 1
+        for name in COLUMNS:
+            if name != "moves":
+                del self.cols[name][n:]
+        if n:
+            del self.cols["moves"][self.cols["offset"][n - 1] + self.cols["plies"][n - 1]:]
+        else:
+            del self.cols["moves"][:]
+        # New games must follow the last complete one in the files too.
+        self.truncate(n, len(self.cols["moves"]))
+        if os.path.exists(self.file("lag.bin")):
+            with open(self.file("lag.bin"), "rb") as f:
+                data = f.read()
+            pos = 0
+            while pos + LAG_HEAD.size <= len(data):
+                gid, count = LAG_HEAD.unpack_from(data, pos)
+                end = pos + LAG_HEAD.size + count * LAG_ROW.size
+                if end > len(data) or gid >= n:
+                    break
+                self.lags[gid] = list(LAG_ROW.iter_unpack(data[pos + LAG_HEAD.size:end]))
+                pos = end
+
+    def intern(self, value, values, ids, fname, save=True):
+        """Id of string in dictionary, adding it when new."""
+        if value not in ids:
+            ids[value] = len(values)
+            values.append(value)
+            if save and self.path is not None and not self.read_only:
+                with open(self.file(fname), "a", encoding="utf-8") as f:
+                    f.write(value + "\n")
+        return ids[value]
+
+    def intern_name(self, name, save=True):
+        """Id of player name."""
+        return self.intern(name or "?", self.names, self.name_ids, "players.txt", save)
+
+    def intern_fen(self, fen, save=True):
+        """Id of start position."""
+        return self.intern(fen, self.fens, self.fen_ids, "fens.txt", save)
+
+    def add(self, white, black, result, moves, start=chess.STARTING_FEN, date=None):
+        """Archive one game and return its id."""
+        return self.extend([(white, black, result, moves, start, date)])
+
+    def extend(self, games):
+        """Archive many games with one write per column, return last id."""
+        new = {name: array(code) for name, code in COLUMNS.items()}
+        offset = self.stored_moves + len(self.cols["moves"])
+        for white, black, result, moves, start, date in games:
+            codes = array("H", (m if isinstance(m, int) else encode_move(m) for m in moves))
+            new["offset"].append(offset)
+            new["plies"].append(len(codes))
+            new["white"].append(self.intern_name(white))
+            new["black"].append(self.intern_name(black))
+            new["result"].append(RESULT_CODES.get(result, 0))
+            new["start"].append(self.intern_fen(start or chess.STARTING_FEN))
+            new["date"].append(time.time() if date is None else date)
+            new["moves"].extend(codes)
+            offset += len(codes)
+        for name, arr in new.items():
+            if not self.append_only:
+                self.cols[name].extend(arr)
+            if self.path is not None and not self.read_only:
+                with open(self.file(f"{name}.bin"), "ab") as f:
+                    arr.tofile(f)
+        if self.append_only:
+            self.stored_games += len(new["plies"])
+            self.stored_moves += len(new["moves"])
+        return len(self) - 1
+
+    def add_lag(self, gid, rows):
+        """Attach per-ply (ply, think ms, server ms, rtt ms) rows to game."""
+        rows = [tuple(row) for row in rows]
+        self.lags[gid] = rows
+        if self.path is not None and not self.read_only:
+            with open(self.file("lag.bin"), "ab") as f:
+                f.write(LAG_HEAD.pack(gid, len(rows)) + b"".join(LAG_ROW.pack(*row) for row in rows))
+
+    def raw(self, gid):
+        """Start position, result and move codes of archived game."""
+        c = self.cols
+        start = c["offset"][gid]
+        return (
+            self.fens[c["start"][gid]],
+            RESULTS[c["result"][gid]],
+            c["moves"][start:start + c["plies"][gid]],
+        )
+
+    def game(self, gid):
+        """Archived game as dict."""
+        c = self.cols
+        start = c["offset"][gid]
+        return {
+            "id": gid,
+            "white": self.names[c["white"][gid]],
+            "black": self.names[c["black"][gid]],
+            "result": RESULTS[c["result"][gid]],
+            "start": self.fens[c["start"][gid]],
+            "date": c["date"][gid],
+            "moves": [decode_move(m) for m in c["moves"][start:start + c["plies"][gid]]],
+            "lag": self.lags.get(gid),
+        }
+
+    def search(self, player=None, since=None, until=None):
+        """Ids of games by player name and date range."""
+        c = self.cols
+        pid = self.name_ids.get(player, -1) if player is not None else None
+        for gid in range(len(self)):
+            if pid is not None and pid not in (c["white"][gid], c["black"][gid]):
+                continue
+            if since is not None and c["date"][gid] < since:
+                continue
+            if until is not None and c["date"][gid] >= until:
+                continue
+            yield gid
+
+    def pgn(self, gid, emt=False):
+        """PGN text of archived game, with [%emt] think times if asked and known."""
+        g = self.game(gid)
+        board = chess.Board(g["start"])
+        for mv in g["moves"]:
+            board.push(mv)
+        game = chess.pgn.Game.from_board(board)
+        if emt and g["lag"]:
+            think = {ply: ms for ply, ms, _server, _rtt in g["lag"]}
+            for ply, node in enumerate(game.mainline(), 1):
+                if not math.isnan(think.get(ply, math.nan)):
+                    node.set_emt(round(think[ply] / 1000, 2))
+        game.headers["Event"] = "Chess Club"
+        game.headers["Site"] = "chessclub"
+        game.headers["Date"] = time.strftime("%Y.%m.%d", time.localtime(g["date"]))
+        game.headers["Round"] = str(gid)
+        game.headers["White"] = g["white"]
+        game.headers["Black"] = g["black"]
+        game.headers["Result"] = g["result"]
+        return str(game)
+
+    def export(self, player=None, since=None, until=None, chunk_size=64 * 1024, emt=False):
+        """Stream PGN of matching games in chunks of about chunk_size chars."""
+        buf, size = [], 0
+        for gid in self.search(player, since, until):
+            text = self.pgn(gid, emt) + "\n\n"
+            buf.append(text)
+            size += len(text)
+            if size >= chunk_size:
+                yield "".join(buf)
+                buf, size = [], 0
+        if buf:
+            yield "".join(buf)
@@ -0,0 +1,35 @@
+"""Polyglot opening book lookups."""
+
+import random
+
+import chess
+import chess.polyglot
+
+
+class OpeningBook:
+    """Polyglot .bin book, memory-mapped and binary-searched in place.
+
+    The file is never loaded into Python objects, so server processes
+    share it through the page cache.
+    """
+
+    def __init__(self, path):
+        """Init class."""
+        self.path = path
+        self.reader = chess.polyglot.open_reader(path)
+
+    def moves(self, board):
+        """Book moves of position with weights, best first."""
+        entries = sorted(self.reader.find_all(board), key=lambda e: -e.weight)
+        return [{"move": e.move.uci(), "weight": e.weight} for e in entries]
+
+    def choose(self, board):
+        """Weighted random book move or None when out of book."""
+        entries = list(self.reader.find_all(board))
+        if not entries:
+            return None
+        return random.choices(entries, [e.weight for e in entries])[0].move
+
+    def close(self):
+        """Unmap book file."""
+        self.reader.close()
@@ -0,0 +1,97 @@
+"""Shared transposition cache of derived position data."""
+
+import sys
+from collections import OrderedDict
+
+import chess
+import chess.polyglot
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+ENTRY_OVERHEAD = 200
+
+
+def approx_size(value):
+    """Rough memory footprint of cached value in bytes."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(sys.getsizeof(v) for v in value)
+    return size + ENTRY_OVERHEAD
+
+
+def position_status(board):
+    """Terminal status that depends only on the position itself."""
+    if board.is_checkmate():
+        return "checkmate"
+    if board.is_stalemate():
+        return "stalemate"
+    if board.is_insufficient_material():
+        return "insufficient_material"
+    return None
+
+
+class PositionCache:
+    """LRU cache keyed by (Zobrist hash, kind) with a memory cap."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        """Init class."""
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def lookup(self, key):
+        """Return cached value or None."""
+        item = self.items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return item[0]
+
+    def store(self, key, value):
+        """Put value to cache evicting least recently used entries."""
+        size = approx_size(value)
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.bytes -= old[1]
+        self.items[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self.items) > 1:
+            _, (_, freed) = self.items.popitem(last=False)
+            self.bytes -= freed
+            self.evictions += 1
+
+    def get(self, board, kind, compute):
+        """Cached compute(board) for the position on board."""
+        key = self.key(board, kind)
+        value = self.lookup(key)
+        if value is None:
+            value = compute(board)
+            self.store(key, value)
+        return value
+
+    def key(self, board, kind):
+        """Cache key of position on board."""
+        return chess.polyglot.zobrist_hash(board), kind
+
+    def legal_moves(self, board):
+        """Legal moves of position as tuple of uci strings."""
+        return self.get(board, "legal", lambda b: tuple(mv.uci() for mv in b.legal_moves))
+
+    def status(self, board):
+        """Terminal status of position or None."""
+        return self.get(board, "status", lambda b: position_status(b) or "") or None
+
+    def stats(self):
+        """Counters for admins."""
+        return {
+            "entries": len(self.items),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,417 @@
+"""Lobby replicated between server nodes through a pub/sub bus.
+
+Every table belongs to one node, chosen by rendezvous hashing of the
+table id over the nodes that own tables, so any node (or a gateway that
+owns none) can route a request without asking anybody. Nodes publish
+their tables and players on the bus and keep a directory of everybody
+else's for lobby listings. Requests for a table owned elsewhere go over
+a per-client upstream connection to the owner; its replies and pushed
+events are copied back as they come. When a node joins, tables it now
+owns move to it; a node that leaves hands its tables over first.
+"""
+
+import asyncio
+import hashlib
+import itertools
+import pickle
+import secrets
+
+from chessclub.protocol.compression import COMPRESSED
+
+# Actions whose table_id decides which node serves them.
+TABLE_ACTIONS = frozenset(
+    {
+        "subscribe", "ready_play", "join", "move", "analyze", "legal_moves", "game_status",
+        "book_moves", "position_stats", "get_board", "view", "leave", "lagstats", "table_info",
+    }
+)
+# Actions with state of their own served by one node of the cluster.
+SERVICE_ACTIONS = {"seek": "seek", "tournament": "tournament", "standings": "tournament"}
+
+
+def rendezvous(key, nodes):
+    """Node with the highest hash of (node, key)."""
+    return max(
+        nodes,
+        key=lambda node: hashlib.blake2b(f"{node}/{key}".encode(), digest_size=8).digest(),
+    )
+
+
+def frame(msg):
+    """Length-prefixed pickle frame."""
+    data = pickle.dumps(msg)
+    return len(data).to_bytes(4, "big") + data
+
+
+async def read_frame(reader):
+    """Header and body of next frame."""
+    header = await reader.readexactly(4)
+    return header, await reader.readexactly(int.from_bytes(header, "big") & ~COMPRESSED)
+
+
+class LocalHub:
+    """In-process bus: every message goes to all other endpoints."""
+
+    def __init__(self):
+        """Init class."""
+        self.ports = []
+
+    def deliver(self, sender, msg):
+        """Queue message for every endpoint except sender."""
+        for port in self.ports:
+            if port is not sender:
+                port.queue.put_nowait(msg)
+
+
+class LocalBus:
+    """Endpoint of LocalHub, for nodes running in one process."""
+
+    def __init__(self, hub):
+        """Init class."""
+        self.hub = hub
+        self.queue = asyncio.Queue()
+
+    async def start(self):
+        """Join hub."""
+        self.hub.ports.append(self)
+
+    def publish(self, msg):
+        """Send message to other nodes."""
+        self.hub.deliver(self, msg)
+
+    async def recv(self):
+        """Next message, None once closed."""
+        return await self.queue.get()
+
+    def close(self):
+        """Leave hub."""
+        if self in self.hub.ports:
+            self.hub.ports.remove(self)
+        self.queue.put_nowait(None)
+
+
+class UnixBus:
+    """Endpoint connected to hub served by serve_hub on a Unix socket."""
+
+    def __init__(self, path):
+        """Init class."""
+        self.path = path
+        self.reader = self.writer = None
+
+    async def start(self):
+        """Connect to hub."""
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+
+    def publish(self, msg):
+        """Send message to other nodes."""
+        self.writer.write(frame(msg))
+
+    async def recv(self):
+        """Next message, None once hub is gone."""
+        try:
+            _header, body = await read_frame(self.reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+        return pickle.loads(body)
+
+    def close(self):
+        """Disconnect from hub."""
+        self.writer.close()
+
+
+async def serve_hub(path):
+    """Relay frames between nodes connected to Unix socket path.
+
+    The hub reads only the hello of each node, to announce a bye for it
+    when its connection drops without one.
+    """
+    peers = {}
+
+    async def relay(reader, writer):
+        peers[writer] = None
+        try:
+            while True:
+                header, body = await read_frame(reader)
+                if peers[writer] is None:
+                    msg = pickle.loads(body)
+                    if msg.get("type") == "hello":
+                        peers[writer] = msg["node"]
+                for peer in peers:
+                    if peer is not writer:
+                        peer.write(header + body)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            node = peers.pop(writer)
+            if node is not None:
+                for peer in peers:
+                    peer.write(frame({"type": "bye", "node": node}))
+            writer.close()
+
+    return await asyncio.start_unix_server(relay, path)
+
+
+class Upstream:
+    """Connection to owner node acting for one client."""
+
+    __slots__ = ("reader", "writer", "pump")
+
+    def __init__(self, reader, writer, pump=None):
+        """Init class."""
+        self.reader = reader
+        self.writer = writer
+        self.pump = pump
+
+    def close(self):
+        """Stop copying and disconnect."""
+        if self.pump is not None:
+            self.pump.cancel()
+        self.writer.close()
+
+
+async def pump(upstream, writer):
+    """Copy frames from owner node to client as they arrive."""
+    try:
+        while True:
+            header, body = await read_frame(upstream.reader)
+            writer.write(header + body)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+
+
+class Cluster:
+    """Membership, table directory and request routing of one node."""
+
+    def __init__(self, server, bus, address, owns=True, node_id=None):
+        """Init class."""
+        self.server = server
+        self.bus = bus
+        self.address = address
+        self.owns = owns
+        self.id = node_id or secrets.token_hex(4)
+        self.secret = secrets.token_urlsafe(16)
+        self.nodes = {}
+        self.tables = {}
+        self.users = {}
+        self.local = set()
+        self.listener = None
+        self.spread = itertools.count()
+
+    async def start(self):
+        """Connect to bus and announce this node."""
+        await self.bus.start()
+        self.hello()
+        self.listener = self.server.spawn(self.listen())
+
+    def hello(self, reply=False):
+        """Publish node address and everything it holds."""
+        self.bus.publish(
+            {
+                "type": "hello", "node": self.id, "address": self.address, "secret": self.secret,
+                "owns": self.owns, "reply": reply,
+            }
+        )
+        for tid in self.server.tables:
+            self.table_changed(tid)
+        for name in self.local:
+            self.user_changed(name)
+
+    async def leave(self):
+        """Hand tables over to remaining nodes and say goodbye."""
+        async with self.server.lock:
+            rest = [node for node in self.owners() if node != self.id]
+            if rest:
+                for tid in list(self.server.tables):
+                    self.migrate(tid, rendezvous(tid, rest))
+            self.bus.publish({"type": "bye", "node": self.id})
+        self.bus.close()
+        if self.listener is not None:
+            self.listener.cancel()
+
+    def owners(self):
+        """Ids of nodes that own tables; a lone gateway owns them itself."""
+        nodes = [node for node, info in self.nodes.items() if info["owns"]]
+        if self.owns or not nodes:
+            nodes.append(self.id)
+        return nodes
+
+    def owner(self, key):
+        """Node serving table id or service name."""
+        return rendezvous(key, self.owners())
+
+    def free(self, tid):
+        """Whether this node may open a table with id tid."""
+        owners = self.owners()
+        return tid not in self.tables and (self.id not in owners or rendezvous(tid, owners) == self.id)
+
+    def route(self, conn, cmd):
+        """Node that must serve request, None if it is this one."""
+        action = cmd["action"]
+        if action in SERVICE_ACTIONS:
+            node = self.owner(SERVICE_ACTIONS[action])
+        elif action == "subscribe" and cmd.get("table_id") is None:
+            # Listener without table waits for matchmaking events.
+            node = self.owner("seek")
+        elif action == "createtable" and self.id not in self.owners():
+            # Gateway: spread new tables over owning nodes.
+            nodes = sorted(self.owners())
+            node = nodes[next(self.spread) % len(nodes)]
+        elif action == "join" and cmd.get("table_id") is None:
+            free = [t for t in self.listing() if not (t["white"] and t["black"])]
+            if not free:
+                return None
+            cmd["table_id"] = free[0]["id"]
+            node = self.owner(free[0]["id"])
+        elif action in TABLE_ACTIONS and cmd.get("table_id") is not None:
+            node = self.owner(cmd["table_id"])
+        else:
+            return None
+        return None if node == self.id else node
+
+    async def forward(self, conn, node, cmd):
+        """Send request to owner node over client's upstream, False if it is unreachable."""
+        up = conn.upstreams.get(node) if conn.upstreams else None
+        try:
+            if up is None:
+                up = await self.attach(conn, node)
+            up.writer.write(frame(cmd))
+            await up.writer.drain()
+        except (OSError, asyncio.IncompleteReadError, KeyError):
+            if up is not None:
+                up.close()
+                conn.upstreams.pop(node, None)
+            return False
+        return True
+
+    async def attach(self, conn, node):
+        """Open upstream to node on behalf of connection's user."""
+        info = self.nodes[node]
+        reader, writer = await asyncio.open_connection(*info["address"])
+        player = self.server.users.get(conn.user)
+        writer.write(
+            frame(
+                {
+                    "action": "attach", "secret": info["secret"], "user": conn.user,
+                    "rating": player.rating if player is not None else None,
+                }
+            )
+        )
+        up = Upstream(reader, writer)
+        _header, body = await read_frame(reader)
+        if pickle.loads(body)["status"] != "ok":
+            up.close()
+            raise ConnectionRefusedError(node)
+        up.pump = asyncio.create_task(pump(up, conn.writer))
+        if conn.upstreams is None:
+            conn.upstreams = {}
+        conn.upstreams[node] = up
+        return up
+
+    def table_info(self, t):
+        """Directory entry of local table."""
+        return dict(self.server.table_info(t), owner=self.id)
+
+    def listing(self):
+        """Entries of all tables of the cluster by id."""
+        entries = {tid: self.table_info(t) for tid, t in self.server.tables.items()}
+        for tid, info in self.tables.items():
+            entries.setdefault(tid, info)
+        return [entries[tid] for tid in sorted(entries)]
+
+    def ids(self):
+        """Ids of all tables of the cluster."""
+        return sorted({*self.server.tables, *self.tables})
+
+    def table_changed(self, tid):
+        """Publish state of local table, or that it is gone."""
+        t = self.server.tables.get(tid)
+        if t is None:
+            self.bus.publish({"type": "table_gone", "node": self.id, "table_id": tid})
+        else:
+            self.bus.publish({"type": "table", "node": self.id, "info": self.table_info(t)})
+
+    def user_changed(self, name, gone=False):
+        """Publish player registered here, or that the session ended."""
+        player = self.server.users.get(name)
+        if gone or player is None:
+            self.local.discard(name)
+            self.bus.publish({"type": "user_gone", "node": self.id, "name": name})
+        else:
+            self.local.add(name)
+            self.bus.publish({"type": "user", "node": self.id, "name": name, "rating": player.rating})
+
+    def rated(self, name, rating):
+        """Share rating change of player who may be registered on another node."""
+        self.bus.publish({"type": "rating", "node": self.id, "name": name, "rating": rating})
+
+    def taken(self, name):
+        """Whether name is registered on another node."""
+        return name in self.users
+
+    def migrate(self, tid, node):
+        """Move local table to node."""
+        t = self.server.tables.pop(tid)
+        self.tables[tid] = dict(self.table_info(t), owner=node)
+        self.bus.publish(
+            {"type": "migrate", "node": self.id, "to": node, "table": self.server.table_state(t)}
+        )
+
+    def rebalance(self):
+        """Move local tables another node owns now."""
+        for tid in list(self.server.tables):
+            node = self.owner(tid)
+            if node != self.id:
+                self.migrate(tid, node)
+
+    async def listen(self):
+        """Apply bus messages until the bus closes."""
+        while True:
+            msg = await self.bus.recv()
+            if msg is None:
+                return
+            async with self.server.lock:
+                self.apply(msg)
+
+    def apply(self, msg):
+        """Update directory from message of another node."""
+        kind, node = msg["type"], msg["node"]
+        if kind == "hello":
+            known = node in self.nodes
+            self.nodes[node] = {"address": msg["address"], "secret": msg["secret"], "owns": msg["owns"]}
+            if not msg["reply"]:
+                self.hello(reply=True)
+            if not known and msg["owns"]:
+                self.rebalance()
+        elif kind == "bye":
+            self.nodes.pop(node, None)
+            for tid in [tid for tid, info in self.tables.items() if info["owner"] == node]:
+                del self.tables[tid]
+                self.server.lobby_changed(tid, False, local=False)
+            for name in [name for name, owner in self.users.items() if owner == node]:
+                del self.users[name]
+        elif kind == "table":
+            info = msg["info"]
+            if info["id"] not in self.server.tables:
+                new = info["id"] not in self.tables
+                self.tables[info["id"]] = info
+                if new:
+                    self.server.lobby_changed(info["id"], True, local=False)
+        elif kind == "table_gone":
+            info = self.tables.get(msg["table_id"])
+            if info is not None and info["owner"] == node:
+                del self.tables[msg["table_id"]]
+                self.server.lobby_changed(msg["table_id"], False, local=False)
+        elif kind == "user":
+            self.users[msg["name"]] = node
+        elif kind == "user_gone":
+            if self.users.get(msg["name"]) == node:
+                del self.users[msg["name"]]
+        elif kind == "rating":
+            player = self.server.users.get(msg["name"])
+            if player is not None:
+                player.rating = msg["rating"]
+        elif kind == "migrate" and msg["to"] == self.id:
+            t = self.server.restore_table(msg["table"])
+            self.tables.pop(t.id, None)
+            self.table_changed(t.id)
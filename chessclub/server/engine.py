@@ -0,0 +1,240 @@
+"""Engine worker pool for bot tables and analysis."""
+
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import chess
+import chess.engine
+
+MATE = 100000
+MAX_MOVETIME = 5.0
+MAX_NODES = 2_000_000
+DEFAULT_MOVETIME = 0.5
+DEFAULT_NODES = 50_000
+QUIESCE_DEPTH = 4
+
+PIECE_VALUES = {
+    chess.PAWN: 100,
+    chess.KNIGHT: 320,
+    chess.BISHOP: 330,
+    chess.ROOK: 500,
+    chess.QUEEN: 900,
+    chess.KING: 0,
+}
+CENTER = chess.BB_CENTER | chess.BB_D3 | chess.BB_E3 | chess.BB_D6 | chess.BB_E6
+
+
+class Budget(Exception):
+    """Search ran out of time or nodes."""
+
+
+class Searcher:
+    """Alpha-beta search on python-chess board with time and node budget."""
+
+    def __init__(self, movetime, nodes):
+        """Init class."""
+        self.deadline = time.monotonic() + movetime
+        self.max_nodes = nodes
+        self.nodes = 0
+
+    def evaluate(self, board):
+        """Static evaluation from side to move point of view."""
+        score = 0
+        for pt, value in PIECE_VALUES.items():
+            score += value * (
+                chess.popcount(board.pieces_mask(pt, chess.WHITE))
+                - chess.popcount(board.pieces_mask(pt, chess.BLACK))
+            )
+        minors = board.knights | board.bishops | board.pawns
+        score += 15 * (
+            chess.popcount(minors & board.occupied_co[chess.WHITE] & CENTER)
+            - chess.popcount(minors & board.occupied_co[chess.BLACK] & CENTER)
+        )
+        return score if board.turn else -score
+
+    def ordered(self, board, moves):
+        """Captures first, most valuable victim first."""
+
+        def key(mv):
+            victim = board.piece_type_at(mv.to_square)
+            return -(PIECE_VALUES[victim] if victim else 0) - (900 if mv.promotion else 0)
+
+        return sorted(moves, key=key)
+
+    def count(self):
+        """Count node and stop when budget is exhausted."""
+        self.nodes += 1
+        if self.nodes >= self.max_nodes:
+            raise Budget
+        if not self.nodes & 1023 and time.monotonic() > self.deadline:
+            raise Budget
+
+    def quiesce(self, board, alpha, beta, depth):
+        """Search captures only until position is quiet."""
+        self.count()
+        stand = self.evaluate(board)
+        if stand >= beta or depth == 0:
+            return stand
+        alpha = max(alpha, stand)
+        for mv in self.ordered(board, board.generate_legal_captures()):
+            board.push(mv)
+            score = -self.quiesce(board, -beta, -alpha, depth - 1)
+            board.pop()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+    def negamax(self, board, depth, alpha, beta, ply):
+        """Alpha-beta negamax."""
+        self.count()
+        moves = list(board.legal_moves)
+        if not moves:
+            return -MATE + ply if board.is_check() else 0
+        if board.is_insufficient_material() or board.halfmove_clock >= 100:
+            return 0
+        if depth == 0:
+            return self.quiesce(board, alpha, beta, QUIESCE_DEPTH)
+        best = -MATE
+        for mv in self.ordered(board, moves):
+            board.push(mv)
+            score = -self.negamax(board, depth - 1, -beta, -alpha, ply + 1)
+            board.pop()
+            best = max(best, score)
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                break
+        return best
+
+    def search(self, board):
+        """Iterative deepening, returns (move, score, depth)."""
+        moves = self.ordered(board, board.legal_moves)
+        best_move, best_score, done = (moves[0] if moves else None), 0, 0
+        depth = 1
+        try:
+            while moves:
+                alpha, scores = -MATE - 1, {}
+                for mv in moves:
+                    board.push(mv)
+                    scores[mv] = -self.negamax(board, depth - 1, -MATE - 1, -alpha, 1)
+                    board.pop()
+                    alpha = max(alpha, scores[mv])
+                moves.sort(key=lambda mv: -scores[mv])
+                best_move, best_score, done = moves[0], scores[moves[0]], depth
+                if abs(best_score) >= MATE - depth:
+                    break
+                depth += 1
+        except Budget:
+            pass
+        return best_move, best_score, done
+
+
+_UCI = {}
+
+
+def analyse(fen, movetime, nodes, uci=None):
+    """Search position in worker process and return result dict.
+
+    Score is in centipawns from white's point of view.
+    """
+    board = chess.Board(fen)
+    started = time.monotonic()
+    if uci:
+        if uci not in _UCI:
+            _UCI[uci] = chess.engine.SimpleEngine.popen_uci(uci)
+        info = _UCI[uci].analyse(board, chess.engine.Limit(time=movetime, nodes=nodes))
+        pv = info.get("pv") or [None]
+        move, score = pv[0], info["score"].white().score(mate_score=MATE)
+        depth, searched = info.get("depth", 0), info.get("nodes", 0)
+    else:
+        searcher = Searcher(movetime, nodes)
+        move, score, depth = searcher.search(board)
+        score = score if board.turn else -score
+        searched = searcher.nodes
+    return {
+        "move": move.uci() if move else None,
+        "score": score,
+        "depth": depth,
+        "nodes": searched,
+        "time": time.monotonic() - started,
+    }
+
+
+class EnginePool:
+    """Process pool of engine workers with round-robin queue per table.
+
+    Every job gets a round number one past the previous job of its table
+    but not less than the round being served, so a table with a long
+    queue cannot delay tables that ask for their first analysis.
+    """
+
+    def __init__(self, workers=None, uci=None, max_movetime=MAX_MOVETIME, max_nodes=MAX_NODES):
+        """Init class."""
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(self.workers)
+        self.uci = uci
+        self.max_movetime = max_movetime
+        self.max_nodes = max_nodes
+        self.queue = []
+        self.last_round = {}
+        self.round = 0
+        self.seq = itertools.count()
+        self.running = 0
+
+    def budget(self, movetime=None, nodes=None):
+        """Clamp requested budget to pool limits."""
+        movetime = min(float(movetime or DEFAULT_MOVETIME), self.max_movetime)
+        nodes = min(int(nodes or DEFAULT_NODES), self.max_nodes)
+        return max(movetime, 0.01), max(nodes, 1)
+
+    def submit(self, key, fen, movetime=None, nodes=None):
+        """Queue search for key (table id) and return awaitable result."""
+        return self.call(key, analyse, fen, *self.budget(movetime, nodes), self.uci)
+
+    def call(self, key, fn, *args):
+        """Queue fn(*args) for key in a worker process and return awaitable result."""
+        fut = asyncio.get_running_loop().create_future()
+        rnd = max(self.last_round.get(key, -1) + 1, self.round)
+        self.last_round[key] = rnd
+        heapq.heappush(self.queue, (rnd, next(self.seq), key, (fn, args, fut)))
+        self.dispatch()
+        return fut
+
+    def dispatch(self):
+        """Start queued jobs in round order while workers are free."""
+        loop = asyncio.get_running_loop()
+        while self.running < self.workers and self.queue:
+            self.round, _, key, (fn, args, fut) = heapq.heappop(self.queue)
+            if len(self.last_round) > 2 * len(self.queue) + 64:
+                self.last_round = {
+                    k: r for k, r in self.last_round.items() if r >= self.round
+                }
+            if fut.cancelled():
+                continue
+            self.running += 1
+            job = loop.run_in_executor(self.executor, fn, *args)
+            job.add_done_callback(lambda job, fut=fut: self.finished(job, fut))
+
+    def finished(self, job, fut):
+        """Pass worker result on and start next job."""
+        self.running -= 1
+        if job.cancelled():
+            fut.cancel()
+        elif not fut.cancelled():
+            if job.exception() is not None:
+                fut.set_exception(job.exception())
+            else:
+                fut.set_result(job.result())
+        self.dispatch()
+
+    def pending(self):
+        """Number of queued jobs."""
+        return len(self.queue)
+
+    def close(self):
+        """Stop worker processes."""
+        self.executor.shutdown(cancel_futures=True)
@@ -0,0 +1,47 @@
+"""Hand listening socket and state over to a new server process."""
+
+import asyncio
+import os
+import pickle
+import socket
+import zlib
+
+MAX_FDS = 8
+ACK = b"\x01"
+
+
+def listen(path):
+    """Unix control socket the next server process connects to."""
+    if os.path.exists(path):
+        os.unlink(path)
+    ctl = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    ctl.bind(path)
+    ctl.listen(1)
+    ctl.setblocking(False)
+    return ctl
+
+
+async def send_state(conn, fds, state):
+    """Send listening sockets and compressed state, wait for the ack."""
+    loop = asyncio.get_running_loop()
+    data = zlib.compress(pickle.dumps(state))
+    socket.send_fds(conn, [len(data).to_bytes(4, "big")], fds)
+    await loop.sock_sendall(conn, data)
+    return await loop.sock_recv(conn, 1) == ACK
+
+
+def take_over(path):
+    """Connect to running server, return its listening sockets and state."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        header, fds, _flags, _addr = socket.recv_fds(conn, 4, MAX_FDS)
+        size = int.from_bytes(header, "big")
+        data = bytearray()
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Server closed handoff")
+            data += chunk
+        state = pickle.loads(zlib.decompress(data))
+        conn.sendall(ACK)
+    return [socket.socket(fileno=fd) for fd in fds], state
@@ -0,0 +1,144 @@
+"""Rated matchmaking queue bucketed by rating band."""
+
+import itertools
+import time
+from bisect import bisect_left, insort
+from collections import deque
+
+DEFAULT_RATING = 1500
+ELO_K = 32
+BAND = 50
+BASE_WINDOW = 100
+WIDEN_PER_SEC = 25
+MAX_WINDOW = 800
+# Seeks looked at per band when older ones do not accept each other.
+BAND_DEPTH = 32
+DEFAULT_TIME_CONTROL = "5+0"
+
+
+def elo(rating, opponent, score, k=ELO_K):
+    """New Elo rating after game with score 1, 0.5 or 0."""
+    expected = 1 / (1 + 10 ** ((opponent - rating) / 400))
+    return rating + k * (score - expected)
+
+
+class Seek:
+    """Player waiting in matchmaking queue."""
+
+    __slots__ = ("name", "rating", "time_control", "since", "payload")
+
+    def __init__(self, name, rating, time_control, since, payload=None):
+        """Init class."""
+        self.name = name
+        self.rating = rating
+        self.time_control = time_control
+        self.since = since
+        self.payload = payload
+
+
+class Matchmaker:
+    """Seeks grouped into FIFO queues per (time control, rating band).
+
+    Non-empty bands of every time control are kept sorted, so finding
+    opponents inside a rating window is a bisect plus a walk over the few
+    bands the window covers. The window grows while a player waits. In
+    each band the oldest acceptable seek wins; the walk over a band stops
+    after BAND_DEPTH seeks so a crowded band cannot make pairing linear.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """Init class."""
+        self.clock = clock
+        self.bands = {}
+        self.queues = {}
+        self.seeks = {}
+
+    def __len__(self):
+        """Number of waiting players."""
+        return len(self.seeks)
+
+    def window(self, s, now):
+        """Allowed rating difference for seek at time now."""
+        return min(BASE_WINDOW + WIDEN_PER_SEC * (now - s.since), MAX_WINDOW)
+
+    def add(self, s):
+        """Put seek to the end of its band queue."""
+        key = (s.time_control, int(s.rating // BAND))
+        q = self.queues.get(key)
+        if q is None:
+            q = self.queues[key] = deque()
+            insort(self.bands.setdefault(s.time_control, []), key[1])
+        q.append(s)
+        self.seeks[s.name] = s
+
+    def remove(self, s):
+        """Take seek out of queue."""
+        key = (s.time_control, int(s.rating // BAND))
+        q = self.queues[key]
+        if q[0] is s:
+            q.popleft()
+        else:
+            q.remove(s)
+        if not q:
+            del self.queues[key]
+            bands = self.bands[s.time_control]
+            del bands[bisect_left(bands, key[1])]
+            if not bands:
+                del self.bands[s.time_control]
+        del self.seeks[s.name]
+
+    def find(self, s, now):
+        """Closest waiting opponent both sides accept or None."""
+        bands = self.bands.get(s.time_control, [])
+        width = self.window(s, now)
+        i = bisect_left(bands, int((s.rating - width) // BAND))
+        best, best_diff = None, None
+        while i < len(bands) and bands[i] <= (s.rating + width) // BAND:
+            for other in itertools.islice(self.queues[(s.time_control, bands[i])], BAND_DEPTH):
+                if other is s:
+                    continue
+                diff = abs(other.rating - s.rating)
+                if diff <= min(width, self.window(other, now)):
+                    if best is None or diff < best_diff:
+                        best, best_diff = other, diff
+                    # Queue is oldest first; the first one that fits has waited longest.
+                    break
+            i += 1
+        return best
+
+    def seek(self, name, rating, time_control=DEFAULT_TIME_CONTROL, payload=None):
+        """Queue player, return (seek, opponent) with opponent None if nobody fits."""
+        if name in self.seeks:
+            self.remove(self.seeks[name])
+        now = self.clock()
+        s = Seek(name, rating, time_control, now, payload)
+        opponent = self.find(s, now)
+        if opponent is not None:
+            self.remove(opponent)
+        else:
+            self.add(s)
+        return s, opponent
+
+    def cancel(self, name, seek=None):
+        """Drop player from queue if waiting; given seek, only if it is still that one."""
+        s = self.seeks.get(name)
+        if s is not None and (seek is None or s is seek):
+            self.remove(s)
+            return s
+        return None
+
+    def sweep(self):
+        """Pair oldest seeks of each band whose windows have widened, return pairs."""
+        now, pairs = self.clock(), []
+        for time_control in list(self.bands):
+            for band in list(self.bands.get(time_control, [])):
+                q = self.queues.get((time_control, band))
+                for s in list(itertools.islice(q or (), BAND_DEPTH)):
+                    if self.seeks.get(s.name) is not s:
+                        continue
+                    opponent = self.find(s, now)
+                    if opponent is not None:
+                        self.remove(s)
+                        self.remove(opponent)
+                        pairs.append((s, opponent))
+        return pairs
@@ -0,0 +1,81 @@
+"""Event loop choice and TCP socket tuning."""
+
+import asyncio
+import socket
+
+BACKLOG = 128
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
+LOOPS = ("asyncio", "uvloop")
+
+
+def loop_factory(name):
+    """Event loop constructor for name, default loop if uvloop is missing."""
+    if name == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            print("SERVER:: uvloop is not installed, using asyncio loop")
+        else:
+            return uvloop.new_event_loop
+    return asyncio.new_event_loop
+
+
+def run_on(factory, coro):
+    """Run coroutine on new event loop from factory like asyncio.run.
+
+    On Ctrl-C the coroutine is cancelled and awaited, so its cleanup
+    runs before the interrupt propagates.
+    """
+    loop = factory()
+    asyncio.set_event_loop(loop)
+    task = loop.create_task(coro)
+    try:
+        return loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+        raise
+    finally:
+        rest = asyncio.all_tasks(loop)
+        for t in rest:
+            t.cancel()
+        loop.run_until_complete(asyncio.gather(*rest, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.run_until_complete(loop.shutdown_default_executor())
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def tune_socket(sock, rcvbuf=None, sndbuf=None):
+    """Disable Nagle, enable keepalive and set buffer sizes if given."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Probe timings are not portable, macOS has only TCP_KEEPALIVE.
+    for opt, value in (
+        ("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+        ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+        ("TCP_KEEPCNT", KEEPALIVE_COUNT),
+    ):
+        if hasattr(socket, opt):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    if sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+
+
+def listen_socket(host, port, backlog=BACKLOG, rcvbuf=None, sndbuf=None):
+    """Listening TCP socket; accepted sockets inherit its options."""
+    family, kind, proto, _name, address = socket.getaddrinfo(
+        host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE
+    )[0]
+    sock = socket.socket(family, kind, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Buffer sizes must be set before listen to affect TCP window scaling.
+    tune_socket(sock, rcvbuf, sndbuf)
+    sock.bind(address)
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
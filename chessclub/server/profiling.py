@@ -0,0 +1,109 @@
+"""Opt-in per-action timings and sampled stacks of the event loop thread."""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILE_ENV = "CHESSCLUB_PROFILE"
+SAMPLE_INTERVAL = 0.001
+MAX_DEPTH = 64
+# Frames of these files mean the loop is waiting for I/O.
+IDLE_FILES = ("selectors.py",)
+
+
+def frame_stack(frame):
+    """Collapsed "file:function;..." stack from outermost to innermost frame."""
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profiler:
+    """Wall time per handled action plus a stack sampler.
+
+    The sampler thread looks at the current frame of the loop thread every
+    interval and counts the stacks it sees, which is the input format of
+    flamegraph.pl and speedscope. It never touches the loop itself, so it
+    measures handlers, engine calls and pickling alike.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL, thread_id=None):
+        """Init class."""
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.actions = {}
+        self.stacks = Counter()
+        self.idle = 0
+        self.started = time.monotonic()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, name="profiler", daemon=True)
+        self.sampler.start()
+
+    def record(self, action, seconds):
+        """Account one handled request."""
+        calls, total, worst = self.actions.get(action, (0, 0.0, 0.0))
+        self.actions[action] = (calls + 1, total + seconds, max(worst, seconds))
+
+    def sample(self):
+        """Sampler thread body."""
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            if os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+                self.idle += 1
+            else:
+                self.stacks[frame_stack(frame)] += 1
+
+    def reset(self):
+        """Forget everything collected so far."""
+        self.actions = {}
+        self.stacks = Counter()
+        self.idle = 0
+        self.started = time.monotonic()
+
+    def stop(self):
+        """Stop sampler thread."""
+        self.stopped.set()
+        self.sampler.join()
+
+    def collapsed(self):
+        """Lines "stack count", busiest first."""
+        # Copy in one C call, the sampler thread keeps adding stacks.
+        stacks = dict(self.stacks)
+        return [f"{stack} {n}" for stack, n in sorted(stacks.items(), key=lambda item: -item[1])]
+
+    def dump(self, path):
+        """Write collapsed stacks to file."""
+        with open(path, "w") as f:
+            f.writelines(line + "\n" for line in self.collapsed())
+
+    def stats(self):
+        """Per-action calls, mean and max milliseconds."""
+        return {
+            action: {
+                "calls": calls,
+                "mean_ms": total * 1000 / calls,
+                "max_ms": worst * 1000,
+                "total_ms": total * 1000,
+            }
+            for action, (calls, total, worst) in sorted(
+                self.actions.items(), key=lambda item: -item[1][1]
+            )
+        }
+
+    def report(self, stacks=True):
+        """Everything collected, for the admin action."""
+        busy = sum(self.stacks.values())
+        return {
+            "seconds": time.monotonic() - self.started,
+            "samples": busy + self.idle,
+            "busy": busy,
+            "actions": self.stats(),
+            "stacks": self.collapsed() if stacks else None,
+        }
@@ -0,0 +1,83 @@
+"""Token bucket rate limits per connection and per action."""
+
+import time
+from collections import Counter
+
+# Action -> (tokens per second, burst). Expensive actions get less.
+RATES = {
+    "list_tables": (2.0, 10),
+    "export_games": (0.2, 2),
+    "analyze": (2.0, 5),
+    "tournament": (0.1, 2),
+    "register": (1.0, 5),
+    "get_board": (20.0, 40),
+    "move": (20.0, 40),
+}
+DEFAULT_RATE = (10.0, 30)
+CONNECTION_RATE = (50.0, 100)
+
+
+class TokenBucket:
+    """Bucket refilled at rate tokens per second up to burst."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        """Init class."""
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, now):
+        """Add tokens earned since last call, return current amount."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens
+
+
+class RateLimiter:
+    """Limits of all connections; the buckets live with each connection.
+
+    A request needs a token from the bucket of its action and from the
+    connection's overall bucket, so cheap actions cannot be used to keep
+    expensive ones running at full speed and vice versa.
+    """
+
+    def __init__(self, rates=None, default=DEFAULT_RATE, connection=CONNECTION_RATE, clock=time.monotonic):
+        """Init class."""
+        self.rates = RATES if rates is None else rates
+        self.default = default
+        self.connection = connection
+        self.clock = clock
+        self.allowed = Counter()
+        self.limited = Counter()
+
+    def buckets(self):
+        """Fresh bucket set for new connection."""
+        return {None: TokenBucket(*self.connection, self.clock())}
+
+    def allow(self, buckets, action):
+        """Whether connection with buckets may run action now."""
+        now = self.clock()
+        bucket = buckets.get(action)
+        if bucket is None:
+            bucket = buckets[action] = TokenBucket(*self.rates.get(action, self.default), now)
+        total = buckets[None]
+        # Refused requests cost nothing, so a client is never locked out for long.
+        if bucket.refill(now) >= 1 and total.refill(now) >= 1:
+            bucket.tokens -= 1
+            total.tokens -= 1
+            self.allowed[action] += 1
+            return True
+        self.limited[action] += 1
+        return False
+
+    def stats(self):
+        """Counters of allowed and refused requests per action."""
+        return {
+            "allowed": dict(self.allowed),
+            "limited": dict(self.limited),
+            "rates": {**self.rates, "default": self.default},
+            "connection": self.connection,
+        }
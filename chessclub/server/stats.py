@@ -0,0 +1,248 @@
+"""Opening explorer statistics over archived games."""
+
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+from bisect import bisect_left
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import chess
+import chess.polyglot
+
+from .archive import decode_move
+
+RECORD = struct.Struct("<QHIII")
+END = 0
+MAX_PLY = 60
+FLUSH_AT = 4096
+REBUILD_CHUNK = 2000
+SCORES = {"1-0": 0, "1/2-1/2": 1, "0-1": 2}
+
+
+def game_records(start, codes, max_ply=MAX_PLY):
+    """Yield (Zobrist key, move code) of every position of game.
+
+    The final position gets the END code so games that stop there still
+    count for it.
+    """
+    board = chess.Board(start)
+    for code in codes[:max_ply]:
+        yield chess.polyglot.zobrist_hash(board), code
+        board.push(decode_move(code))
+    if len(codes) <= max_ply:
+        yield chess.polyglot.zobrist_hash(board), END
+
+
+def count_games(games, counts=None):
+    """Add (start, result, codes) games to {key: {code: [w, d, l]}}."""
+    counts = {} if counts is None else counts
+    for start, result, codes in games:
+        col = SCORES.get(result)
+        if col is None:
+            continue
+        for key, code in game_records(start, codes):
+            row = counts.setdefault(key, {}).setdefault(code, [0, 0, 0])
+            row[col] += 1
+    return counts
+
+
+def sorted_records(counts):
+    """Records of counts dict in file order."""
+    for key in sorted(counts):
+        moves = counts[key]
+        for code in sorted(moves):
+            yield (key, code, *moves[code])
+
+
+def read_records(path):
+    """Records of index file read sequentially."""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(RECORD.size * 4096)
+            if not chunk:
+                return
+            yield from RECORD.iter_unpack(chunk)
+
+
+def merge_records(runs, path):
+    """Merge sorted record streams summing equal entries into file."""
+    with open(path, "wb") as f:
+        last = None
+        for rec in heapq.merge(*runs):
+            if last is not None and rec[:2] == last[:2]:
+                last[2] += rec[2]
+                last[3] += rec[3]
+                last[4] += rec[4]
+                continue
+            if last is not None:
+                f.write(RECORD.pack(*last))
+            last = list(rec)
+        if last is not None:
+            f.write(RECORD.pack(*last))
+
+
+def build_run(games, path):
+    """Count chunk of games in worker process and write sorted run file."""
+    merge_records([sorted_records(count_games(games))], path)
+    return path
+
+
+class _Keys:
+    """Sequence of record keys in mapped index file for bisect."""
+
+    def __init__(self, data):
+        """Init class."""
+        self.data = data
+
+    def __len__(self):
+        """Number of records."""
+        return len(self.data) // RECORD.size
+
+    def __getitem__(self, i):
+        """Key of record i."""
+        return struct.unpack_from("<Q", self.data, i * RECORD.size)[0]
+
+
+class OpeningIndex:
+    """Sorted file of (key, move, white, draws, black) records.
+
+    The file is memory-mapped and binary-searched; games that end while
+    the server runs are kept in memory and merged into the file in
+    batches. A batch being merged stays visible to lookups until the
+    merged file is mapped, so the merge may run in another thread.
+    A read-only index still counts games but never merges them.
+    """
+
+    def __init__(self, path, flush_at=FLUSH_AT):
+        """Init class."""
+        self.path = path
+        self.flush_at = flush_at
+        self.pending = {}
+        self.pending_games = 0
+        self.merging = None
+        self.read_only = False
+        self.file = self.data = None
+        self.open()
+
+    def open(self):
+        """Map index file if it has records."""
+        self.close()
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            self.file = open(self.path, "rb")
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        """Unmap index file."""
+        if self.data is not None:
+            self.data.close()
+            self.file.close()
+        self.file = self.data = None
+
+    def __len__(self):
+        """Number of records on disk."""
+        return len(self.data) // RECORD.size if self.data is not None else 0
+
+    def add_game(self, start, result, codes):
+        """Count finished game, True when enough piled up to flush."""
+        if result not in SCORES:
+            return False
+        count_games([(start, result, codes)], self.pending)
+        self.pending_games += 1
+        return self.pending_games >= self.flush_at
+
+    def detach(self):
+        """Take games kept in memory for merge, None if none, a merge runs or index is read-only."""
+        if not self.pending or self.merging is not None or self.read_only:
+            return None
+        self.merging, self.pending, self.pending_games = self.pending, {}, 0
+        return self.merging
+
+    def merge(self, counts):
+        """Write merge of counts and index file to temporary file and return its path.
+
+        Only reads the mapped file, so it may run in a worker thread.
+        """
+        runs = [sorted_records(counts)]
+        if self.data is not None:
+            runs.append(RECORD.iter_unpack(self.data))
+        tmp = f"{self.path}.tmp"
+        merge_records(runs, tmp)
+        return tmp
+
+    def install(self, tmp):
+        """Map merged file in place of index file."""
+        self.close()
+        os.replace(tmp, self.path)
+        self.open()
+        self.merging = None
+
+    def flush(self):
+        """Merge games kept in memory into index file."""
+        counts = self.detach()
+        if counts is not None:
+            self.install(self.merge(counts))
+
+    def write(self, runs):
+        """Replace index file with merge of runs."""
+        tmp = f"{self.path}.tmp"
+        merge_records(runs, tmp)
+        self.install(tmp)
+
+    def rebuild(self, archive, workers=None, chunk=REBUILD_CHUNK):
+        """Recount all archived games in worker processes."""
+        self.pending, self.pending_games, self.merging = {}, 0, None
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(self.path))) as tmp:
+            paths, running = [], set()
+            with ProcessPoolExecutor(workers) as executor:
+                limit = 2 * (workers or os.cpu_count() or 1)
+                for first in range(0, len(archive), chunk):
+                    games = [archive.raw(gid) for gid in range(first, min(first + chunk, len(archive)))]
+                    path = os.path.join(tmp, f"run{len(paths)}")
+                    paths.append(path)
+                    running.add(executor.submit(build_run, games, path))
+                    if len(running) >= limit:
+                        done, running = wait(running, return_when=FIRST_COMPLETED)
+                        for fut in done:
+                            fut.result()
+                for fut in running:
+                    fut.result()
+            self.write([read_records(path) for path in paths])
+
+    def lookup(self, board):
+        """Statistics of position on board and of moves played from it."""
+        key = chess.polyglot.zobrist_hash(board)
+        moves = {}
+        if self.data is not None:
+            lo = bisect_left(_Keys(self.data), key)
+            while lo < len(self):
+                k, code, *row = RECORD.unpack_from(self.data, lo * RECORD.size)
+                if k != key:
+                    break
+                moves[code] = row
+                lo += 1
+        for counts in (self.merging or {}, self.pending):
+            for code, row in counts.get(key, {}).items():
+                moves[code] = [a + b for a, b in zip(moves.get(code, [0, 0, 0]), row)]
+        total = [sum(col) for col in zip(*moves.values())] or [0, 0, 0]
+        return {
+            "games": sum(total),
+            "white": total[0],
+            "draws": total[1],
+            "black": total[2],
+            "moves": sorted(
+                (
+                    {
+                        "move": decode_move(code).uci(),
+                        "games": sum(row),
+                        "white": row[0],
+                        "draws": row[1],
+                        "black": row[2],
+                    }
+                    for code, row in moves.items()
+                    if code != END
+                ),
+                key=lambda m: -m["games"],
+            ),
+        }
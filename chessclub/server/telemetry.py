@@ -0,0 +1,139 @@
+"""Move timing and network lag per table and for the whole server."""
+
+import math
+from array import array
+from bisect import bisect_left
+
+LAG_PLIES = 256
+# Upper bounds of histogram buckets in milliseconds; the last one is open.
+BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+KINDS = ("think", "server", "rtt")
+NAN = float("nan")
+
+
+class LagLog:
+    """Ring buffer of the last LAG_PLIES moves of a table.
+
+    For every move it keeps the ply, the think time (from the previous
+    move to the server receiving this one), the time the server spent on
+    the request and the round trip the client measured for its previous
+    request, all in milliseconds. Unknown values are NaN.
+    """
+
+    __slots__ = ("size", "next", "ply", "think", "server", "rtt", "last")
+
+    def __init__(self, size=LAG_PLIES):
+        """Init class."""
+        self.size = size
+        self.next = 0
+        self.ply = array("H")
+        self.think = array("f")
+        self.server = array("f")
+        self.rtt = array("f")
+        self.last = None
+
+    def __len__(self):
+        """Number of moves kept."""
+        return len(self.ply)
+
+    def moved(self, now):
+        """Remember time of move the log has no timings for, e.g. a bot move."""
+        self.last = now
+
+    def add(self, ply, received, done, rtt=None):
+        """Record move received and answered at monotonic times, return the row."""
+        row = (
+            ply,
+            NAN if self.last is None else (received - self.last) * 1000,
+            (done - received) * 1000,
+            NAN if rtt is None else rtt * 1000,
+        )
+        self.last = done
+        if len(self.ply) < self.size:
+            for col, value in zip((self.ply, self.think, self.server, self.rtt), row):
+                col.append(value)
+        else:
+            for col, value in zip((self.ply, self.think, self.server, self.rtt), row):
+                col[self.next] = value
+            self.next = (self.next + 1) % self.size
+        return row
+
+    @classmethod
+    def from_rows(cls, rows, size=LAG_PLIES):
+        """Log holding rows, e.g. from a snapshot."""
+        log = cls(size)
+        for ply, think, server, rtt in rows[-size:]:
+            for col, value in zip((log.ply, log.think, log.server, log.rtt), (ply, think, server, rtt)):
+                col.append(value)
+        return log
+
+    def rows(self):
+        """Kept moves as (ply, think ms, server ms, rtt ms), oldest first."""
+        order = list(range(self.next, len(self.ply))) + list(range(self.next))
+        return [(self.ply[i], self.think[i], self.server[i], self.rtt[i]) for i in order]
+
+
+class Histogram:
+    """Counts of values per BOUNDS_MS bucket."""
+
+    __slots__ = ("counts", "total", "sum")
+
+    def __init__(self):
+        """Init class."""
+        self.counts = array("Q", bytes(8 * (len(BOUNDS_MS) + 1)))
+        self.total = 0
+        self.sum = 0.0
+
+    def add(self, ms):
+        """Count one value, NaN is skipped."""
+        if math.isnan(ms):
+            return
+        self.counts[bisect_left(BOUNDS_MS, ms)] += 1
+        self.total += 1
+        self.sum += ms
+
+    def quantile(self, q):
+        """Upper bound of bucket holding the q-quantile, inf for the open one."""
+        rank, seen = q * self.total, 0
+        for bound, n in zip((*BOUNDS_MS, math.inf), self.counts):
+            seen += n
+            if n and seen >= rank:
+                return bound
+        return 0
+
+    def report(self):
+        """Buckets and summary as plain data."""
+        return {
+            "bounds_ms": list(BOUNDS_MS),
+            "counts": list(self.counts),
+            "count": self.total,
+            "mean_ms": self.sum / self.total if self.total else 0.0,
+            "p50_ms": self.quantile(0.5),
+            "p99_ms": self.quantile(0.99),
+        }
+
+
+class Telemetry:
+    """Server-wide histograms fed by the lag logs of all tables."""
+
+    def __init__(self):
+        """Init class."""
+        self.histograms = {kind: Histogram() for kind in KINDS}
+
+    def moved(self, t, now):
+        """Note move of table t made without a client request."""
+        if t.lag is None:
+            t.lag = LagLog()
+        t.lag.moved(now)
+
+    def record(self, t, ply, received, done, rtt=None):
+        """Log move of table t and count it in the histograms."""
+        if t.lag is None:
+            t.lag = LagLog()
+        row = t.lag.add(ply, received, done, rtt)
+        for kind, value in zip(KINDS, row[1:]):
+            self.histograms[kind].add(value)
+
+    def report(self):
+        """Histograms of all kinds."""
+        return {kind: h.report() for kind, h in self.histograms.items()}
@@ -0,0 +1,248 @@
+"""Round-robin and Swiss tournaments between bots."""
+
+import asyncio
+import itertools
+import math
+import os
+import random
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import chess
+
+from .archive import encode_move
+from .engine import Searcher
+
+MAX_PLIES = 300
+OPENING_PLIES = 4
+ENGINE_NODES = 300
+BATCH = 16
+MAX_PLAYERS = 256
+MAX_ROUNDS = 64
+KINDS = ("random", "engine")
+POINTS = {"1-0": (1.0, 0.0), "0-1": (0.0, 1.0), "1/2-1/2": (0.5, 0.5)}
+
+
+def play_game(kind, seed, nodes=ENGINE_NODES, max_plies=MAX_PLIES):
+    """Play bot game from start position, return (result, move codes).
+
+    Engine games start with a few random plies so pairings do not all
+    repeat the same game. Games still running at max_plies are drawn.
+    """
+    rng = random.Random(seed)
+    board = chess.Board()
+    codes = array("H")
+    while not board.is_game_over() and len(codes) < max_plies:
+        if kind == "engine" and len(codes) >= OPENING_PLIES:
+            # Search leaves moves pushed when it runs out of nodes.
+            mv = Searcher(60, nodes).search(board.copy(stack=False))[0]
+        else:
+            mv = rng.choice(list(board.legal_moves))
+        board.push(mv)
+        codes.append(encode_move(mv))
+    result = board.result()
+    return ("1/2-1/2" if result == "*" else result), codes
+
+
+def play_batch(games):
+    """Play batch of (table id, kind, seed) games in worker process."""
+    return [(tid, *play_game(kind, seed)) for tid, kind, seed in games]
+
+
+def round_robin(players):
+    """Rounds of circle method pairings; None opponent is a bye."""
+    ps = list(players) + ([None] if len(players) % 2 else [])
+    n, rounds = len(ps), []
+    for r in range(n - 1):
+        pairs = []
+        for i in range(n // 2):
+            a, b = ps[i], ps[n - 1 - i]
+            if a is None or b is None:
+                pairs.append((a or b, None))
+                continue
+            if (r + i) % 2:
+                a, b = b, a
+            pairs.append((a, b))
+        rounds.append(pairs)
+        ps = [ps[0], ps[-1], *ps[1:-1]]
+    return rounds
+
+
+def swiss_round(players, points, played):
+    """Pair players with close scores avoiding rematches where possible."""
+    order = sorted(players, key=lambda p: -points[p])
+    pairs = []
+    if len(order) % 2:
+        bye = next((p for p in reversed(order) if frozenset((p, None)) not in played), order[-1])
+        order.remove(bye)
+        pairs.append((bye, None))
+    while order:
+        a = order.pop(0)
+        i = next((i for i, b in enumerate(order) if frozenset((a, b)) not in played), 0)
+        pairs.append((a, order.pop(i)))
+    return pairs
+
+
+class Tournament:
+    """Bot tournament played on server tables.
+
+    Games run in a process pool in batches; finished batches come back
+    through an asyncio queue, their tables are closed and the games go to
+    the server archive. Given the server's engine pool, every game is one
+    job in its per-key queue next to bot moves and analyses, and one
+    worker is left to live tables; otherwise the tournament starts a pool
+    of its own.
+    """
+
+    ids = itertools.count(1)
+
+    def __init__(
+        self, server, players, system="round-robin", rounds=None, kind="random", workers=None, seed=None,
+        pool=None,
+    ):
+        """Init class."""
+        self.id = next(self.ids)
+        self.server = server
+        self.players = list(players)
+        self.system = system
+        if rounds is None:
+            rounds = len(self.players) - 1 if system == "round-robin" else math.ceil(math.log2(len(self.players)))
+        self.rounds = min(rounds, MAX_ROUNDS)
+        self.kind = kind
+        cpus = os.cpu_count() or 1
+        self.workers = max(1, min(workers or cpus, cpus))
+        self.pool = pool
+        self.rng = random.Random(seed)
+        self.points = dict.fromkeys(self.players, 0.0)
+        self.opponents = {p: [] for p in self.players}
+        self.whites = dict.fromkeys(self.players, 0)
+        self.played = set()
+        self.seats = {}
+        self.games = 0
+        self.started = self.finished = None
+
+    async def run(self):
+        """Play all rounds."""
+        self.started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        jobs = set()
+        if self.pool is not None:
+            key = ("tournament", self.id)
+            size, limit = 1, max(1, min(self.workers, self.pool.workers - 1))
+
+            def start(batch):
+                return self.pool.call(key, play_batch, batch)
+        else:
+            executor = ProcessPoolExecutor(self.workers)
+            size, limit = BATCH, self.workers
+
+            def start(batch):
+                return loop.run_in_executor(executor, play_batch, batch)
+
+        def submit(batch):
+            job = start(batch)
+            jobs.add(job)
+            job.add_done_callback(jobs.discard)
+            return job
+
+        try:
+            if self.system == "round-robin":
+                schedule = round_robin(self.players)[: self.rounds]
+                await self.play([pair for rnd in schedule for pair in rnd], submit, size, limit)
+            else:
+                for _ in range(self.rounds):
+                    await self.play(swiss_round(self.players, self.points, self.played), submit, size, limit)
+        finally:
+            for job in jobs:
+                job.cancel()
+            if self.pool is None:
+                executor.shutdown(cancel_futures=True)
+            if self.seats:
+                # Failed or cancelled batch: do not leave its tables in the lobby.
+                async with self.server.lock:
+                    for tid in self.seats:
+                        if tid in self.server.tables:
+                            self.server.close_table(tid)
+                    self.seats.clear()
+            self.finished = time.monotonic()
+
+    def colors(self, a, b):
+        """Give white to player who had it less often."""
+        if self.whites[b] < self.whites[a] or (self.whites[a] == self.whites[b] and self.rng.random() < 0.5):
+            a, b = b, a
+        self.whites[a] += 1
+        return a, b
+
+    async def play(self, pairs, submit, size, limit):
+        """Play pairings in batches of size, at most limit at once, and wait for all results."""
+        results = asyncio.Queue()
+        games = []
+        async with self.server.lock:
+            for a, b in pairs:
+                self.played.add(frozenset((a, b)))
+                if b is None:
+                    self.points[a] += 1
+                    continue
+                white, black = self.colors(a, b)
+                tid = self.server.open_table(white, black, bots_only=True)
+                self.seats[tid] = (white, black)
+                games.append((tid, self.kind, self.rng.randrange(2 ** 32)))
+        batches = [games[i:i + size] for i in range(0, len(games), size)]
+        batches.reverse()
+        running = 0
+        pending = len(games)
+        while pending:
+            while batches and running < limit:
+                job = submit(batches.pop())
+                job.add_done_callback(results.put_nowait)
+                running += 1
+            batch = (await results.get()).result()
+            running -= 1
+            async with self.server.lock:
+                for tid, result, codes in batch:
+                    self.finish(tid, result, codes)
+            pending -= len(batch)
+
+    def finish(self, tid, result, codes):
+        """Close table of finished game and score it."""
+        white, black = self.seats.pop(tid)
+        if tid in self.server.tables:
+            self.server.close_table(tid)
+        self.server.record_game(white, black, result, codes)
+        w, b = POINTS[result]
+        self.points[white] += w
+        self.points[black] += b
+        self.opponents[white].append(black)
+        self.opponents[black].append(white)
+        self.games += 1
+
+    def rate(self):
+        """Finished games per second."""
+        end = self.finished or time.monotonic()
+        return self.games / (end - self.started) if self.started and end > self.started else 0.0
+
+    def standings(self):
+        """Players by points, then Buchholz (sum of opponents' points)."""
+        rows = [
+            {
+                "name": p,
+                "points": self.points[p],
+                "buchholz": sum(self.points[o] for o in self.opponents[p]),
+                "games": len(self.opponents[p]),
+            }
+            for p in self.players
+        ]
+        rows.sort(key=lambda r: (-r["points"], -r["buchholz"], r["name"]))
+        return rows
+
+    def status(self):
+        """Progress summary for admins."""
+        return {
+            "id": self.id,
+            "system": self.system,
+            "finished": self.finished is not None,
+            "games": self.games,
+            "games_per_sec": self.rate(),
+            "standings": self.standings(),
+        }
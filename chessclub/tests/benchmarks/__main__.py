@@ -0,0 +1,607 @@
+"""Бенчмарки клиента и сервера.
+
+Использование: python3 -m chessclub.tests.benchmarks <имя> [опции]
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import io
+import os
+import pickle
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import deque
+from contextlib import ExitStack
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import chess
+import chess.pgn
+
+GAMES = [
+    # Морфи — герцог Брауншвейгский и граф Изуар, Париж 1858
+    "1. e4 e5 2. Nf3 d6 3. d4 Bg4 4. dxe5 Bxf3 5. Qxf3 dxe5 6. Bc4 Nf6 7. Qb3 Qe7 "
+    "8. Nc3 c6 9. Bg5 b5 10. Nxb5 cxb5 11. Bxb5+ Nbd7 12. O-O-O Rd8 13. Rxd7 Rxd7 "
+    "14. Rd1 Qe6 15. Bxd7+ Nxd7 16. Qb8+ Nxb8 17. Rd8# 1-0",
+    # Андерсен — Кизерицкий, Лондон 1851
+    "1. e4 e5 2. f4 exf4 3. Bc4 Qh4+ 4. Kf1 b5 5. Bxb5 Nf6 6. Nf3 Qh6 7. d3 Nh5 "
+    "8. Nh4 Qg5 9. Nf5 c6 10. g4 Nf6 11. Rg1 cxb5 12. h4 Qg6 13. h5 Qg5 14. Qf3 Ng8 "
+    "15. Bxf4 Qf6 16. Nc3 Bc5 17. Nd5 Qxb2 18. Bd6 Bxg1 19. e5 Qxa1+ 20. Ke2 Na6 "
+    "21. Nxg7+ Kd8 22. Qf6+ Nxf6 23. Be7# 1-0",
+    # Превращения у обеих сторон, в том числе не в ферзя
+    "1. h4 a5 2. h5 a4 3. h6 a3 4. hxg7 axb2 5. gxh8=N bxa1=Q 6. Nxf7 Qxb1 "
+    "7. Nxd8 Qxc1 8. Rxh7 Qxd1+ 9. Kxd1 Kxd8 10. Rxh8 Bg7 11. Rxg8+ Bf8 "
+    "12. Rxf8# 1-0",
+]
+
+SQ, TOP_MARGIN, FPS = 96, 40, 60
+PROMO_PAD = 12
+PROMO_OPTS = [chess.QUEEN, chess.ROOK, chess.BISHOP, chess.KNIGHT]
+
+
+def percentile(data, q):
+    """Return q-th percentile of sorted data."""
+    if not data:
+        return 0.0
+    return data[min(len(data) - 1, int(len(data) * q / 100))]
+
+
+def square_pos(sq):
+    """Screen center of square for white at the bottom."""
+    f, r = chess.square_file(sq), 7 - chess.square_rank(sq)
+    return f * SQ + SQ // 2, r * SQ + SQ // 2 + TOP_MARGIN
+
+
+class StubServer:
+    """Scripted local server answering client frames like a socket.
+
+    White moves are expected from the client, black moves are played
+    from the PGN after a few polls.
+    """
+
+    def __init__(self, moves, reply_polls=2):
+        """Init class."""
+        self.moves = moves
+        self.board = chess.Board()
+        self.reply_polls = reply_polls
+        self.polls = 0
+        self.requests = 0
+        self.out = b""
+
+    @property
+    def expected(self):
+        """Next move of the game or None when it is over."""
+        ply = len(self.board.move_stack)
+        return self.moves[ply] if ply < len(self.moves) else None
+
+    def answer(self, cmd):
+        """Build response for client request."""
+        resp = {"status": "ok", "msg": None, "data": None}
+        if cmd["action"] == "get_board":
+            self.polls += 1
+            if self.board.turn == chess.BLACK and self.expected:
+                if self.polls >= self.reply_polls:
+                    self.board.push(self.expected)
+                    self.polls = 0
+            resp["data"] = self.board.fen()
+        elif cmd["action"] == "table_info":
+            resp["data"] = {
+                "id": 1,
+                "white": "white",
+                "black": "black",
+                "in_game": True,
+                "active_players": ["white", "black"],
+            }
+        elif cmd["action"] == "move":
+            if chess.Move.from_uci(cmd["uci"]) == self.expected:
+                self.board.push(self.expected)
+                self.polls = 0
+            else:
+                resp["status"] = "err"
+                resp["msg"] = "SERVER:: Illegal move"
+        return resp
+
+    def sendall(self, payload):
+        """Receive request frame."""
+        self.requests += 1
+        out = pickle.dumps(self.answer(pickle.loads(payload[4:])))
+        self.out += len(out).to_bytes(4, "big") + out
+
+    def recv(self, n):
+        """Send response bytes."""
+        data, self.out = self.out[:n], self.out[n:]
+        return data
+
+
+class RenderDriver:
+    """Plays white through mouse events and measures every frame."""
+
+    def __init__(self, pygame, server, drag_frames=6, trace=False):
+        """Init class."""
+        self.pygame = pygame
+        self.server = server
+        self.drag_frames = drag_frames
+        self.trace = trace
+        self.now = 0.0
+        self.script = deque()
+        self.tried = None
+        self.done_frames = 0
+        self.frame_start = time.perf_counter()
+        self.blits = self.surfaces = 0
+        self.times, self.blit_counts, self.surface_counts = [], [], []
+        self.requests, self.allocated = [], []
+        self.mem_start = 0
+
+    def clock(self):
+        """Virtual time advancing one frame per flip."""
+        return self.now
+
+    def tick(self, fps=0):
+        """Start frame without sleeping."""
+        self.frame_start = time.perf_counter()
+        self.blits = self.surfaces = 0
+        self.server.requests = 0
+        if self.trace:
+            tracemalloc.reset_peak()
+            self.mem_start = tracemalloc.get_traced_memory()[0]
+        return 1000 // FPS
+
+    def post(self, etype, **kw):
+        """Post event to pygame queue."""
+        self.pygame.event.post(self.pygame.event.Event(etype, **kw))
+
+    def plan(self):
+        """Queue mouse events for next white move or quit."""
+        pg, srv = self.pygame, self.server
+        mv = srv.expected
+        if mv is None:
+            self.done_frames += 1
+            if self.done_frames == FPS // 2:
+                self.script.append([(pg.QUIT, {})])
+            return
+        if srv.board.turn == chess.BLACK:
+            nxt = srv.moves[len(srv.board.move_stack) + 1:][:1]
+            if not nxt or self.tried == nxt[0] or nxt[0].promotion:
+                return
+            mv = nxt[0]
+        elif self.tried == mv:
+            self.tried = None
+            return
+        self.tried = mv
+        a, b = square_pos(mv.from_square), square_pos(mv.to_square)
+        self.script.append([(pg.MOUSEBUTTONDOWN, {"button": 1, "pos": a})])
+        for i in range(1, self.drag_frames + 1):
+            pos = (
+                a[0] + (b[0] - a[0]) * i // self.drag_frames,
+                a[1] + (b[1] - a[1]) * i // self.drag_frames,
+            )
+            self.script.append(
+                [(pg.MOUSEMOTION, {"pos": pos, "rel": (0, 0), "buttons": (1, 0, 0)})]
+            )
+        self.script.append([(pg.MOUSEBUTTONUP, {"button": 1, "pos": b})])
+        if mv.promotion and srv.board.turn == chess.WHITE:
+            self.script.extend([] for _ in range(14))
+            i = PROMO_OPTS.index(mv.promotion)
+            pos = (b[0], SQ + TOP_MARGIN + i * (SQ + PROMO_PAD) + SQ // 2)
+            self.script.append([(pg.MOUSEBUTTONDOWN, {"button": 1, "pos": pos})])
+        self.script.extend([] for _ in range(20))
+
+    def flip(self):
+        """Finish frame, record stats and feed next events."""
+        self.times.append((time.perf_counter() - self.frame_start) * 1000)
+        self.blit_counts.append(self.blits)
+        self.surface_counts.append(self.surfaces)
+        self.requests.append(self.server.requests)
+        if self.trace:
+            self.allocated.append(tracemalloc.get_traced_memory()[1] - self.mem_start)
+        self.now += 1 / FPS
+        if not self.script:
+            self.plan()
+        for etype, kw in self.script.popleft() if self.script else []:
+            self.post(etype, **kw)
+
+
+def run_render_game(pgn, args):
+    """Replay one game through play_game_pygame and return driver."""
+    import pygame
+    from chessclub.client import __main__ as client
+
+    game = chess.pgn.read_game(io.StringIO(pgn))
+    server = StubServer(list(game.mainline_moves()), args.reply_polls)
+    driver = RenderDriver(pygame, server, args.drag_frames, args.trace)
+
+    class CountingSurface(pygame.Surface):
+        def __init__(self, *a, **kw):
+            super().__init__(*a, **kw)
+            driver.surfaces += 1
+
+        def blit(self, *a, **kw):
+            driver.blits += 1
+            return super().blit(*a, **kw)
+
+    class CountingFont(pygame.font.Font):
+        def render(self, *a, **kw):
+            driver.surfaces += 1
+            return super().render(*a, **kw)
+
+    real_set_mode = pygame.display.set_mode
+
+    def set_mode(size, *a, **kw):
+        real_set_mode(size, *a, **kw)
+        return CountingSurface(size)
+
+    with ExitStack() as stack:
+        stack.enter_context(patch.object(pygame.display, "set_mode", set_mode))
+        stack.enter_context(patch.object(pygame.display, "flip", driver.flip))
+        stack.enter_context(patch.object(pygame, "Surface", CountingSurface))
+        stack.enter_context(
+            patch.object(pygame.font, "SysFont", lambda name, size, *a, **kw: CountingFont(name, size))
+        )
+        stack.enter_context(
+            patch.object(pygame.time, "Clock", lambda: SimpleNamespace(tick=driver.tick))
+        )
+        stack.enter_context(
+            patch.object(
+                client,
+                "time",
+                SimpleNamespace(time=driver.clock, monotonic=driver.clock, sleep=lambda s: None),
+            )
+        )
+        client.play_game_pygame(1, server, my_color="white", username="white")
+    if server.expected is not None:
+        raise RuntimeError(f"game stopped at ply {len(server.board.move_stack)}")
+    return driver
+
+
+def bench_render(args):
+    """Headless render benchmark of play_game_pygame."""
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    if args.trace:
+        tracemalloc.start()
+    times, blits, surfaces, requests, allocated = [], [], [], [], []
+    for _ in range(args.repeat):
+        for pgn in GAMES:
+            d = run_render_game(pgn, args)
+            times += d.times
+            blits += d.blit_counts
+            surfaces += d.surface_counts
+            requests += d.requests
+            allocated += d.allocated
+    times.sort()
+    frames = len(times)
+    print(f"games: {len(GAMES) * args.repeat}, frames: {frames}")
+    print(
+        "frame ms: p50 {:.2f}  p90 {:.2f}  p99 {:.2f}  max {:.2f}".format(
+            percentile(times, 50), percentile(times, 90), percentile(times, 99), times[-1]
+        )
+    )
+    print(f"blits/frame: {sum(blits) / frames:.1f}  max {max(blits)}")
+    print(f"surface allocations/frame: {sum(surfaces) / frames:.2f}  max {max(surfaces)}")
+    print(f"server requests/frame: {sum(requests) / frames:.2f}")
+    if allocated:
+        print(f"python KiB allocated/frame: {sum(allocated) / frames / 1024:.1f}")
+
+
+def sample_positions():
+    """Positions (FEN) of every benchmark game."""
+    fens = []
+    for pgn in GAMES:
+        board = chess.Board()
+        for mv in chess.pgn.read_game(io.StringIO(pgn)).mainline_moves():
+            board.push(mv)
+            if not board.is_game_over():
+                fens.append(board.fen())
+    return fens
+
+
+def bench_engine(args):
+    """Analyses per second of EnginePool for several worker counts."""
+    from chessclub.server.engine import EnginePool
+
+    fens = sample_positions()
+    jobs = [(i % args.tables, fens[i % len(fens)]) for i in range(args.analyses)]
+
+    async def run(pool):
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(pool.submit(key, fen, movetime=60, nodes=args.nodes) for key, fen in jobs)
+        )
+        return time.perf_counter() - started, sum(r["nodes"] for r in results)
+
+    print(f"analyses: {len(jobs)}, tables: {args.tables}, nodes per analysis: {args.nodes}")
+    base = None
+    for workers in args.workers:
+        pool = EnginePool(workers, max_movetime=60, max_nodes=args.nodes)
+        try:
+            elapsed, nodes = asyncio.run(run(pool))
+        finally:
+            pool.close()
+        rate = len(jobs) / elapsed
+        base = base or rate
+        print(
+            f"workers {workers:3d}: {rate:8.1f} analyses/s  {nodes / elapsed:10.0f} nodes/s"
+            f"  speedup x{rate / base:.2f}"
+        )
+
+
+class DictTable:
+    """Table as it was before slots: own board with move stack."""
+
+    def __init__(self, tid, white=None, black=None):
+        """Init class."""
+        self.id, self.white, self.black, self.bot = tid, white, black, None
+        self.board = chess.Board()
+        self.spectators = []
+        self.active_players = set()
+
+    def push(self, mv):
+        """Make move."""
+        self.board.push(mv)
+
+
+def table_bytes(make, count, moves):
+    """Traced bytes per table for count tables with moves played."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tables = []
+    for tid in range(count):
+        t = make(tid, "white", "black")
+        for mv in moves:
+            t.push(mv)
+        tables.append(t)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / count
+
+
+def bench_tables(args):
+    """Memory per idle and per active server table."""
+    from chessclub.server.__main__ import Table
+
+    moves = list(chess.pgn.read_game(io.StringIO(GAMES[1])).mainline_moves())[: args.plies]
+    print(f"tables: {args.tables}, plies per active table: {len(moves)}")
+    for name, make in (("dict + board stack", DictTable), ("slots + packed moves", Table)):
+        idle = table_bytes(make, args.tables, [])
+        active = table_bytes(make, args.tables, moves)
+        print(
+            f"{name:22s} idle {idle:7.0f} B/table  active {active:7.0f} B/table"
+            f"  ({active * args.tables / 2**20:.1f} MiB active)"
+        )
+
+
+def bench_seek(args):
+    """Matchmaking cost and waiting time with many players seeking at once."""
+    import random
+
+    from chessclub.server.matchmaking import Matchmaker
+
+    rng = random.Random(args.seed)
+    now = [0.0]
+    mm = Matchmaker(clock=lambda: now[0])
+    controls = ["1+0", "3+2", "5+0", "15+10"][: args.controls]
+    costs, waits = [], []
+    for i in range(args.players):
+        rating = min(max(rng.gauss(1500, 300), 100), 3000)
+        started = time.perf_counter()
+        s, opponent = mm.seek(i, rating, rng.choice(controls))
+        costs.append((time.perf_counter() - started) * 1e6)
+        if opponent is not None:
+            waits += [0.0, 0.0]
+    immediate = len(waits)
+    sweeps = []
+    while mm.seeks and now[0] < args.max_wait:
+        now[0] += 1.0
+        started = time.perf_counter()
+        pairs = mm.sweep()
+        sweeps.append((time.perf_counter() - started) * 1e3)
+        waits += [now[0] - s.since for pair in pairs for s in pair]
+    costs.sort()
+    waits.sort()
+    sweeps.sort()
+    print(f"players: {args.players}, time controls: {len(controls)}")
+    print(
+        "seek us: p50 {:.1f}  p99 {:.1f}  max {:.1f}".format(
+            percentile(costs, 50), percentile(costs, 99), costs[-1]
+        )
+    )
+    print(f"paired on arrival: {immediate}, paired later: {len(waits) - immediate}, unmatched: {len(mm)}")
+    print(
+        "wait s: p50 {:.0f}  p90 {:.0f}  p99 {:.0f}".format(
+            percentile(waits, 50), percentile(waits, 90), percentile(waits, 99)
+        )
+    )
+    if sweeps:
+        print(f"sweep ms: p50 {percentile(sweeps, 50):.2f}  max {sweeps[-1]:.2f}  ({len(sweeps)} sweeps)")
+
+
+def bench_tournament(args):
+    """Games per second of bot tournament for several worker counts."""
+    from chessclub.server.__main__ import ChessServer
+    from chessclub.server.tournament import Tournament
+
+    players = [f"bot{i}" for i in range(args.players)]
+    print(f"players: {args.players}, system: {args.system}, kind: {args.kind}")
+    base = None
+    for workers in args.workers:
+        server = ChessServer()
+        tour = Tournament(server, players, args.system, args.rounds, args.kind, workers, seed=args.seed)
+        asyncio.run(tour.run())
+        rate = tour.rate()
+        base = base or rate
+        print(
+            f"workers {workers:3d}: {tour.games} games  {rate:8.1f} games/s"
+            f"  {len(server.archive.cols['moves']) / (tour.finished - tour.started):10.0f} plies/s"
+            f"  speedup x{rate / base:.2f}"
+        )
+
+
+async def load_client(port, name, requests, latencies, limited):
+    """Register, open table and time get_board round trips; count rate limited ones."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+    async def call(cmd):
+        data = pickle.dumps(cmd)
+        writer.write(len(data).to_bytes(4, "big") + data)
+        size = int.from_bytes(await reader.readexactly(4), "big")
+        return pickle.loads(await reader.readexactly(size))
+
+    await call({"action": "register", "name": name})
+    tid = (await call({"action": "createtable", "color": "white"}))["data"]["table_id"]
+    for _ in range(requests):
+        started = time.perf_counter()
+        if (await call({"action": "get_board", "table_id": tid})).get("limited"):
+            limited.append(name)
+        latencies.append((time.perf_counter() - started) * 1e6)
+    writer.close()
+
+
+async def load_run(port, clients, requests):
+    """Run concurrent clients, return (seconds, sorted latencies, rate limited replies)."""
+    latencies, limited = [], []
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(load_client(port, f"load{i}", requests, latencies, limited) for i in range(clients))
+    )
+    return time.perf_counter() - started, sorted(latencies), len(limited)
+
+
+def bench_load(args):
+    """Requests per second of real server process for each event loop."""
+    print(f"clients: {args.clients}, requests per client: {args.requests}")
+    for loop in args.loops:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        server = subprocess.Popen(
+            [sys.executable, "-m", "chessclub.server", "--host", "127.0.0.1", "--port", str(port),
+             "--loop", loop, "--backlog", str(max(args.clients, 128)),
+             *([] if args.rate_limit else ["--no-rate-limit"])],
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            for _ in range(100):
+                try:
+                    socket.create_connection(("127.0.0.1", port)).close()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+            seconds, latencies, limited = asyncio.run(load_run(port, args.clients, args.requests))
+        finally:
+            server.terminate()
+            server.wait()
+        label = loop if loop == "asyncio" or importlib.util.find_spec(loop) else f"{loop} (missing, asyncio)"
+        print(
+            f"{label:24s} {len(latencies) / seconds:9.0f} req/s"
+            f"  p50 {percentile(latencies, 50):6.0f} us  p99 {percentile(latencies, 99):6.0f} us"
+            f"  rate limited {limited}"
+        )
+
+
+def bench_compress(args):
+    """Frame sizes and codec cost for list_tables replies of growing lobbies."""
+    import zlib
+
+    from chessclub.protocol.compression import CODECS, ZlibCodec
+
+    class PlainZlib(ZlibCodec):
+        """Deflate without the preset dictionary."""
+
+        name = "zlib, no dict"
+
+        def compress(self, data):
+            return zlib.compress(data, self.level)
+
+    codecs = [PlainZlib(), *(make() for make in CODECS.values())]
+    for tables in args.tables:
+        data = [
+            {
+                "id": i,
+                "white": f"player{i}",
+                "black": f"player{i + 1}" if i % 3 else None,
+                "in_game": bool(i % 3),
+                "active_players": [f"player{i}"],
+            }
+            for i in range(1, tables + 1)
+        ]
+        payload = pickle.dumps({"status": "ok", "msg": None, "data": data})
+        print(f"list_tables, {tables} tables: {len(payload)} B raw")
+        for codec in codecs:
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                packed = codec.compress(payload)
+            spent = (time.perf_counter() - started) / args.repeat
+            line = (
+                f"  {codec.name:14s} {len(packed):8d} B  x{len(payload) / len(packed):5.1f}"
+                f"  compress {spent * 1e6:8.1f} us"
+            )
+            if not isinstance(codec, PlainZlib):
+                started = time.perf_counter()
+                for _ in range(args.repeat):
+                    codec.decompress(packed)
+                line += f"  decompress {(time.perf_counter() - started) / args.repeat * 1e6:7.1f} us"
+            print(line)
+
+
+def main(argv=None):
+    """Run benchmark chosen on command line."""
+    parser = argparse.ArgumentParser(prog="python3 -m chessclub.tests.benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("render", help="headless play_game_pygame frame benchmark")
+    p.add_argument("--repeat", type=int, default=1, help="replay game set N times")
+    p.add_argument("--reply-polls", type=int, default=2, help="polls before stub replies")
+    p.add_argument("--drag-frames", type=int, default=6, help="frames per drag")
+    p.add_argument("--trace", action="store_true", help="trace python allocations")
+    p.set_defaults(func=bench_render)
+
+    p = sub.add_parser("engine", help="engine pool analyses per second")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--analyses", type=int, default=200)
+    p.add_argument("--tables", type=int, default=50, help="distinct queue keys")
+    p.add_argument("--nodes", type=int, default=3000, help="node budget per analysis")
+    p.set_defaults(func=bench_engine)
+
+    p = sub.add_parser("tables", help="memory per idle and active server table")
+    p.add_argument("--tables", type=int, default=100_000)
+    p.add_argument("--plies", type=int, default=20, help="moves played on active tables")
+    p.set_defaults(func=bench_tables)
+
+    p = sub.add_parser("seek", help="matchmaking latency with many queued players")
+    p.add_argument("--players", type=int, default=50_000)
+    p.add_argument("--controls", type=int, default=4, help="distinct time controls (1-4)")
+    p.add_argument("--max-wait", type=float, default=60, help="virtual seconds to sweep")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_seek)
+
+    p = sub.add_parser("tournament", help="bot tournament games per second")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--players", type=int, default=64)
+    p.add_argument("--system", choices=["round-robin", "swiss"], default="round-robin")
+    p.add_argument("--rounds", type=int, default=None)
+    p.add_argument("--kind", choices=["random", "engine"], default="random")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_tournament)
+
+    p = sub.add_parser("load", help="server round trips per second for each event loop")
+    p.add_argument("--loops", nargs="+", default=["asyncio", "uvloop"])
+    p.add_argument("--clients", type=int, default=100)
+    p.add_argument("--requests", type=int, default=200, help="round trips per client")
+    p.add_argument("--rate-limit", action="store_true", help="keep server rate limits on")
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser("compress", help="frame compression ratio and cost per codec")
+    p.add_argument("--tables", type=int, nargs="+", default=[1, 10, 100, 1000])
+    p.add_argument("--repeat", type=int, default=200)
+    p.set_defaults(func=bench_compress)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+"""Прогон настоящего сервера случайными действиями многих клиентов.
+
+Использование: python3 -m chessclub.tests.soak [--seed N] [--clients N] [--steps N] [--batch N] [--rate-limit]
+
+Все решения принимает один генератор с заданным seed. На каждом шаге он
+выбирает группу клиентов и их действия над разными столами; группа
+выполняется параллельно по настоящим соединениям, после чего состояние
+сервера сверяется с моделью. Один и тот же seed даёт тот же журнал
+запросов и ответов, его хэш печатается в конце. С --rate-limit сервер
+работает со своими ограничениями, а отклонённые запросы повторяются.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import pickle
+import random
+import sys
+import time
+from collections import Counter
+
+import chess
+
+from chessclub.server.__main__ import REPETITIONS, SEVENTY_FIVE_MOVES, ChessServer
+from chessclub.server.archive import decode_move
+
+WEIGHTS = {
+    "create": 3,
+    "join": 5,
+    "move": 30,
+    "illegal": 1,
+    "leave": 2,
+    "disconnect": 1,
+    "resume": 1,
+    "list": 2,
+}
+# Sessions of dropped clients must outlive the run.
+GRACE = 3600.0
+# Table moves are replayed from the start every this many steps.
+DEEP_CHECK = 10
+# Pause before a request refused by the rate limiter is sent again.
+LIMIT_BACKOFF = 0.05
+
+
+class SoakError(AssertionError):
+    """Server state or reply differs from the model."""
+
+
+def outcome(board):
+    """Result and reason the server must declare, from a board with full move stack."""
+    if board.is_checkmate():
+        return ("0-1" if board.turn == chess.WHITE else "1-0"), "checkmate"
+    if board.is_stalemate():
+        return "1/2-1/2", "stalemate"
+    if board.is_insufficient_material():
+        return "1/2-1/2", "insufficient_material"
+    if board.halfmove_clock >= SEVENTY_FIVE_MOVES:
+        return "1/2-1/2", "seventyfive_moves"
+    if board.is_repetition(REPETITIONS):
+        return "1/2-1/2", "fivefold_repetition"
+    return None
+
+
+class ModelTable:
+    """Expected state of one table."""
+
+    __slots__ = ("white", "black", "board", "result")
+
+    def __init__(self, white=None, black=None):
+        """Init class."""
+        self.white = white
+        self.black = black
+        self.board = chess.Board()
+        self.result = None
+
+
+class Client:
+    """Connection and expected seat of one simulated player."""
+
+    __slots__ = ("name", "conn", "token", "seat")
+
+    def __init__(self, name):
+        """Init class."""
+        self.name = name
+        self.conn = None
+        self.token = None
+        self.seat = None
+
+
+class Soak:
+    """Seeded random clients against one server with a model to check it."""
+
+    def __init__(self, server, address, seed, clients=20, batch=8):
+        """Init class."""
+        self.server = server
+        self.address = address
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.batch = batch
+        self.clients = [Client(f"p{i}") for i in range(clients)]
+        self.tables = {}
+        self.step = 0
+        self.requests = 0
+        self.limited = 0
+        self.busy_time = 0.0
+        self.archived = 0
+        self.created = 0
+        self.results = Counter()
+        self.trace = hashlib.blake2b(digest_size=16)
+        self.log = None
+
+    def fail(self, msg):
+        """Stop run with position in schedule."""
+        raise SoakError(f"seed {self.seed}, step {self.step}: {msg}")
+
+    def record(self, *entry):
+        """Add entry to trace."""
+        line = repr(entry)
+        self.trace.update(line.encode() + b"\n")
+        if self.log is not None:
+            self.log.write(line + "\n")
+
+    async def request(self, client, cmd):
+        """Send request of client and read reply."""
+        reader, writer = client.conn
+        data = pickle.dumps(cmd)
+        while True:
+            writer.write(len(data).to_bytes(4, "big") + data)
+            await writer.drain()
+            size = int.from_bytes(await reader.readexactly(4), "big")
+            self.requests += 1
+            resp = pickle.loads(await reader.readexactly(size))
+            if not resp.get("limited"):
+                return resp
+            # Retries stay out of the trace, so it does not depend on timing.
+            self.limited += 1
+            await asyncio.sleep(LIMIT_BACKOFF)
+
+    async def start(self):
+        """Connect and register all clients."""
+        for c in self.clients:
+            c.conn = await asyncio.open_connection(*self.address)
+            resp = await self.request(c, {"action": "register", "name": c.name})
+            if resp["status"] != "ok":
+                self.fail(f"register {c.name}: {resp['msg']}")
+            c.token = resp["data"]["token"]
+
+    def free_tables(self, busy):
+        """Ids of tables with a free seat not touched in this step."""
+        return [
+            tid for tid, t in sorted(self.tables.items())
+            if tid not in busy and t.result is None and (t.white is None or t.black is None)
+        ]
+
+    def options(self, c, busy):
+        """Actions client can take without touching what others in the step do."""
+        if c.conn is None:
+            return ["resume"]
+        opts = ["disconnect"]
+        # Creating and closing tables changes ids the others see.
+        lobby = "lobby" not in busy
+        if lobby:
+            opts.append("list")
+        if c.seat is None:
+            if lobby:
+                opts.append("create")
+            if self.free_tables(busy):
+                opts.append("join")
+        elif c.seat[0] not in busy:
+            tid, color = c.seat
+            t = self.tables[tid]
+            if lobby:
+                opts.append("leave")
+            if t.result is None and t.board.turn == (color == "white"):
+                opts += ["move", "illegal"]
+        return opts
+
+    def plan(self):
+        """Clients, actions and arguments of next step; no two touch the same table."""
+        busy, step = set(), []
+        for c in self.rng.sample(self.clients, min(self.batch, len(self.clients))):
+            opts = self.options(c, busy)
+            op = self.rng.choices(opts, [WEIGHTS[o] for o in opts])[0]
+            arg = None
+            if op == "create":
+                arg = self.rng.choice(["white", "black"])
+                busy.add("lobby")
+            elif op == "join":
+                arg = self.rng.choice(self.free_tables(busy))
+                busy.add(arg)
+            elif op == "move":
+                board = self.tables[c.seat[0]].board
+                arg = self.rng.choice(sorted(mv.uci() for mv in board.legal_moves))
+                busy.add(c.seat[0])
+            elif op == "illegal":
+                legal = {mv.uci() for mv in self.tables[c.seat[0]].board.legal_moves}
+                while arg is None or arg in legal:
+                    arg = chess.square_name(self.rng.randrange(64)) + chess.square_name(self.rng.randrange(64))
+                busy.add(c.seat[0])
+            elif op in ("leave", "list"):
+                busy.add("lobby")
+                if op == "leave":
+                    busy.add(c.seat[0])
+            step.append((c, op, arg))
+        return step
+
+    async def perform(self, c, op, arg):
+        """Run action over client's connection, return reply."""
+        if op == "disconnect":
+            c.conn[1].close()
+            await c.conn[1].wait_closed()
+            c.conn = None
+            return None
+        if op == "resume":
+            c.conn = await asyncio.open_connection(*self.address)
+            return await self.request(c, {"action": "resume", "token": c.token})
+        if op == "create":
+            cmd = {"action": "createtable", "color": arg}
+        elif op == "join":
+            cmd = {"action": "join", "table_id": arg}
+        elif op in ("move", "illegal"):
+            cmd = {"action": "move", "table_id": c.seat[0], "uci": arg}
+        elif op == "leave":
+            cmd = {"action": "leave", "table_id": c.seat[0], "color": c.seat[1], "user": c.name}
+        else:
+            cmd = {"action": "list_tables"}
+        return await self.request(c, cmd)
+
+    def expect_ok(self, c, op, resp):
+        """Fail unless request succeeded."""
+        if resp["status"] != "ok":
+            self.fail(f"{c.name} {op}: {resp['msg']}")
+
+    def apply(self, c, op, arg, resp):
+        """Check reply against model and update model."""
+        self.record(self.step, c.name, op, arg, resp and resp["status"], resp and resp["msg"])
+        if op == "disconnect":
+            return
+        if op == "illegal":
+            if resp["msg"] != "SERVER:: Illegal move":
+                self.fail(f"{c.name} illegal {arg} answered {resp['msg']}")
+            return
+        self.expect_ok(c, op, resp)
+        if op == "resume":
+            if resp["data"]["table_id"] != (c.seat and c.seat[0]):
+                self.fail(f"{c.name} resumed at {resp['data']['table_id']}, seated at {c.seat}")
+        elif op == "list":
+            ids = [t["id"] for t in resp["data"]]
+            if sorted(ids) != sorted(self.tables):
+                self.fail(f"lobby lists {sorted(ids)}, expected {sorted(self.tables)}")
+        elif op == "create":
+            tid = 1
+            while tid in self.tables:
+                tid += 1
+            if resp["data"]["table_id"] != tid:
+                self.fail(f"table {resp['data']['table_id']} created, expected smallest free id {tid}")
+            self.tables[tid] = ModelTable(**{arg: c.name})
+            c.seat = (tid, arg)
+            self.created += 1
+        elif op == "join":
+            t = self.tables[arg]
+            color = "white" if t.white is None else "black"
+            if resp["data"]["color"] != color:
+                self.fail(f"{c.name} joined {arg} as {resp['data']['color']}, expected {color}")
+            setattr(t, color, c.name)
+            c.seat = (arg, color)
+        elif op == "move":
+            t = self.tables[c.seat[0]]
+            t.board.push_uci(arg)
+            t.result = outcome(t.board)
+            got = resp["data"] and (resp["data"]["result"], resp["data"]["reason"])
+            if got != t.result:
+                self.fail(f"move {arg} at {c.seat[0]} ended game as {got}, expected {t.result}")
+            if t.result is not None:
+                self.archived += 1
+                self.results[t.result[1]] += 1
+        elif op == "leave":
+            tid, color = c.seat
+            t = self.tables[tid]
+            setattr(t, color, None)
+            c.seat = None
+            if t.white is None and t.black is None:
+                del self.tables[tid]
+                if t.result is None and t.board.move_stack:
+                    self.archived += 1
+
+    def check(self, deep=False):
+        """Compare server state with model: tables, seats, positions, archive."""
+        server = self.server
+        if set(server.tables) != set(self.tables):
+            self.fail(f"server tables {sorted(server.tables)}, expected {sorted(self.tables)}")
+        seats = {}
+        for tid, t in server.tables.items():
+            m = self.tables[tid]
+            if t.white is None and t.black is None:
+                self.fail(f"orphan table {tid}")
+            if (t.white, t.black) != (m.white, m.black):
+                self.fail(f"table {tid} seats {t.white}/{t.black}, expected {m.white}/{m.black}")
+            for color, name in (("white", t.white), ("black", t.black)):
+                if name is not None:
+                    if name in seats:
+                        self.fail(f"{name} seated at {seats[name][0]} and {tid}")
+                    seats[name] = (tid, color)
+            if t.position.fen() != m.board.fen():
+                self.fail(f"table {tid} at {t.position.fen()}, expected {m.board.fen()}")
+            if (t.result and (t.result["result"], t.result["reason"])) != m.result:
+                self.fail(f"table {tid} result {t.result}, expected {m.result}")
+            if deep:
+                board = chess.Board()
+                for ply, code in enumerate(t.moves, 1):
+                    mv = decode_move(code)
+                    if mv not in board.legal_moves:
+                        self.fail(f"table {tid} ply {ply}: illegal {mv.uci()} in move list")
+                    board.push(mv)
+                if board.fen() != m.board.fen():
+                    self.fail(f"table {tid} moves lead to {board.fen()}")
+        for c in self.clients:
+            if c.name not in server.users:
+                self.fail(f"session of {c.name} lost")
+            if seats.get(c.name) != c.seat:
+                self.fail(f"{c.name} seated at {seats.get(c.name)}, expected {c.seat}")
+        if len(server.archive) != self.archived:
+            self.fail(f"{len(server.archive)} games archived, expected {self.archived}")
+
+    async def run_step(self, step):
+        """Run actions of step concurrently, then check replies in plan order."""
+        started = time.perf_counter()
+        replies = await asyncio.gather(*(self.perform(c, op, arg) for c, op, arg in step))
+        self.busy_time += time.perf_counter() - started
+        for (c, op, arg), resp in zip(step, replies):
+            self.apply(c, op, arg, resp)
+
+    async def run(self, steps):
+        """Run steps random steps, then let every client leave and disconnect."""
+        await self.start()
+        for _step in range(steps):
+            self.step += 1
+            await self.run_step(self.plan())
+            self.check(deep=self.step % DEEP_CHECK == 0)
+        self.step += 1
+        await self.run_step([(c, "resume", None) for c in self.clients if c.conn is None])
+        await self.run_step([(c, "leave", None) for c in self.clients if c.seat is not None])
+        self.check(deep=True)
+        if self.server.tables:
+            self.fail(f"tables left after everybody left: {sorted(self.server.tables)}")
+        await self.run_step([(c, "disconnect", None) for c in self.clients])
+
+    def report(self):
+        """Counters of the run."""
+        return {
+            "seed": self.seed,
+            "steps": self.step,
+            "requests": self.requests,
+            "limited": self.limited,
+            "seconds": self.busy_time,
+            "tables": self.created,
+            "archived": self.archived,
+            "results": dict(self.results),
+            "trace": self.trace.hexdigest(),
+        }
+
+
+async def soak(seed, clients=20, steps=500, batch=8, log=None, rate_limit=False):
+    """Run seeded soak against fresh in-process server over loopback, return report."""
+    server = ChessServer(grace=GRACE)
+    if not rate_limit:
+        server.limiter = None
+    srv = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+    run = Soak(server, srv.sockets[0].getsockname()[:2], seed, clients, batch)
+    run.log = log
+    try:
+        await run.run(steps)
+    finally:
+        srv.close()
+        await srv.wait_closed()
+        for task in list(server.tasks):
+            task.cancel()
+    return run.report()
+
+
+def main(argv=None):
+    """Run soak from command line, exit with 1 on broken invariant."""
+    parser = argparse.ArgumentParser(prog="python3 -m chessclub.tests.soak")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--steps", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=16, help="clients acting concurrently per step")
+    parser.add_argument("--log", default=None, help="write trace of requests and replies to file")
+    parser.add_argument("--rate-limit", action="store_true", help="keep server rate limits on")
+    args = parser.parse_args(argv)
+    log = open(args.log, "w", encoding="utf-8") if args.log else None
+    try:
+        report = asyncio.run(soak(args.seed, args.clients, args.steps, args.batch, log, args.rate_limit))
+    except SoakError as e:
+        print(f"FAILED: {e}")
+        sys.exit(1)
+    finally:
+        if log is not None:
+            log.close()
+    print(f"seed {report['seed']}: {report['steps']} steps, {args.clients} clients, batch {args.batch}")
+    print(
+        f"{report['requests']} requests in {report['seconds']:.2f} s"
+        f" ({report['requests'] / report['seconds']:.0f} req/s, {report['limited']} rate limited)"
+    )
+    results = ", ".join(f"{k} {v}" for k, v in sorted(report["results"].items())) or "none"
+    print(f"tables {report['tables']}, games archived {report['archived']}, results: {results}")
+    print(f"trace {report['trace']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,136 @@
 """Юнит тестирование."""
 
+import asyncio
+import contextlib
+import io
+import os
+import pickle
+import random
+import socket
+import struct
+import tempfile
 import unittest
+import chess
+import chess.polyglot
 from unittest.mock import MagicMock, patch
 
-from chessclub.server.__main__ import Player, Table
+from concurrent.futures import ThreadPoolExecutor
+
+from chessclub.server.__main__ import Player, Table, ChessServer, HANDLERS, START_BOARD
+from chessclub.server.engine import EnginePool, analyse
+from chessclub.server.cache import PositionCache
+from chessclub.server.book import OpeningBook
+from chessclub.server.archive import GameArchive, decode_move, encode_move
+from chessclub.server.stats import OpeningIndex
+from chessclub.importer.__main__ import import_pgn, split_games
+from chessclub.server.matchmaking import Matchmaker, elo
+from chessclub.server.tournament import Tournament, round_robin, swiss_round
+from chessclub.server.handoff import listen, take_over
+from chessclub.server.net import KEEPALIVE_IDLE, loop_factory, run_on, tune_socket
+from chessclub.server.ratelimit import RateLimiter
+from chessclub.server.telemetry import LagLog
+from chessclub.server.cluster import Cluster, LocalBus, LocalHub
+from chessclub.tests.soak import soak
+from chessclub.protocol.compression import COMPRESSED, ZlibCodec, pack, unpack
 from chessclub.client.__main__ import (
     get_table_info,
+    send_recv,
+    LIMIT_RETRIES,
     _,
     ChessCmd,
+    TextCache,
+    TEXT_CACHE,
+    find_move,
+    premove_board,
+    TableIdCache,
+    Replay,
 )
 
 
+async def read_frame(reader):
+    """Прочитать один кадр от сервера."""
+    size = int.from_bytes(await reader.readexactly(4), "big")
+    return pickle.loads(await reader.readexactly(size))
+
+
+async def request(conn, cmd):
+    """Отправить запрос серверу и дождаться ответа."""
+    reader, writer = conn
+    data = pickle.dumps(cmd)
+    writer.write(len(data).to_bytes(4, "big") + data)
+    await writer.drain()
+    return await read_frame(reader)
+
+
+async def until(cond, timeout=2.0):
+    """Дождаться, пока условие станет истинным, не дольше timeout секунд."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not cond():
+        if loop.time() > deadline:
+            raise AssertionError("Условие не выполнилось за {} с".format(timeout))
+        await asyncio.sleep(0.005)
+
+
+class Harness:
+    """Сервер на свободном порту и открытые к нему соединения."""
+
+    def __init__(self, server):
+        """Запомнить сервер, обработчики соединений ищутся по адресу клиента."""
+        self.server = server
+        self.srv = None
+        self.handlers = {}
+        self.conns = []
+
+    @property
+    def address(self):
+        """Адрес, на котором слушает сервер."""
+        return self.srv.sockets[0].getsockname()[:2]
+
+    async def handle(self, reader, writer):
+        """Обслужить соединение и отметить, что сервер его отпустил."""
+        peer = writer.get_extra_info("peername")
+        self.handlers[peer] = asyncio.current_task()
+        try:
+            await self.server.handle(reader, writer)
+        finally:
+            del self.handlers[peer]
+
+    async def connect(self):
+        """Открыть соединение и дождаться, пока сервер его примет."""
+        conn = await asyncio.open_connection(*self.address)
+        peer = conn[1].get_extra_info("sockname")
+        self.conns.append(conn)
+        await until(lambda: peer in self.handlers)
+        return conn
+
+    async def drop(self, conn):
+        """Закрыть соединение и дождаться, пока сервер его отпустит."""
+        peer = conn[1].get_extra_info("sockname")
+        conn[1].close()
+        await until(lambda: peer not in self.handlers)
+
+
+@contextlib.asynccontextmanager
+async def running_server(server=None, sock=None, **opts):
+    """Запустить сервер на свободном порту, по выходе закрыть соединения и задачи."""
+    harness = Harness(ChessServer(**opts) if server is None else server)
+    if sock is None:
+        harness.srv = await asyncio.start_server(harness.handle, "127.0.0.1", 0)
+    else:
+        harness.srv = await asyncio.start_server(harness.handle, sock=sock)
+    try:
+        yield harness
+    finally:
+        for reader, writer in harness.conns:
+            writer.close()
+        await until(lambda: not harness.handlers)
+        harness.srv.close()
+        await harness.srv.wait_closed()
+        for task in list(harness.server.tasks):
+            task.cancel()
+
+
 class TestChessProject(unittest.TestCase):
     """Набор юнит тестов."""
 
@@ -38,20 +158,69 @@ class TestChessProject(unittest.TestCase):
         t.active_players.update({"vasya", "petya"})
         self.assertSetEqual(t.active_players, {"vasya", "petya"})
 
+    def test_idle_tables_share_start_board_and_keep_move_codes(self):
+        """Столы без ходов читают общий START_BOARD, ходы хранятся кодами и восстанавливаются."""
+        a, b = Table(1), Table(2)
+        self.assertIs(a.position, START_BOARD)
+        self.assertIs(b.position, START_BOARD)
+        moves = [chess.Move.from_uci(uci) for uci in ("e2e4", "d7d5", "e4d5", "g8f6")]
+        for mv in moves:
+            a.push(mv)
+        self.assertIsNot(a.position, START_BOARD)
+        self.assertIs(b.position, START_BOARD)
+        self.assertEqual(START_BOARD.fen(), chess.STARTING_FEN)
+        self.assertEqual(START_BOARD.move_stack, [])
+        self.assertEqual(list(a.moves), [encode_move(mv) for mv in moves])
+        self.assertEqual(a.history(), moves)
+        self.assertEqual(a.position.move_stack, [])
+        replay = chess.Board()
+        for mv in a.history():
+            replay.push(mv)
+        self.assertEqual(replay.fen(), a.position.fen())
+        promotion = chess.Move.from_uci("a7a8n")
+        self.assertEqual(decode_move(encode_move(promotion)), promotion)
+
     def test_get_table_info(self):
-        """get_table_info возвращает нужную запись стола или None."""
+        """get_table_info запрашивает один стол и возвращает None при ошибке или ограничении."""
         fake_sock = MagicMock()
 
         with patch("chessclub.client.__main__.send_recv") as mock_send_recv:
-            mock_send_recv.return_value = {
-                "data": [
-                    {"id": 1, "white": "a", "black": "b"},
-                    {"id": 2, "white": None, "black": "c"},
-                ]
-            }
-
+            mock_send_recv.return_value = {"status": "ok", "data": {"id": 1, "white": "a", "black": "b"}}
             self.assertEqual(get_table_info(fake_sock, 1)["id"], 1)
+            mock_send_recv.assert_called_with(fake_sock, {"action": "table_info", "table_id": 1})
+
+            mock_send_recv.return_value = {"status": "err", "msg": "SERVER:: No such table", "data": None}
             self.assertIsNone(get_table_info(fake_sock, 99))
+            mock_send_recv.return_value = {"status": "err", "msg": "slow down", "data": None, "limited": True}
+            self.assertIsNone(get_table_info(fake_sock, 1))
+
+    def test_send_recv_retries_rate_limited_requests(self):
+        """Отклонённый ограничителем запрос повторяется, пока попытки не кончатся."""
+        limited = {"status": "err", "msg": "SERVER:: Too many requests, slow down", "data": None, "limited": True}
+
+        class ScriptedSock:
+            def __init__(self, replies):
+                self.replies = [pickle.dumps(r) for r in replies]
+                self.sent = 0
+                self.out = b""
+
+            def sendall(self, data):
+                self.sent += 1
+                reply = self.replies.pop(0)
+                self.out += len(reply).to_bytes(4, "big") + reply
+
+            def recv(self, n):
+                data, self.out = self.out[:n], self.out[n:]
+                return data
+
+        with patch("chessclub.client.__main__.LIMIT_BACKOFF", 0):
+            sock = ScriptedSock([limited, limited, {"status": "ok", "msg": None, "data": []}])
+            self.assertEqual(send_recv(sock, {"action": "list_tables"})["status"], "ok")
+            self.assertEqual(sock.sent, 3)
+
+            sock = ScriptedSock([limited] * (LIMIT_RETRIES + 1))
+            self.assertTrue(send_recv(sock, {"action": "list_tables"})["limited"])
+            self.assertEqual(sock.sent, LIMIT_RETRIES + 1)
 
     def test_complete_createtable_space_then_tab(self):
         """После 'createtable ' (с пробелом) автодополнение предлагает 'as'."""
@@ -87,6 +256,849 @@ class TestChessProject(unittest.TestCase):
                 },
             )
 
+    def test_text_cache_renders_once_and_is_bounded(self):
+        """Кэш TextCache рендерит строку один раз и не растёт сверх maxsize."""
+        cache = TextCache(maxsize=2)
+        font = MagicMock()
+
+        first = cache.text(font, "Пат. Ничья", (255, 255, 255), "en_US.UTF-8")
+        again = cache.text(font, "Пат. Ничья", (255, 255, 255), "en_US.UTF-8")
+        self.assertIs(first, again)
+        font.render.assert_called_once_with("Stalemate. Draw", True, (255, 255, 255))
+
+        cache.text(font, "vasya", (0, 0, 0))
+        cache.text(font, "petya", (0, 0, 0))
+        self.assertEqual(len(cache.items), 2)
+
+        cache.set_names(("vasya", "petya"))
+        self.assertEqual(len(cache.items), 0)
+
+    def test_switchlocale_clears_text_cache(self):
+        """Смена локали сбрасывает кэш отрисованных надписей."""
+        with patch("chessclub.client.__main__.send_recv") as mock_send_recv:
+            mock_send_recv.return_value = {"status": "ok", "msg": "ok"}
+            cmd = ChessCmd("petya", sock=MagicMock())
+
+            TEXT_CACHE.get("key", MagicMock)
+            cmd.do_switchlocale("")
+            self.assertEqual(cmd.locale, "en_US.UTF-8")
+            self.assertNotIn("key", TEXT_CACHE.items)
+
+    def test_premove_queue_applies_on_own_side(self):
+        """Предходы проверяются на доске, где ход у игрока, с учётом очереди."""
+        board = chess.Board()
+        board.push_uci("e2e4")
+
+        pb = premove_board(board, chess.WHITE, [])
+        first = find_move(pb.pseudo_legal_moves, chess.D2, chess.D4)
+        self.assertEqual(first, chess.Move.from_uci("d2d4"))
+
+        pb = premove_board(board, chess.WHITE, [first])
+        self.assertEqual(pb.turn, chess.WHITE)
+        self.assertIsNotNone(find_move(pb.pseudo_legal_moves, chess.D4, chess.D5))
+        self.assertIsNone(find_move(pb.pseudo_legal_moves, chess.D2, chess.D4))
+        self.assertEqual(board.turn, chess.BLACK)
+
+    def test_lobby_events_are_pushed_to_subscribers(self):
+        """Сервер сам оповещает создателя стола о входе и выходе соперника."""
+
+        async def scenario():
+            async with running_server() as env:
+                host = await env.connect()
+                guest = await env.connect()
+                events = await env.connect()
+                await request(host, {"action": "register", "name": "vasya"})
+                await request(guest, {"action": "register", "name": "petya"})
+                resp = await request(host, {"action": "createtable", "color": "white"})
+                tid = resp["data"]["table_id"]
+                resp = await request(events, {"action": "subscribe", "user": "vasya", "table_id": tid})
+                self.assertIsNone(resp["data"]["black"])
+
+                await request(guest, {"action": "join", "table_id": tid})
+                joined = await asyncio.wait_for(read_frame(events[0]), 1)
+                await request(guest, {"action": "leave", "table_id": tid, "color": "black", "user": "petya"})
+                left = await asyncio.wait_for(read_frame(events[0]), 1)
+            return joined, left
+
+        joined, left = asyncio.run(scenario())
+        self.assertEqual(joined, {"event": "joined", "table_id": 1, "user": "petya"})
+        self.assertEqual(left["event"], "left")
+
+    def test_only_seated_player_leaving_frees_bot_table(self):
+        """Уход чужого игрока не снимает движок, уход хозяина закрывает стол с ботом."""
+
+        async def scenario():
+            async with running_server() as env:
+                host = await env.connect()
+                stranger = await env.connect()
+                await request(host, {"action": "register", "name": "vasya"})
+                await request(stranger, {"action": "register", "name": "petya"})
+                tid = (await request(host, {"action": "createtable", "color": "white", "bot": True}))["data"]["table_id"]
+                await request(stranger, {"action": "leave", "table_id": tid, "color": "black", "user": "petya"})
+                table = env.server.tables[tid]
+                kept = (table.black, set(table.active_players))
+                await request(host, {"action": "leave", "table_id": tid, "color": "white", "user": "vasya"})
+            return kept, (table.black, set(table.active_players)), tid in env.server.tables
+
+        kept, freed, open_ = asyncio.run(scenario())
+        self.assertEqual(kept[0], "Engine")
+        self.assertIn("Engine", kept[1])
+        self.assertIsNone(freed[0])
+        self.assertNotIn("Engine", freed[1])
+        self.assertFalse(open_)
+
+    def test_table_id_cache_applies_lobby_changes(self):
+        """Кэш id столов обновляется по журналу изменений и ищет по префиксу."""
+        with patch("chessclub.client.__main__.send_recv") as mock_send_recv:
+            cache = TableIdCache(ttl=0)
+            mock_send_recv.return_value = {"status": "ok", "data": {"version": 3, "ids": [1, 12, 2]}}
+            self.assertEqual(cache.complete(MagicMock(), "1"), ["1", "12"])
+
+            mock_send_recv.return_value = {
+                "status": "ok", "data": {"version": 5, "changes": [(12, False), (15, True)]}
+            }
+            self.assertEqual(cache.complete(MagicMock(), "1"), ["1", "15"])
+            self.assertEqual(mock_send_recv.call_args[0][1]["since"], 3)
+            self.assertEqual(cache.ids, ["1", "15", "2"])
+
+            mock_send_recv.return_value = {"status": "err", "msg": "slow down", "data": None, "limited": True}
+            self.assertEqual(cache.complete(MagicMock(), "1"), ["1", "15"])
+            self.assertEqual(cache.version, 5)
+
+    def test_engine_finds_mate_in_one(self):
+        """Встроенный движок находит мат в один ход в пределах бюджета."""
+        res = analyse("6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1", 1.0, 20000)
+        self.assertEqual(res["move"], "d1d8")
+        self.assertGreater(res["score"], 0)
+        self.assertLessEqual(res["nodes"], 20000)
+
+    def test_engine_pool_round_robin_between_tables(self):
+        """Очередь движка обслуживает столы по кругу, а не по порядку запросов."""
+        order = []
+
+        def fake_analyse(fen, movetime, nodes, uci=None):
+            order.append(fen)
+            return {"move": None}
+
+        async def scenario():
+            pool = EnginePool(1)
+            pool.executor.shutdown()
+            pool.executor = ThreadPoolExecutor(1)
+            jobs = [pool.submit("a", f"a{i}") for i in range(3)]
+            jobs.append(pool.submit("b", "b0"))
+            await asyncio.gather(*jobs)
+            pool.close()
+
+        with patch("chessclub.server.engine.analyse", fake_analyse):
+            asyncio.run(scenario())
+        self.assertEqual(order, ["a0", "b0", "a1", "a2"])
+
+    def test_position_cache_shares_transpositions(self):
+        """Одна и та же позиция на разных столах считается один раз."""
+        cache = PositionCache()
+        a, b = Table(1), Table(2)
+        for uci in ("g1f3", "g8f6", "b1c3"):
+            a.push(chess.Move.from_uci(uci))
+        for uci in ("b1c3", "g8f6", "g1f3"):
+            b.push(chess.Move.from_uci(uci))
+
+        self.assertEqual(cache.legal_moves(a.position), cache.legal_moves(b.position))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertIsNone(cache.status(a.position))
+
+        small = PositionCache(max_bytes=1)
+        small.legal_moves(a.position)
+        small.legal_moves(Table(3).position)
+        self.assertEqual((len(small.items), small.evictions), (1, 1))
+
+    def test_opening_book_lookup(self):
+        """Ходы книги ищутся в .bin файле по Zobrist-ключу позиции."""
+        key = chess.polyglot.zobrist_hash(chess.Board())
+        entries = sorted(
+            [
+                (key, chess.E2 << 6 | chess.E4, 10, 0),
+                (key, chess.D2 << 6 | chess.D4, 30, 0),
+                (key + 1, chess.G1 << 6 | chess.F3, 5, 0),
+            ]
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "book.bin")
+            with open(path, "wb") as f:
+                for entry in entries:
+                    f.write(struct.pack(">QHHI", *entry))
+            book = OpeningBook(path)
+            moves = book.moves(chess.Board())
+            reply = book.choose(chess.Board())
+            out_of_book = book.choose(chess.Board("8/8/8/8/8/8/8/K6k w - - 0 1"))
+            book.close()
+
+        self.assertEqual(moves, [{"move": "d2d4", "weight": 30}, {"move": "e2e4", "weight": 10}])
+        self.assertIn(reply.uci(), ("d2d4", "e2e4"))
+        self.assertIsNone(out_of_book)
+
+    def test_archive_stores_games_in_columns(self):
+        """Архив хранит ходы 16-битными кодами и читает их после перезапуска."""
+        promo = chess.Move.from_uci("a7b8q")
+        self.assertEqual(decode_move(encode_move(promo)), promo)
+        with tempfile.TemporaryDirectory() as tmp:
+            archive = GameArchive(tmp)
+            archive.add("vasya", "petya", "1-0", [chess.Move.from_uci("e2e4")], date=100)
+            archive.add("petya", "kolya", "*", [], date=200)
+            reopened = GameArchive(tmp)
+            self.assertEqual(len(reopened), 2)
+            self.assertEqual(reopened.game(0)["moves"], [chess.Move.from_uci("e2e4")])
+            self.assertEqual(list(reopened.search(player="vasya")), [0])
+            self.assertEqual(list(reopened.search(since=150)), [1])
+            self.assertEqual(reopened.cols["moves"].itemsize, 2)
+
+    def test_finished_game_is_archived_and_exported(self):
+        """Партия со стола попадает в архив и выгружается частями PGN."""
+
+        async def scenario():
+            async with running_server() as env:
+                conn = await env.connect()
+                await request(conn, {"action": "register", "name": "vasya"})
+                resp = await request(conn, {"action": "createtable", "color": "white"})
+                tid = resp["data"]["table_id"]
+                for uci in ("f2f3", "e7e5", "g2g4", "d8h4"):
+                    await request(conn, {"action": "move", "table_id": tid, "uci": uci})
+                await request(conn, {"action": "leave", "table_id": tid, "color": "white", "user": "vasya"})
+                frames = [await request(conn, {"action": "export_games", "player": "vasya", "chunk_size": 1})]
+                while frames[-1]["more"]:
+                    frames.append(await read_frame(conn[0]))
+            return frames
+
+        frames = asyncio.run(scenario())
+        self.assertEqual(len(frames), 2)
+        self.assertIn('[White "vasya"]', frames[0]["data"])
+        self.assertIn("1. f3 e5 2. g4 Qh4#", frames[0]["data"])
+
+    def test_opening_index_counts_results_by_position(self):
+        """Индекс считает результаты и ходы из позиции, в том числе после пересборки."""
+        archive = GameArchive()
+        for result, ucis in (
+            ("1-0", ["e2e4", "e7e5"]),
+            ("0-1", ["d2d4"]),
+            ("1/2-1/2", ["e2e4", "c7c5"]),
+            ("*", ["e2e4"]),
+        ):
+            archive.add("a", "b", result, [chess.Move.from_uci(u) for u in ucis])
+        with tempfile.TemporaryDirectory() as tmp:
+            index = OpeningIndex(os.path.join(tmp, "stats.bin"), flush_at=2)
+            for gid in range(len(archive)):
+                if index.add_game(*archive.raw(gid)):
+                    before = index.lookup(chess.Board())
+                    counts = index.detach()
+                    self.assertIsNone(index.detach())
+                    self.assertEqual(index.lookup(chess.Board()), before)
+                    index.install(index.merge(counts))
+            self.assertTrue(index.pending)
+            self.assertEqual(len(index), 5)
+            incremental = index.lookup(chess.Board())
+            after_e4 = index.lookup(chess.Board("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1"))
+            index.rebuild(archive, workers=1)
+            rebuilt = index.lookup(chess.Board())
+            index.close()
+
+        self.assertEqual(incremental, rebuilt)
+        self.assertEqual((rebuilt["games"], rebuilt["white"], rebuilt["draws"], rebuilt["black"]), (3, 1, 1, 1))
+        self.assertEqual(rebuilt["moves"][0], {"move": "e2e4", "games": 2, "white": 1, "draws": 1, "black": 0})
+        self.assertCountEqual([m["move"] for m in after_e4["moves"]], ["c7c5", "e7e5"])
+
+    def test_pgn_import_splits_and_validates_games(self):
+        """Импорт режет PGN по границам партий и отбрасывает некорректные."""
+        pgn = (
+            '[White "vasya"]\n[Result "1-0"]\n\n1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0\n\n'
+            '[White "petya"]\n[Result "*"]\n\n1. e4 e4 *\n\n'
+            '[White "kolya"]\n[Date "2020.05.??"]\n\n1. d4 (1. c4) d5 *\n'
+        )
+        self.assertEqual(len(list(split_games(io.StringIO(pgn), chunk_games=1))), 3)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "games.pgn")
+            with open(path, "w") as f:
+                f.write(pgn)
+            GameArchive(os.path.join(tmp, "archive")).add("old", "game", "0-1", [chess.Move.from_uci("g1f3")])
+            with open(os.path.join(tmp, "archive", "offset.bin"), "ab") as f:
+                f.write(b"torn")
+            archive = GameArchive(os.path.join(tmp, "archive"), append_only=True)
+            imported, rejected, _elapsed = import_pgn(path, archive, workers=1, chunk_games=2)
+            kept = sum(len(col) for col in archive.cols.values())
+            reopened = GameArchive(os.path.join(tmp, "archive"))
+
+        self.assertEqual((imported, rejected), (2, 1))
+        self.assertEqual(kept, 0)
+        self.assertEqual(len(archive), 3)
+        self.assertEqual(len(reopened), 3)
+        self.assertEqual([mv.uci() for mv in reopened.game(0)["moves"]], ["g1f3"])
+        self.assertEqual(reopened.game(1)["result"], "1-0")
+        self.assertEqual(reopened.game(1)["white"], "vasya")
+        self.assertEqual([mv.uci() for mv in reopened.game(2)["moves"]], ["d2d4", "d7d5"])
+
+    def test_matchmaker_widens_rating_window(self):
+        """Подбор соперника по рейтингу расширяет окно со временем ожидания."""
+        now = [0.0]
+        mm = Matchmaker(clock=lambda: now[0])
+        self.assertIsNone(mm.seek("a", 1500)[1])
+        self.assertIsNone(mm.seek("b", 1800)[1])
+        self.assertIsNone(mm.seek("c", 1550, "15+10")[1])
+        self.assertEqual(mm.seek("d", 1560)[1].name, "a")
+        self.assertEqual(mm.sweep(), [])
+        mm.seek("e", 1500)
+        now[0] = 100.0
+        pairs = mm.sweep()
+        self.assertEqual(sorted(s.name for s in pairs[0]), ["b", "e"])
+        self.assertEqual(list(mm.seeks), ["c"])
+        self.assertAlmostEqual(elo(1500, 1500, 1), 1516)
+
+        # With a narrow window the head of a band can be out of reach while the next seek is not.
+        with patch("chessclub.server.matchmaking.BASE_WINDOW", 20):
+            mm = Matchmaker(clock=lambda: 0.0)
+            mm.seek("f", 1549)
+            g = mm.seek("g", 1500)[0]
+            self.assertEqual(mm.seek("h", 1480)[1].name, "g")
+        self.assertIsNone(mm.cancel("f", g))
+        self.assertIn("f", mm.seeks)
+
+    def test_seek_pairs_players_at_new_table(self):
+        """Запрос seek сразу отвечает, пара приходит событием, уход отменяет только свой поиск."""
+
+        async def scenario():
+            async with running_server() as env:
+                a = await env.connect()
+                b = await env.connect()
+                events = await env.connect()
+                await request(a, {"action": "register", "name": "vasya"})
+                await request(b, {"action": "register", "name": "petya"})
+                await request(events, {"action": "subscribe", "user": "vasya"})
+                queued = await request(a, {"action": "seek", "timeout": 5})
+                second = await request(b, {"action": "seek", "timeout": 5})
+                first = await asyncio.wait_for(read_frame(events[0]), 1)
+                table = env.server.tables[first["table_id"]]
+
+                await request(a, {"action": "seek", "time_control": "15+10"})
+                await request(b, {"action": "seek", "time_control": "3+2", "timeout": 0.5})
+                await env.drop(b)
+                waiting = list(env.server.matchmaker.seeks)
+            return queued, first, second, table, waiting
+
+        queued, first, second, table, waiting = asyncio.run(scenario())
+        self.assertIsNone(queued["data"])
+        self.assertEqual(first["event"], "matched")
+        self.assertEqual(first["table_id"], second["data"]["table_id"])
+        self.assertEqual({first["color"], second["data"]["color"]}, {"white", "black"})
+        self.assertEqual({table.white, table.black}, {"vasya", "petya"})
+        self.assertEqual(table.time_control, "5+0")
+        self.assertEqual(waiting, ["vasya"])
+
+    def test_seek_expires_with_pushed_event(self):
+        """Поиск без пары снимается по таймауту, игрок получает событие."""
+
+        async def scenario():
+            async with running_server() as env:
+                a = await env.connect()
+                events = await env.connect()
+                await request(a, {"action": "register", "name": "vasya"})
+                await request(events, {"action": "subscribe", "user": "vasya"})
+                await request(a, {"action": "seek", "timeout": 0.1})
+                expired = await asyncio.wait_for(read_frame(events[0]), 3)
+                left = len(env.server.matchmaker)
+            return expired, left
+
+        expired, left = asyncio.run(scenario())
+        self.assertEqual(expired["event"], "unmatched")
+        self.assertEqual(left, 0)
+
+    def test_tournament_pairings(self):
+        """Круговая система сводит всех со всеми, швейцарская избегает повторов."""
+        rounds = round_robin("abcde")
+        met = [frozenset(p) for rnd in rounds for p in rnd if p[1] is not None]
+        self.assertEqual(len(rounds), 5)
+        self.assertEqual(len(set(met)), 10)
+        self.assertEqual(len(met), 10)
+
+        points = {"a": 2, "b": 2, "c": 1, "d": 0}
+        pairs = swiss_round("abcd", points, {frozenset("ab")})
+        self.assertEqual(pairs, [("a", "c"), ("b", "d")])
+
+    def test_tournament_archives_games_and_scores(self):
+        """Турнир играет партии в пуле процессов, пишет их в архив и считает очки."""
+        server = ChessServer()
+        tour = Tournament(server, ["a", "b", "c", "d"], workers=1, seed=1)
+        asyncio.run(tour.run())
+        standings = tour.standings()
+
+        self.assertEqual(tour.games, 6)
+        self.assertEqual(len(server.archive), 6)
+        self.assertEqual(server.tables, {})
+        self.assertEqual(sum(r["points"] for r in standings), 6)
+        self.assertTrue(all(r["games"] == 3 for r in standings))
+
+    def test_tournament_games_queue_in_engine_pool(self):
+        """В общем пуле движка турнир шлёт по одной партии и оставляет воркер живым столам."""
+        server = ChessServer()
+        calls = []
+
+        async def scenario():
+            pool = EnginePool(2)
+            pool.executor.shutdown()
+            pool.executor = ThreadPoolExecutor(2)
+            real = pool.call
+
+            def call(key, fn, *args):
+                calls.append((key, len(args[0]), pool.running))
+                return real(key, fn, *args)
+
+            pool.call = call
+            tour = Tournament(server, ["a", "b", "c", "d"], seed=1, pool=pool)
+            await tour.run()
+            pool.close()
+            return tour
+
+        tour = asyncio.run(scenario())
+        self.assertEqual(tour.games, 6)
+        self.assertEqual(len(calls), 6)
+        self.assertEqual({key for key, size, running in calls}, {("tournament", tour.id)})
+        self.assertEqual({size for key, size, running in calls}, {1})
+        self.assertEqual(max(running for key, size, running in calls), 0)
+
+    def test_tournament_action_is_admin_only_and_cleans_up(self):
+        """Турнир запускает только админ, число игроков ограничено, упавший тур закрывает столы."""
+        server = ChessServer()
+        server.admin_token = "secret"
+
+        async def scenario():
+            resps = []
+            for cmd in (
+                {"action": "tournament", "players": 4},
+                {"action": "tournament", "players": 10 ** 6, "admin_token": "secret"},
+                {"action": "tournament", "players": 4, "rounds": 10 ** 6, "admin_token": "secret"},
+            ):
+                resp = {"status": "ok", "msg": None, "data": None}
+                await HANDLERS["tournament"](server, None, cmd, resp)
+                resps.append(resp)
+            tid = server.open_table("a", "b", bots_only=True)
+            move = {"status": "ok", "msg": None, "data": None}
+            await HANDLERS["move"](server, None, {"table_id": tid, "uci": "e2e4"}, move)
+            server.close_table(tid)
+            tour = Tournament(server, ["a", "b", "c", "d"], workers=10 ** 6, seed=1, pool=pool)
+            with self.assertRaises(RuntimeError):
+                await tour.run()
+            return resps, move, tour
+
+        class Broken:
+            workers = 4
+
+            def call(self, *args):
+                raise RuntimeError("pool is gone")
+
+        pool = Broken()
+        resps, move, tour = asyncio.run(scenario())
+        self.assertEqual(resps[0]["msg"], "SERVER:: Admin only")
+        self.assertEqual([r["status"] for r in resps[1:]], ["err", "err"])
+        self.assertEqual(move["msg"], "SERVER:: Bots play at this table")
+        self.assertLessEqual(tour.workers, os.cpu_count())
+        self.assertEqual(server.tables, {})
+        self.assertEqual(tour.seats, {})
+
+    def test_session_resume_after_drop(self):
+        """После обрыва клиент по токену получает место, стол и пропущенные ходы."""
+
+        async def scenario():
+            async with running_server(grace=0.2) as env:
+                conn = await env.connect()
+                token = (await request(conn, {"action": "register", "name": "vasya"}))["data"]["token"]
+                tid = (await request(conn, {"action": "createtable", "color": "white"}))["data"]["table_id"]
+                await request(conn, {"action": "move", "table_id": tid, "uci": "e2e4"})
+                await env.drop(conn)
+                other = await env.connect()
+                taken = await request(other, {"action": "register", "name": "vasya"})
+                again = await env.connect()
+                resumed = await request(again, {"action": "resume", "token": token, "ply": 0})
+                await request(again, {"action": "move", "table_id": tid, "uci": "e7e5"})
+                await env.drop(again)
+                await until(lambda: "vasya" not in env.server.users)
+                expired = await request(other, {"action": "resume", "token": token})
+                fresh = await request(other, {"action": "register", "name": "vasya"})
+            return taken, resumed, expired, fresh
+
+        taken, resumed, expired, fresh = asyncio.run(scenario())
+        self.assertEqual(taken["status"], "err")
+        self.assertEqual((resumed["data"]["table_id"], resumed["data"]["color"]), (1, "white"))
+        self.assertEqual(resumed["data"]["moves"], ["e2e4"])
+        self.assertEqual(expired["status"], "err")
+        self.assertEqual(fresh["status"], "ok")
+
+    def test_grace_period_counts_from_last_drop(self):
+        """Таймер прошлого обрыва не снимает сессию, возобновлённую и снова оборванную."""
+
+        async def scenario():
+            async with running_server(grace=0.4) as env:
+                conn = await env.connect()
+                token = (await request(conn, {"action": "register", "name": "vasya"}))["data"]["token"]
+                await env.drop(conn)
+                again = await env.connect()
+                await request(again, {"action": "resume", "token": token})
+                await asyncio.sleep(0.25)
+                await env.drop(again)
+                await asyncio.sleep(0.25)
+                last = await env.connect()
+                resumed = await request(last, {"action": "resume", "token": token})
+                await env.drop(last)
+                await until(lambda: "vasya" not in env.server.users)
+            return resumed
+
+        self.assertEqual(asyncio.run(scenario())["status"], "ok")
+
+    def test_handoff_moves_socket_and_state_to_new_server(self):
+        """Новый процесс получает сокет и столы, старый останавливает задачи и больше не пишет файлы."""
+
+        def sizes(tmp):
+            return {name: os.path.getsize(os.path.join(tmp, "archive", name)) for name in os.listdir(os.path.join(tmp, "archive"))}
+
+        async def scenario(tmp):
+            server = ChessServer(
+                archive=GameArchive(os.path.join(tmp, "archive")),
+                stats=OpeningIndex(os.path.join(tmp, "stats.bin"), flush_at=1),
+            )
+            server.record_game("a", "b", "1-0", [chess.Move.from_uci("e2e4")])
+            async with running_server(server) as old:
+                conn = await old.connect()
+                token = (await request(conn, {"action": "register", "name": "vasya"}))["data"]["token"]
+                await request(conn, {"action": "createtable", "color": "white"})
+                await request(conn, {"action": "move", "table_id": 1, "uci": "d2d4"})
+                server.spawn(asyncio.sleep(60))
+                stopped = asyncio.Event()
+                handing = asyncio.create_task(server.hand_over(listen(os.path.join(tmp, "handoff.sock")), old.srv, stopped))
+                sockets, state = await asyncio.to_thread(take_over, os.path.join(tmp, "handoff.sock"))
+                await stopped.wait()
+                await handing
+                dropped = await conn[0].read()
+            stopped_tasks = set(server.tasks)
+            before = sizes(tmp), os.path.getsize(os.path.join(tmp, "stats.bin"))
+            server.record_game("c", "d", "0-1", [chess.Move.from_uci("d2d4")])
+            await server.save_stats()
+            after = sizes(tmp), os.path.getsize(os.path.join(tmp, "stats.bin"))
+            server.stats.close()
+            new = ChessServer()
+            new.restore(state)
+            async with running_server(new, sock=sockets[0]) as env:
+                again = await env.connect()
+                resumed = await request(again, {"action": "resume", "token": token})
+            return dropped, resumed, stopped_tasks, before, after
+
+        with tempfile.TemporaryDirectory() as tmp:
+            dropped, resumed, stopped_tasks, before, after = asyncio.run(scenario(tmp))
+        self.assertEqual(dropped, b"")
+        self.assertEqual(resumed["data"]["table_id"], 1)
+        self.assertEqual(resumed["data"]["moves"], ["d2d4"])
+        self.assertEqual(stopped_tasks, set())
+        self.assertGreater(before[1], 0)
+        self.assertEqual(before, after)
+
+    def test_uvloop_falls_back_and_sockets_are_tuned(self):
+        """Без uvloop берётся обычный цикл, сокет получает TCP_NODELAY, keepalive и буферы."""
+        out = io.StringIO()
+        with patch.dict("sys.modules", {"uvloop": None}), contextlib.redirect_stdout(out):
+            self.assertIs(loop_factory("uvloop"), asyncio.new_event_loop)
+        self.assertIn("uvloop is not installed", out.getvalue())
+        uvloop = MagicMock()
+        with patch.dict("sys.modules", {"uvloop": uvloop}):
+            self.assertIs(loop_factory("uvloop"), uvloop.new_event_loop)
+        self.assertIs(loop_factory("asyncio"), asyncio.new_event_loop)
+        self.assertEqual(run_on(loop_factory("asyncio"), asyncio.sleep(0, "done")), "done")
+
+        with socket.socket() as sock:
+            tune_socket(sock, rcvbuf=32768, sndbuf=32768)
+            self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            self.assertTrue(sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE), KEEPALIVE_IDLE)
+            self.assertGreaterEqual(sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), 32768)
+            self.assertGreaterEqual(sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), 32768)
+        with socket.socket() as sock:
+            rcvbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            tune_socket(sock)
+            self.assertEqual(sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), rcvbuf)
+
+    def test_actions_dispatch_through_registry_and_profiler(self):
+        """Действия находятся в реестре, профилировщик считает время каждого."""
+
+        async def scenario():
+            server = ChessServer()
+            server.admin_token = "secret"
+            async with running_server(server) as env:
+                conn = await env.connect()
+                refused = await request(conn, {"action": "profile", "enable": True, "admin_token": "guess"})
+                started = server.profiler
+                off = await request(conn, {"action": "profile", "admin_token": "secret"})
+                await request(conn, {"action": "profile", "enable": True, "reset": True, "admin_token": "secret"})
+                await request(conn, {"action": "register", "name": "vasya"})
+                await request(conn, {"action": "createtable", "color": "white"})
+                await request(conn, {"action": "move", "table_id": 1, "uci": "e2e4"})
+                unknown = await request(conn, {"action": "dance"})
+                report = await request(conn, {"action": "profile", "enable": False, "admin_token": "secret"})
+            return refused, started, off, unknown, report["data"], server.profiler
+
+        refused, started, off, unknown, report, profiler = asyncio.run(scenario())
+        self.assertEqual(refused["msg"], "SERVER:: Admin only")
+        self.assertIsNone(started)
+        self.assertTrue({"register", "move", "legal_moves", "game_status", "view"} <= set(HANDLERS))
+        self.assertEqual(off["status"], "err")
+        self.assertEqual(unknown["status"], "err")
+        self.assertEqual(report["actions"]["move"]["calls"], 1)
+        self.assertIn("register", report["actions"])
+        self.assertNotIn("dance", report["actions"])
+        self.assertIsInstance(report["stacks"], list)
+        self.assertIsNone(profiler)
+
+    def test_rate_limits_per_action_and_connection(self):
+        """Список столов ограничен сильнее ходов, соседнее соединение обслуживается."""
+        now = [0.0]
+        limiter = RateLimiter({"list_tables": (1.0, 2)}, (10.0, 5), (100.0, 6), clock=lambda: now[0])
+        buckets = limiter.buckets()
+        listed = [limiter.allow(buckets, "list_tables") for i in range(3)]
+        moved = [limiter.allow(buckets, "move") for i in range(6)]
+        now[0] += 1.0
+        self.assertEqual(listed, [True, True, False])
+        self.assertEqual(moved, [True, True, True, True, False, False])
+        self.assertTrue(limiter.allow(buckets, "list_tables"))
+        self.assertEqual(limiter.stats()["limited"], {"list_tables": 1, "move": 2})
+
+        async def scenario():
+            async with running_server() as env:
+                greedy = await env.connect()
+                polite = await env.connect()
+                frame = pickle.dumps({"action": "list_tables"})
+                greedy[1].write((len(frame).to_bytes(4, "big") + frame) * 50)
+                answer = await request(polite, {"action": "list_tables"})
+                replies = [await read_frame(greedy[0]) for i in range(50)]
+                await request(polite, {"action": "register", "name": "vasya"})
+                await request(polite, {"action": "createtable", "color": "white"})
+                info = await request(polite, {"action": "table_info", "table_id": 1})
+                counters = await request(polite, {"action": "rate_limits"})
+            return answer, replies, info["data"], counters["data"]
+
+        answer, replies, info, counters = asyncio.run(scenario())
+        refused = sum(r["status"] == "err" for r in replies)
+        self.assertEqual(refused, sum(bool(r.get("limited")) for r in replies))
+        self.assertEqual((info["id"], info["white"], info["black"]), (1, "vasya", None))
+        self.assertEqual(answer["status"], "ok")
+        self.assertGreater(refused, 30)
+        self.assertEqual(counters["limited"]["list_tables"], refused)
+
+    def test_large_frames_compressed_after_negotiation(self):
+        """После согласования большие ответы сжимаются, короткие идут как есть."""
+        codec = ZlibCodec()
+        payload = pickle.dumps([{"id": i, "white": "vasya", "black": None} for i in range(50)])
+        frame = pack(payload, codec)
+        header = int.from_bytes(frame[:4], "big")
+        self.assertTrue(header & COMPRESSED)
+        self.assertEqual(unpack(header, frame[4:], codec), payload)
+        self.assertEqual(pack(b"move", codec), b"\x00\x00\x00\x04move")
+
+        async def raw_request(conn, cmd):
+            reader, writer = conn
+            data = pickle.dumps(cmd)
+            writer.write(len(data).to_bytes(4, "big") + data)
+            header = int.from_bytes(await reader.readexactly(4), "big")
+            body = await reader.readexactly(header & ~COMPRESSED)
+            return header, pickle.loads(unpack(header, body, codec))
+
+        async def scenario():
+            async with running_server() as env:
+                old = await env.connect()
+                new = await env.connect()
+                agreed = await request(new, {"action": "compress", "codecs": ["brotli", "zlib"]})
+                for i in range(25):
+                    await request(old, {"action": "createtable", "color": "white"})
+                plain, tables = await raw_request(old, {"action": "list_tables"})
+                packed, same = await raw_request(new, {"action": "list_tables"})
+                small, board = await raw_request(new, {"action": "get_board", "table_id": 1})
+            return agreed, plain, packed, small, tables, same, board
+
+        agreed, plain, packed, small, tables, same, board = asyncio.run(scenario())
+        self.assertEqual(agreed["data"]["codec"], "zlib")
+        self.assertFalse(plain & COMPRESSED)
+        self.assertTrue(packed & COMPRESSED)
+        self.assertLess(packed & ~COMPRESSED, plain)
+        self.assertFalse(small & COMPRESSED)
+        self.assertEqual(tables, same)
+        self.assertEqual(board["data"], chess.STARTING_FEN)
+
+    def test_move_lag_is_logged_and_archived(self):
+        """Задержки ходов пишутся в кольцевой буфер стола, гистограммы и архив."""
+        log = LagLog(size=3)
+        for ply in range(1, 6):
+            log.add(ply, ply * 2.0, ply * 2.0 + 0.001, 0.02)
+        self.assertEqual([row[0] for row in log.rows()], [3, 4, 5])
+        self.assertAlmostEqual(log.rows()[0][1], 1999.0, places=2)
+
+        async def scenario():
+            async with running_server() as env:
+                env.server.admin_token = "secret"
+                conn = await env.connect()
+                await request(conn, {"action": "register", "name": "vasya"})
+                tid = (await request(conn, {"action": "createtable", "color": "white"}))["data"]["table_id"]
+                await request(conn, {"action": "move", "table_id": tid, "uci": "e2e4"})
+                await request(conn, {"action": "move", "table_id": tid, "uci": "e7e5", "rtt": 0.015})
+                refused = await request(conn, {"action": "lagstats", "table_id": tid})
+                table = await request(conn, {"action": "lagstats", "table_id": tid, "admin_token": "secret"})
+                total = await request(conn, {"action": "lagstats", "admin_token": "secret"})
+                await request(conn, {"action": "leave", "table_id": tid, "color": "white", "user": "vasya"})
+            return refused, table["data"]["rows"], total["data"], env.server.archive
+
+        refused, rows, total, archive = asyncio.run(scenario())
+        self.assertEqual(refused["msg"], "SERVER:: Admin only")
+        self.assertEqual([row[0] for row in rows], [1, 2])
+        self.assertNotEqual(rows[0][1], rows[0][1])
+        self.assertGreaterEqual(rows[1][1], 0)
+        self.assertAlmostEqual(rows[1][3], 15.0, places=3)
+        self.assertEqual(total["server"]["count"], 2)
+        self.assertEqual(total["rtt"]["count"], 1)
+        self.assertEqual(total["think"]["count"], 1)
+        self.assertEqual(len(archive.game(0)["lag"]), 2)
+        self.assertIn("[%emt", archive.pgn(0, emt=True))
+
+    def test_cluster_routes_tables_to_owner_and_rebalances(self):
+        """Шлюз ведёт запросы к владельцу стола, узлы делят лобби и передают столы при уходе."""
+
+        async def scenario():
+            hub, nodes = LocalHub(), {}
+            async with contextlib.AsyncExitStack() as stack:
+                for name, owns in (("a", True), ("b", True), ("gw", False)):
+                    env = await stack.enter_async_context(running_server())
+                    env.server.cluster = Cluster(env.server, LocalBus(hub), env.address, owns=owns, node_id=name)
+                    await env.server.cluster.start()
+                    nodes[name] = env
+                a, b, gw = (nodes[name].server for name in ("a", "b", "gw"))
+                await until(lambda: all(len(env.server.cluster.nodes) == 2 for env in nodes.values()))
+                vasya = await nodes["gw"].connect()
+                petya = await nodes["gw"].connect()
+                await request(vasya, {"action": "register", "name": "vasya"})
+                await request(petya, {"action": "register", "name": "petya"})
+                await until(lambda: {"vasya", "petya"} <= set(a.cluster.users))
+                direct = await nodes["a"].connect()
+                taken = await request(direct, {"action": "register", "name": "vasya"})
+                tids = []
+                for i in range(4):
+                    resp = await request(vasya, {"action": "createtable", "color": "white"})
+                    tids.append(resp["data"]["table_id"])
+                joined = await request(petya, {"action": "join", "table_id": tids[1]})
+                await request(vasya, {"action": "move", "table_id": tids[1], "uci": "e2e4"})
+                await until(lambda: gw.cluster.ids() == sorted(tids))
+                lobby = await request(petya, {"action": "list_tables"})
+                owned = {"a": sorted(a.tables), "b": sorted(b.tables)}
+                await b.cluster.leave()
+                await until(lambda: "b" not in gw.cluster.nodes and len(a.tables) == len(tids))
+                after = sorted(a.tables)
+                board = await request(petya, {"action": "get_board", "table_id": tids[1]})
+                moved = await request(petya, {"action": "move", "table_id": tids[1], "uci": "e7e5"})
+            return taken, tids, joined, lobby, owned, after, board, moved, a
+
+        taken, tids, joined, lobby, owned, after, board, moved, a = asyncio.run(scenario())
+        self.assertEqual(taken["msg"], "SERVER:: Name taken")
+        self.assertEqual(len(set(tids)), 4)
+        self.assertTrue(owned["a"] and owned["b"])
+        self.assertEqual(sorted(owned["a"] + owned["b"]), sorted(tids))
+        self.assertEqual(joined["data"], {"table_id": tids[1], "color": "black"})
+        self.assertEqual(sorted(t["id"] for t in lobby["data"]), sorted(tids))
+        self.assertEqual(after, sorted(tids))
+        self.assertIn("4P3", board["data"])
+        self.assertEqual(moved["status"], "ok")
+        self.assertEqual(a.tables[tids[1]].white, "vasya")
+        self.assertEqual(len(a.tables[tids[1]].moves), 2)
+
+    def test_review_replays_archived_game_from_checkpoints(self):
+        """Просмотр партии: переход к любому ходу не дальше шага от контрольной позиции."""
+        board, fens, rng = chess.Board(), [], random.Random(7)
+        fens.append(board.fen())
+        moves = []
+        while len(moves) < 50 and not board.is_game_over():
+            mv = rng.choice(list(board.legal_moves))
+            board.push(mv)
+            moves.append(mv)
+            fens.append(board.fen())
+        replay = Replay(moves, every=8)
+        self.assertEqual(len(replay.checkpoints), len(moves) // 8 + 1)
+        for ply in (len(moves), 3, 4, 3, 17, 16, 15, 0, 1, 40, 39, len(moves) + 5, -2):
+            pos = replay.seek(ply)
+            self.assertEqual(pos.fen(), fens[max(0, min(ply, len(moves)))])
+            self.assertLess(len(pos.move_stack), 8)
+
+        async def scenario():
+            async with running_server() as env:
+                conn = await env.connect()
+                await request(conn, {"action": "register", "name": "vasya"})
+                tid = (await request(conn, {"action": "createtable", "color": "white"}))["data"]["table_id"]
+                for uci in ("f2f3", "e7e5", "g2g4", "d8h4"):
+                    await request(conn, {"action": "move", "table_id": tid, "uci": uci})
+                left = await request(conn, {"action": "leave", "table_id": tid, "color": "white", "user": "vasya"})
+                game = await request(conn, {"action": "game", "game_id": left["data"]["game_id"]})
+                missing = await request(conn, {"action": "game", "game_id": 5})
+            return game, missing
+
+        game, missing = asyncio.run(scenario())
+        self.assertEqual(game["data"]["moves"], ["f2f3", "e7e5", "g2g4", "d8h4"])
+        self.assertEqual(game["data"]["result"], "0-1")
+        self.assertEqual(missing["msg"], "SERVER:: No such game")
+        replay = Replay([chess.Move.from_uci(uci) for uci in game["data"]["moves"]], game["data"]["start"])
+        self.assertTrue(replay.seek(len(replay)).is_checkmate())
+
+    def test_server_decides_result_freezes_table_and_pushes_it(self):
+        """Сервер сам определяет конец партии, замораживает стол, рассылает итог и архивирует."""
+        server = ChessServer()
+        t = Table(1, "vasya", "petya")
+        t._board = chess.Board("8/8/4k3/8/8/3RK3/8/8 w - - 149 120")
+        t.push(chess.Move.from_uci("d3d1"))
+        self.assertEqual(server.decide(t), ("1/2-1/2", "seventyfive_moves"))
+        t = Table(2, "vasya", "petya")
+        t._board = chess.Board("8/8/4k3/8/8/3nK3/8/8 w - - 0 60")
+        t.push(chess.Move.from_uci("e3d3"))
+        self.assertEqual(server.decide(t), ("1/2-1/2", "insufficient_material"))
+
+        async def scenario():
+            async with running_server(server) as env:
+                vasya = await env.connect()
+                petya = await env.connect()
+                watcher = await env.connect()
+                await request(vasya, {"action": "register", "name": "vasya"})
+                await request(petya, {"action": "register", "name": "petya"})
+                tid = (await request(vasya, {"action": "createtable", "color": "white"}))["data"]["table_id"]
+                await request(petya, {"action": "join", "table_id": tid})
+                await request(watcher, {"action": "subscribe", "user": "petya", "table_id": tid})
+                replies = []
+                for i in range(4):
+                    for uci in ("g1f3", "g8f6", "f3g1", "f6g8"):
+                        conn = vasya if uci[0] in "gf" and uci[1] in "13" else petya
+                        replies.append(await request(conn, {"action": "move", "table_id": tid, "uci": uci}))
+                pushed = await read_frame(watcher[0])
+                frozen = await request(petya, {"action": "move", "table_id": tid, "uci": "e7e5"})
+                status = await request(petya, {"action": "game_status", "table_id": tid})
+            return replies, pushed, frozen, status
+
+        replies, pushed, frozen, status = asyncio.run(scenario())
+        self.assertTrue(all(r["data"] is None for r in replies[:-1]))
+        outcome = {"result": "1/2-1/2", "reason": "fivefold_repetition", "game_id": 0}
+        self.assertEqual(replies[-1]["data"], outcome)
+        self.assertEqual(pushed, {"event": "result", "table_id": 1, "user": None, **outcome})
+        self.assertEqual((frozen["msg"], frozen["data"]), ("SERVER:: Game is over", outcome))
+        self.assertEqual(status["data"], outcome)
+        self.assertEqual(len(server.archive), 1)
+        self.assertEqual(server.archive.game(0)["result"], "1/2-1/2")
+        abandoned = Table(5, "vasya", None)
+        abandoned.push(chess.Move.from_uci("e2e4"))
+        self.assertEqual(server.archive.game(server.archive_table(abandoned))["result"], "*")
+
+    def test_soak_run_is_reproducible_from_seed(self):
+        """Случайный прогон многих клиентов сохраняет инварианты и повторяется по seed."""
+        first = asyncio.run(soak(3, clients=12, steps=150, batch=6))
+        again = asyncio.run(soak(3, clients=12, steps=150, batch=6))
+        other = asyncio.run(soak(4, clients=12, steps=150, batch=6))
+        self.assertEqual(first["trace"], again["trace"])
+        self.assertEqual(first["requests"], again["requests"])
+        self.assertNotEqual(first["trace"], other["trace"])
+        self.assertGreater(first["tables"], 0)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -83,6 +83,16 @@ def task_test():
     return {"actions": ["python3 -m chessclub.tests.unittests -v"]}
 
 
+def task_soak():
+    """Run seeded soak of server with random clients."""
+    return {"actions": ["python3 -m chessclub.tests.soak --seed 1"]}
+
+
+def task_bench():
+    """Run client render benchmark."""
+    return {"actions": ["python3 -m chessclub.tests.benchmarks render"]}
+
+
 def task_clean_targets():
     """Gitclean."""
     return {"actions": ["gir clean -xdf", "rmtree docs"]}